@@ -0,0 +1,163 @@
+""" Benchmark lookups of tiles, products, and bands in a large index
+
+Builds a synthetic SQLite index (by default, of 10 million bands) and times
+the lookups made while ingesting and reading:
+
+    * ``get_tile_by_tile_index``
+    * ``get_product_by_name``
+    * ``get_band_by_name``
+    * ``get_products_by_tile`` within a time range
+
+Run with ``--single`` to time the same lookups using only the single column
+indexes of databases created before composite indexes.
+
+Example:
+
+    > python sandbox/benchmark_db.py --bands 10000000 /tmp/benchmark.db
+"""
+import datetime as dt
+import os
+import random
+import time
+from timeit import default_timer
+
+import click
+import numpy as np
+
+N_BANDS = 10
+N_TILES_PER_SCENE = 6
+BAND_NAMES = ['sr_band{}'.format(i) for i in range(1, N_BANDS)] + ['cfmask']
+# Composite indexes, and the single column indexes they replaced
+COMPOSITE_INDEXES = ('ix_tile_tilespec_index', 'ix_product_tile_acquired',
+                     'ix_band_product_standard_name')
+SINGLE_INDEXES = ('CREATE INDEX ix_band_product_id ON band (product_id)',
+                  'CREATE INDEX ix_product_tile_id ON product (tile_id)')
+
+
+def _chunks(rows, size=100000):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def build(db, n_bands):
+    """ Fill the database with tiles of scenes, each with ``N_BANDS`` bands
+    """
+    from tilezilla.db import (TableBand, TableBandDefinition, TableProduct,
+                              TableScene, TableTile)
+
+    n_products = n_bands // N_BANDS
+    n_scenes = n_products // N_TILES_PER_SCENE
+    n_tiles = max(int(np.sqrt(n_products / 2.)), 1)
+    spec = db.ensure_tilespec('benchmark', [0, 0], 'EPSG:5070',
+                              [30, 30], [5000, 5000])
+    now = dt.datetime(2016, 1, 1)
+    day = dt.timedelta(days=1)
+    conn = db.engine.connect()
+    with conn.begin():
+        conn.execute(TableTile.__table__.insert(), [
+            dict(id=i + 1, tilespec_id=spec.id, storage='GeoTIFF',
+                 collection='ESPALandsat', horizontal=i % 100,
+                 vertical=i // 100, bounds=[0, 0, 1, 1], key=i,
+                 xmin=0, ymin=0, xmax=1, ymax=1) for i in range(n_tiles)])
+        conn.execute(TableBandDefinition.__table__.insert(), [
+            dict(id=i + 1, standard_name=name, long_name=name,
+                 friendly_name=name, units='reflectance', fill=-9999,
+                 valid_min=-2000, valid_max=16000, scale_factor=0.0001)
+            for i, name in enumerate(BAND_NAMES)])
+        conn.execute(TableScene.__table__.insert(), [
+            dict(id=i + 1, timeseries_id='LT5{:012d}'.format(i),
+                 description='ESPALandsat', platform='LANDSAT_5',
+                 instrument='TM', processed=now, metadata_={},
+                 created=now, updated=now) for i in range(n_scenes)])
+        # Scenes cover consecutive tiles, so each tile has products spanning
+        # n_products / n_tiles days
+        products = [
+            dict(id=i + 1, tile_id=(i % n_tiles) + 1,
+                 scene_id=(i // N_TILES_PER_SCENE) % n_scenes + 1,
+                 timeseries_id='LT5{:012d}'.format(i // N_TILES_PER_SCENE),
+                 acquired=now + (i // n_tiles) * day, n_bands=N_BANDS,
+                 metadata_files_={}, created=now, updated=now)
+            for i in range(n_products)]
+        for chunk in _chunks(products):
+            conn.execute(TableProduct.__table__.insert(), chunk)
+        del products
+        for start in range(0, n_products, 10000):
+            conn.execute(TableBand.__table__.insert(), [
+                dict(product_id=p + 1, definition_id=b + 1,
+                     standard_name=name, path='{}_{}.tif'.format(p, name),
+                     bidx=1, created=now, updated=now)
+                for p in range(start, min(start + 10000, n_products))
+                for b, name in enumerate(BAND_NAMES)])
+    conn.close()
+    return spec.id, n_tiles, n_products
+
+
+def _time(db, func, args):
+    """ Return median and 95th percentile time of calls, in milliseconds
+    """
+    times = []
+    for arg in args:
+        start = default_timer()
+        func(*arg)
+        times.append(default_timer() - start)
+        db.session.remove()
+    return np.median(times) * 1000., np.percentile(times, 95) * 1000.
+
+
+@click.command()
+@click.option('--bands', default=10000000, show_default=True,
+              help='Number of band rows')
+@click.option('--samples', default=500, show_default=True,
+              help='Number of lookups timed')
+@click.option('--single', is_flag=True,
+              help='Use only single column indexes')
+@click.argument('path', type=click.Path(dir_okay=False))
+def main(bands, samples, single, path):
+    from tilezilla.db import Database, TableProduct
+
+    if os.path.exists(path):
+        os.remove(path)
+    db = Database.connect('sqlite:///' + path)
+    start = time.time()
+    tilespec_id, n_tiles, n_products = build(db, bands)
+    click.echo('Built index of {} tiles, {} products, and {} bands in {:.0f}s'
+               .format(n_tiles, n_products, n_products * N_BANDS,
+                       time.time() - start))
+    if single:
+        with db.engine.begin() as conn:
+            for name in COMPOSITE_INDEXES:
+                conn.execute('DROP INDEX {}'.format(name))
+            for ddl in SINGLE_INDEXES:
+                conn.execute(ddl)
+    with db.engine.begin() as conn:
+        conn.execute('ANALYZE')
+
+    rng = random.Random(0)
+    products = [rng.randrange(n_products) for _ in range(samples)]
+    days = n_products // n_tiles
+    lookups = [
+        ('get_tile_by_tile_index', db.get_tile_by_tile_index,
+         [(tilespec_id, 'GeoTIFF', 'ESPALandsat', i % 100, i // 100)
+          for i in (rng.randrange(n_tiles) for _ in range(samples))]),
+        ('get_product_by_name', db.get_product_by_name,
+         [(p % n_tiles + 1, 'LT5{:012d}'.format(p // N_TILES_PER_SCENE))
+          for p in products]),
+        ('get_band_by_name', db.get_band_by_name,
+         [(p + 1, rng.choice(BAND_NAMES)) for p in products]),
+        ('get_products_by_tile (30 days)', db.get_products_by_tile,
+         [(rng.randrange(n_tiles) + 1,
+           dt.datetime(2016, 1, 1) + dt.timedelta(days=d),
+           dt.datetime(2016, 1, 1) + dt.timedelta(days=d + 30))
+          for d in (rng.randrange(max(days - 30, 1))
+                    for _ in range(samples))])
+    ]
+    click.echo('{:<32}{:>12}{:>12}'.format('Lookup', 'median (ms)',
+                                           '95% (ms)'))
+    for name, func, args in lookups:
+        median, p95 = _time(db, func, args)
+        click.echo('{:<32}{:>12.3f}{:>12.3f}'.format(name, median, p95))
+    assert db.session.query(TableProduct).count() == n_products
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,9 @@ entry_points = '''
     ingest=tilezilla.cli.ingest:ingest
     spew=tilezilla.cli.spew:spew
     db=tilezilla.cli.db:db
+    extract=tilezilla.cli.extract:extract
+    composite=tilezilla.cli.composite:composite
+    tiles=tilezilla.cli.info:tiles
 '''
 
 setup(
@@ -62,3 +62,85 @@ def ESPA_GTiff_order_EPSG5070(ESPA_GTiff_archive_EPSG5070,
         tgz.extractall(path)
         path = os.path.join(path, commonpath(tgz.getnames()))
     return path
+
+
+# Indexed datacube -------------------------------------------------------------
+#: dict: Small tile specification used to build test datacubes
+CUBE_TILESPEC = {
+    'ul': (0., 1000.),
+    'crs': 'EPSG:5070',
+    'res': (10., 10.),
+    'size': (50, 50),
+    'desc': 'test_cube'
+}
+#: list[tuple]: Tiles (horizontal, vertical) indexed in the test datacube
+CUBE_TILES = [(0, 0), (1, 0), (0, 1), (1, 1)]
+#: list[str]: Bands indexed in the test datacube
+CUBE_BANDS = ['sr_band3', 'sr_band4', 'cfmask']
+#: int: Number of observations in the test datacube
+CUBE_NTIME = 3
+#: int: Fill value of bands in the test datacube
+CUBE_FILL = -9999
+
+
+def _cube_value(t, band, row, col):
+    return t * 10000 + CUBE_BANDS.index(band) * 1000 + (row + col) % 1000
+
+
+@pytest.fixture
+def cube_value(request):
+    """ Return the value of test datacube pixels at global row/column(s)
+    """
+    return _cube_value
+
+
+@pytest.fixture
+def indexed_cube(tmpdir):
+    """ A small datacube, tiled as GeoTIFFs and indexed in a SQLite database
+
+    Returns:
+        DatasetResource: Dataset resource of the datacube
+    """
+    import arrow
+    import numpy as np
+    import rasterio
+
+    from tilezilla.core import Band, BoundingBox
+    from tilezilla.db import Database, DatacubeResource, DatasetResource
+    from tilezilla.products import ESPALandsat
+    from tilezilla.tilespec import TileSpec
+
+    spec = TileSpec(**CUBE_TILESPEC)
+    db = Database.connect('sqlite:///' + str(tmpdir.join('tilezilla.db')))
+    cube = DatacubeResource(db, spec, 'GeoTIFF')
+    dataset = DatasetResource(db, cube)
+
+    ny, nx = spec.size[1], spec.size[0]
+    for h, v in CUBE_TILES:
+        tile = spec[(v, h)]
+        tile_id = cube.ensure_tile('ESPALandsat', h, v)
+        rows, cols = np.mgrid[v * ny:(v + 1) * ny, h * nx:(h + 1) * nx]
+        for t in range(CUBE_NTIME):
+            product = ESPALandsat(
+                timeseries_id='LT5000000200{}001XXX01'.format(t),
+                acquired=arrow.get(2000 + t, 6, 1),
+                processed=arrow.get(2016, 1, 1),
+                platform='LANDSAT_5', instrument='TM',
+                bounds=BoundingBox(*tile.bounds))
+            product_id = dataset.ensure_product(tile_id, product)
+            for name in CUBE_BANDS:
+                path = str(tmpdir.join('h{}v{}_{}_{}.tif'.format(h, v, t,
+                                                                  name)))
+                with rasterio.open(path, 'w', driver='GTiff',
+                                   dtype='int16', count=1,
+                                   width=nx, height=ny, crs=spec.crs,
+                                   transform=tile.transform,
+                                   nodata=CUBE_FILL, tiled=True,
+                                   blockxsize=16, blockysize=16) as dst:
+                    data = _cube_value(t, name, rows, cols).astype(np.int16)
+                    dst.write(data, 1)
+                dataset.ensure_band(product_id, Band(
+                    path, standard_name=name, long_name=name,
+                    friendly_name=name, units='reflectance',
+                    fill=CUBE_FILL, valid_min=-2000, valid_max=16000))
+    return dataset
@@ -0,0 +1,166 @@
+""" Tests for `tilezilla.api`
+"""
+import numpy as np
+import pytest
+
+from tilezilla import api
+from tilezilla.core import BoundingBox
+
+
+@pytest.fixture
+def reader(indexed_cube):
+    return api.TimeSeriesReader(indexed_cube, njob=2)
+
+
+# TimeSeriesReader -------------------------------------------------------------
+def test_reader_lazy(reader, monkeypatch):
+    calls = []
+    _read = api.TimeSeriesArray._read
+
+    def _spy(self, *args):
+        calls.append(args)
+        return _read(self, *args)
+
+    monkeypatch.setattr(api.TimeSeriesArray, '_read', _spy)
+    arrays = reader.read(BoundingBox(100, 700, 300, 900), ['sr_band3'])
+    assert arrays['sr_band3'].shape == (3, 20, 20)
+    assert not calls
+
+    arrays['sr_band3'][1, :5, :5]
+    assert len(calls) == 1
+
+
+def test_reader_values(reader, cube_value):
+    arrays = reader.read(BoundingBox(100, 700, 300, 900),
+                         ['sr_band3', 'cfmask'])
+    rows, cols = np.mgrid[10:30, 10:30]
+    for name, arr in arrays.items():
+        data = arr[:]
+        for t in range(len(arr)):
+            np.testing.assert_equal(data[t], cube_value(t, name, rows, cols))
+
+
+@pytest.mark.parametrize('key', [
+    (0, ),
+    (slice(None), 3, 4),
+    (slice(0, 2), slice(2, 10, 3), slice(None, None, -1)),
+    ([2, 0], slice(5, 6), 7),
+    (-1, -1, -1),
+])
+def test_reader_indexing(reader, cube_value, key):
+    arr = reader.read(BoundingBox(100, 700, 300, 900), ['sr_band4'])['sr_band4']
+    rows, cols = np.mgrid[10:30, 10:30]
+    truth = np.stack([cube_value(t, 'sr_band4', rows, cols)
+                      for t in range(len(arr))])
+    np.testing.assert_equal(arr[key], truth[key])
+
+
+def test_reader_time_range(reader):
+    arrays = reader.read(BoundingBox(100, 700, 300, 900), ['sr_band3'],
+                         start='2000-12-31', end='2001-12-31')
+    assert len(arrays['sr_band3']) == 1
+    assert arrays['sr_band3'].times[0].year == 2001
+
+
+def test_reader_missing_band(reader):
+    arr = reader.read(BoundingBox(100, 700, 300, 900), ['not_a_band'])
+    assert np.all(np.isnan(arr['not_a_band'][:]))
+
+
+# Stitching across tiles -------------------------------------------------------
+def test_reader_stitch(reader, cube_value, monkeypatch):
+    opened = []
+    _open = api.rasterio.open
+
+    def _spy(path, *args, **kwargs):
+        opened.append(path)
+        return _open(path, *args, **kwargs)
+
+    monkeypatch.setattr(api.rasterio, 'open', _spy)
+
+    arr = reader.read(BoundingBox(300, 300, 700, 700), ['sr_band3'])['sr_band3']
+    assert arr.shape == (3, 40, 40)
+    rows, cols = np.mgrid[30:70, 30:70]
+    data = arr[:]
+    for t in range(len(arr)):
+        np.testing.assert_equal(data[t], cube_value(t, 'sr_band3', rows, cols))
+
+    # Reading a window within one tile only touches that tile
+    del opened[:]
+    arr[0, :10, :10]
+    assert len(opened) == 1
+
+
+def test_reader_stitch_fill(reader, cube_value):
+    # Tiles to the right of (1, 0) are not indexed
+    arr = reader.read(BoundingBox(900, 500, 1100, 700), ['cfmask'])['cfmask']
+    rows, cols = np.mgrid[30:50, 90:110]
+    data = arr[:]
+    np.testing.assert_equal(data[:, :, :10],
+                            np.stack([cube_value(t, 'cfmask', rows, cols)
+                                      for t in range(3)])[:, :, :10])
+    assert np.all(data[:, :, 10:] == -9999)
+
+
+def test_reader_read_roi(reader, cube_value):
+    import shapely.geometry
+    roi = shapely.geometry.box(450, 450, 560, 520)
+    arr = reader.read_roi(roi, ['sr_band4'])['sr_band4']
+    assert arr.shape == (3, 7, 11)
+    rows, cols = np.mgrid[48:55, 45:56]
+    np.testing.assert_equal(arr[2], cube_value(2, 'sr_band4', rows, cols))
+
+
+# Point extraction -------------------------------------------------------------
+def test_reader_read_points(reader, cube_value, monkeypatch):
+    reads = []
+    _open = api.rasterio.open
+
+    def _spy(path, *args, **kwargs):
+        src = _open(path, *args, **kwargs)
+        _read = src.read
+
+        def _read_spy(*args, **kwargs):
+            reads.append(path)
+            return _read(*args, **kwargs)
+        src.read = _read_spy
+        return src
+
+    monkeypatch.setattr(api.rasterio, 'open', _spy)
+
+    # Two points share a block, one is in another tile, one is not indexed
+    x = np.array([15., 25., 515., 2500.])
+    y = np.array([985., 975., 15., 985.])
+    results = list(reader.read_points(x, y, ['sr_band3', 'cfmask']))
+    assert len(results) == 2
+
+    idx, products, values = results[0]
+    np.testing.assert_equal(idx, [0, 1])
+    assert len(products) == 3
+    for t in range(3):
+        np.testing.assert_equal(values['cfmask'][t],
+                                cube_value(t, 'cfmask',
+                                           np.array([1, 2]),
+                                           np.array([1, 2])))
+    idx, products, values = results[1]
+    np.testing.assert_equal(idx, [2])
+    np.testing.assert_equal(values['sr_band3'][:, 0],
+                            [cube_value(t, 'sr_band3', 98, 51)
+                             for t in range(3)])
+
+    # One block read per product band per tile
+    assert len(reads) == 2 * 3 * 2
+
+
+# Read planning ---------------------------------------------------------------
+def test_reader_plan(reader):
+    arr = reader.read(BoundingBox(300, 300, 700, 700), ['sr_band3'])['sr_band3']
+    plan = arr.plan((0, slice(None), slice(None)))
+    # 4 tiles overlap the array; each read is aligned to 16x16 blocks,
+    # i.e., rows/cols 16:50 in the upper/left tiles and 0:32 in the others
+    assert plan.summary()['n_files'] == 4
+    assert len(plan.reads) == 4
+    assert plan.planned_bytes == (34 + 32) ** 2 * 2
+    assert plan.naive_bytes == 4 * 50 * 50 * 2
+
+    assert not arr.plan((slice(0, 0), )).reads
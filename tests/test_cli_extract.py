@@ -0,0 +1,89 @@
+""" Tests for `tilez extract`
+"""
+import csv
+import os
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import rasterio
+
+from tilezilla import config
+from tilezilla.cli import extract, ingest
+
+
+@pytest.fixture
+def ingested_config(ESPA_GTiff_archive_EPSG5070, tmpdir):
+    root = str(tmpdir.mkdir('cube'))
+    cfg = {
+        'database': {'drivername': 'sqlite',
+                     'database': os.path.join(root, 'tilezilla.db')},
+        'store': {
+            'name': 'GeoTIFF',
+            'root': root,
+            'tile_dirpattern': 'h{horizontal:04d}v{vertical:04d}',
+            'tile_imgpattern':
+                '{product.timeseries_id}_{band.standard_name}.tif'
+        },
+        'tilespec': 'WELD_CONUS',
+        'products': {
+            'ESPALandsat': {
+                'include_filter': {
+                    'regex': False,
+                    'long_name': ['*band 3 surface reflectance*']
+                },
+                'resampling': 'nearest'
+            }
+        }
+    }
+    cfg = config._parse_products(config._parse_targets(config._parse_store(
+        config._parse_tilespec(cfg))))
+
+    result = CliRunner().invoke(ingest.ingest, [ESPA_GTiff_archive_EPSG5070],
+                                obj={'config': cfg})
+    assert result.exit_code == 0, result.output
+    return cfg
+
+
+def test_extract(ingested_config, tmpdir):
+    root = ingested_config['store']['root']
+    images = sorted(os.path.join(d, f) for d, _, fs in os.walk(root)
+                    for f in fs if f.endswith('_sr_band3.tif'))
+    assert len(images) == 2
+
+    # Two points within each ingested tile
+    points, expected = [], {}
+    for image in images:
+        with rasterio.open(image) as src:
+            data = src.read(1)
+            valid = np.argwhere(data != src.nodata)
+            for row, col in valid[[0, len(valid) // 2]]:
+                x, y = src.xy(row, col)
+                pid = 'pt{0}'.format(len(points))
+                points.append((pid, x, y))
+                expected[pid] = data[row, col]
+
+    points_csv = str(tmpdir.join('points.csv'))
+    with open(points_csv, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'x', 'y'])
+        writer.writerows(points)
+
+    output = str(tmpdir.join('output.csv'))
+    result = CliRunner().invoke(
+        extract.extract, ['-b', 'sr_band3', '--id_col', 'id', '--njob', '2',
+                          points_csv, output],
+        obj={'config': ingested_config})
+    assert result.exit_code == 0, result.output
+
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0].keys()) == ['id', 'x', 'y', 'timeseries_id',
+                                    'acquired', 'sr_band3']
+    # One observation per point for the single ingested product
+    assert len(rows) == len(points)
+    assert sorted(row['id'] for row in rows) == sorted(expected)
+    for row in rows:
+        assert row['timeseries_id'] == 'LT50120312002300LGS01'
+        assert row['acquired'].startswith('2002-10-27')
+        assert int(float(row['sr_band3'])) == expected[row['id']]
@@ -0,0 +1,87 @@
+""" Tests for `tilez tiles`
+"""
+import csv
+import json
+import sqlite3
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import shapely.geometry
+import shapely.wkb
+
+from tilezilla.cli import info
+
+
+@pytest.fixture
+def cube_config(indexed_cube, tmpdir):
+    return {
+        'tilespec': indexed_cube.datacube.tilespec,
+        'store': {'name': 'GeoTIFF'},
+        'database': {'drivername': 'sqlite',
+                     'database': str(tmpdir.join('tilezilla.db'))}
+    }
+
+
+def _invoke(config, args):
+    result = CliRunner().invoke(info.tiles, args, obj={'config': config})
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def test_tile_records(indexed_cube):
+    spec = indexed_cube.datacube.tilespec
+    rows, cols = np.array([0, 1]), np.array([1, 0])
+    records = list(info.tile_records(spec, rows, cols, counts={(0, 1): 3},
+                                     chunk_size=1))
+    assert records == [
+        (1, 0, spec[(0, 1)].key) + tuple(spec[(0, 1)].bounds) + (3, ),
+        (0, 1, spec[(1, 0)].key) + tuple(spec[(1, 0)].bounds) + (0, )
+    ]
+
+
+def test_tiles_csv_counts(tmpdir, cube_config):
+    output = str(tmpdir.join('tiles.csv'))
+    _invoke(cube_config, ['--counts', '--order', 'hilbert', output])
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 4
+    assert [int(row['n_products']) for row in rows] == [3] * 4
+    keys = [int(row['key']) for row in rows]
+    assert keys == sorted(keys)
+
+
+def test_tiles_geojsonseq_bbox(tmpdir, cube_config):
+    output = str(tmpdir.join('tiles.geojsonl'))
+    # 3x3 tiles, though only 4 are indexed
+    _invoke(cube_config, ['--bbox', '1', '1', '1499', '1499', output])
+    with open(output) as f:
+        features = [json.loads(line) for line in f]
+    assert len(features) == 9
+    spec = cube_config['tilespec']
+    feat = features[0]
+    tile = spec[(feat['properties']['vertical'],
+                 feat['properties']['horizontal'])]
+    assert shapely.geometry.shape(feat['geometry']).equals(tile.polygon)
+
+
+def test_tiles_gpkg(tmpdir, cube_config):
+    output = str(tmpdir.join('tiles.gpkg'))
+    _invoke(cube_config, ['--counts', output])
+    con = sqlite3.connect(output)
+    rows = con.execute('SELECT geom, horizontal, vertical, n_products '
+                       'FROM tiles').fetchall()
+    assert len(rows) == 4
+    spec = cube_config['tilespec']
+    for geom, h, v, n in rows:
+        # Skip 8 byte header and 32 byte envelope of GeoPackage geometry
+        assert shapely.wkb.loads(bytes(geom[40:])).equals(spec[(v, h)].polygon)
+        assert n == 3
+    contents = con.execute('SELECT table_name, srs_id, min_x, max_y '
+                           'FROM gpkg_contents').fetchall()
+    assert contents == [('tiles', 5070, 0.0, 1000.0)]
+
+    # Don't overwrite without asking
+    result = CliRunner().invoke(info.tiles, [output],
+                                obj={'config': cube_config})
+    assert result.exit_code != 0
@@ -0,0 +1,176 @@
+""" Tests for `tilezilla.composite`
+"""
+from collections import OrderedDict
+
+import arrow
+import numpy as np
+import pytest
+import rasterio
+
+from tilezilla import api, composite
+
+
+@pytest.fixture
+def series():
+    """ 4 observations of 2 bands at 3 pixels, with a cfmask band
+    """
+    red = np.array([[100., 200., 300.],
+                    [400., 500., 600.],
+                    [150., np.nan, 350.],
+                    [250., 250., 250.]])
+    nir = np.array([[800., 300., 400.],
+                    [900., 700., 700.],
+                    [400., np.nan, 350.],
+                    [300., 2000., 350.]])
+    cfmask = np.array([[0, 4, 2],
+                       [4, 0, 3],
+                       [1, 255, 4],
+                       [0, 2, 2]])
+    data = OrderedDict([('sr_band3', red[..., np.newaxis]),
+                        ('sr_band4', nir[..., np.newaxis])])
+    times = [arrow.get(2000, m, 1) for m in (3, 6, 7, 10)]
+    return data, cfmask[..., np.newaxis], times
+
+
+def test_median(series):
+    data, mask, times = series
+    result = composite.median(data)
+    np.testing.assert_allclose(result['sr_band3'][:, 0], [200., 250., 325.])
+
+    result = composite.median(data, mask=mask)
+    np.testing.assert_allclose(result['sr_band3'][:, 0],
+                               [150., 500., np.nan])
+    np.testing.assert_allclose(result['sr_band4'][:, 0],
+                               [400., 700., np.nan])
+
+
+def test_percentile(series):
+    data, mask, times = series
+    result = composite.percentile(data, q=100)
+    np.testing.assert_allclose(result['sr_band4'][:, 0], [900., 2000., 700.])
+    with pytest.raises(ValueError):
+        composite.percentile(data, q=101)
+
+
+def test_max_ndvi(series):
+    data, mask, times = series
+    result = composite.max_ndvi(data)
+    np.testing.assert_allclose(result['sr_band3'][:, 0], [100., 250., 250.])
+    np.testing.assert_allclose(result['sr_band4'][:, 0], [800., 2000., 350.])
+
+    # Cloudy observations are not selected
+    result = composite.max_ndvi(data, mask=mask)
+    np.testing.assert_allclose(result['sr_band3'][:, 0], [100., 500., np.nan])
+
+    with pytest.raises(KeyError):
+        composite.max_ndvi(data, red='sr_band1')
+
+
+def test_best_pixel(series):
+    data, mask, times = series
+    # Clear, then most recent: t=3 (clear), t=1 (clear), t=1 (snow)
+    result = composite.best_pixel(data, mask=mask, times=times)
+    np.testing.assert_allclose(result['sr_band3'][:, 0], [250., 500., 600.])
+
+    # Prefer observations near July 1st among clear observations
+    result = composite.best_pixel(data, mask=mask, times=times,
+                                  target_doy=182)
+    np.testing.assert_allclose(result['sr_band3'][:, 0], [150., 500., 600.])
+
+    with pytest.raises(ValueError):
+        composite.best_pixel(data, times=times)
+
+
+@pytest.mark.parametrize(('shape', 'block_shape', 'n'), [
+    ((50, 50), (16, 16), 16),
+    ((32, 48), (16, 16), 6),
+    ((10, 10), (256, 256), 1),
+])
+def test_block_windows(shape, block_shape, n):
+    windows = list(composite.block_windows(shape, block_shape))
+    assert len(windows) == n
+    covered = np.zeros(shape, dtype=int)
+    for (r0, r1), (c0, c1) in windows:
+        covered[r0:r1, c0:c1] += 1
+    assert np.all(covered == 1)
+
+
+# Compositing tiles ------------------------------------------------------------
+@pytest.fixture
+def tile_arrays(indexed_cube):
+    reader = api.TimeSeriesReader(indexed_cube)
+    tile = indexed_cube.datacube.tilespec[(1, 0)]
+    return reader.read(tile.bounds, ['sr_band3', 'sr_band4'])
+
+
+@pytest.mark.parametrize('njob', [1, 3])
+def test_composite_blocks(tile_arrays, cube_value, njob):
+    blocks = list(composite.composite_blocks(tile_arrays, 'median',
+                                             njob=njob))
+    assert len(blocks) == 16
+
+    rows, cols = np.mgrid[50:100, 0:50]
+    truth = cube_value(1, 'sr_band4', rows, cols)
+    for ((r0, r1), (c0, c1)), result in blocks:
+        assert list(result) == ['sr_band3', 'sr_band4']
+        np.testing.assert_equal(result['sr_band4'], truth[r0:r1, c0:c1])
+
+
+@pytest.mark.parametrize('njob', [1, 3])
+def test_composite_blocks_open_once(monkeypatch, tile_arrays, njob):
+    # Datatype and block shape are read from the first file of each band
+    for arr in tile_arrays.values():
+        arr.block_shape
+    opened = []
+    _open = rasterio.open
+
+    def _counted_open(path, *args, **kwargs):
+        opened.append(path)
+        return _open(path, *args, **kwargs)
+
+    monkeypatch.setattr(rasterio, 'open', _counted_open)
+    blocks = list(composite.composite_blocks(tile_arrays, 'median',
+                                             njob=njob))
+    assert len(blocks) == 16
+
+    # Each file is opened once per thread, not once per block
+    paths = set(path for arr in tile_arrays.values()
+                for pieces in arr.sources for path, _, _ in pieces)
+    assert set(opened) == paths
+    assert len(opened) <= njob * len(paths)
+
+
+def test_composite_blocks_missing_mask(tmpdir, indexed_cube):
+    reader = api.TimeSeriesReader(indexed_cube)
+    tile = indexed_cube.datacube.tilespec[(1, 0)]
+    arrays = reader.read(tile.bounds, ['sr_band3', 'fmask'])
+    mask = arrays.pop('fmask')
+
+    # Masking with a band that isn't indexed would mask every pixel
+    with pytest.raises(ValueError) as exc:
+        next(composite.composite_blocks(arrays, 'median', mask=mask))
+    assert 'fmask' in str(exc.value)
+
+    path = str(tmpdir.join('comp.tif'))
+    with pytest.raises(ValueError):
+        composite.write_composite(path, arrays, 'median', mask=mask)
+    assert not tmpdir.join('comp.tif').check()
+
+
+@pytest.mark.parametrize(('method', 'dtype'), [
+    ('median', 'float32'),
+    ('max_ndvi', 'int16'),
+])
+def test_write_composite(tmpdir, tile_arrays, cube_value, method, dtype):
+    path = composite.write_composite(str(tmpdir.join('comp.tif')),
+                                     tile_arrays, method, njob=2)
+    rows, cols = np.mgrid[50:100, 0:50]
+    # NDVI of the test cube is greatest for the earliest observation
+    t = 1 if method == 'median' else 0
+    with rasterio.open(path) as src:
+        assert src.count == 2
+        assert src.dtypes[0] == dtype
+        assert src.transform == tile_arrays['sr_band3'].transform
+        assert src.descriptions == ('sr_band3', 'sr_band4')
+        np.testing.assert_equal(src.read(1), cube_value(t, 'sr_band3',
+                                                        rows, cols))
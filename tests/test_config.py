@@ -1,6 +1,9 @@
 import os
 
+import pytest
+
 from tilezilla import config
+from tilezilla.errors import ConfigException
 
 
 # ENVIRONMENT VARIABLE PARSING
@@ -33,3 +36,61 @@ def test_get_envvars():
     os.environ.update(backup)
 
     assert truth == expanded
+
+
+# INGEST TARGETS
+def _targets_config(**target):
+    return {
+        'tilespec': 'WELD_CONUS',
+        'store': {'name': 'GeoTIFF', 'root': '/tmp/tiles',
+                  'tile_dirpattern': 'h{horizontal:04d}v{vertical:04d}'},
+        'targets': [dict({
+            'tilespec': {'desc': 'REGIONAL', 'crs': 'EPSG:5070',
+                         'ul': [0., 0.], 'res': [60., 60.],
+                         'size': [100, 100]},
+        }, **target)]
+    }
+
+
+def _parse(cfg):
+    return config._parse_targets(config._parse_store(
+        config._parse_tilespec(cfg)))
+
+
+def test_parse_targets():
+    cfg = _parse(_targets_config(store={
+        'tile_dirpattern': '{tilespec.desc}/h{horizontal}v{vertical}'}))
+    assert [t['tilespec'].desc for t in cfg['targets']] == \
+        ['WELD_CONUS', 'REGIONAL']
+    # Stores inherit the options not given for the target
+    store = cfg['targets'][1]['store']
+    assert store['root'] == '/tmp/tiles'
+    assert store['tile_dirpattern'].names == ('tilespec', 'horizontal',
+                                              'vertical')
+    assert cfg['targets'][0]['store'] is cfg['store']
+
+
+def test_parse_targets_same_paths():
+    with pytest.raises(ConfigException):
+        _parse(_targets_config())
+    # Another root is fine
+    _parse(_targets_config(store={'root': '/tmp/regional'}))
+
+
+def test_parse_targets_same_tilespec():
+    with pytest.raises(ConfigException):
+        _parse(_targets_config(tilespec='WELD_CONUS',
+                               store={'root': '/tmp/regional'}))
+
+
+# PRODUCTS
+def test_parse_products_derived():
+    cfg = {'products': {'ESPALandsat': {'derived': {
+        'ndvi': {'function': 'normalized_difference',
+                 'bands': ['sr_band4', 'sr_band3']}
+    }}}}
+    assert config._parse_products(cfg) is cfg
+
+    cfg['products']['ESPALandsat']['derived']['ndvi']['function'] = 'ndvi'
+    with pytest.raises(ConfigException):
+        config._parse_products(cfg)
@@ -2,6 +2,7 @@
 """
 import inspect
 
+import numpy as np
 import rasterio
 import pytest
 
@@ -28,3 +29,14 @@ def test_band(rgb_image, band_idx):
                  if not p.startswith('_')]
         for prop, value in props:
             assert getattr(band.band, prop) == value
+
+
+def test_band_masked():
+    band = core.Band(None, fill=-9999, valid_min=0, valid_max=10)
+    data = np.array([-9999, 0, 5, 11])
+    masked = band.masked(data)
+    np.testing.assert_equal(np.ma.getmaskarray(masked), [1, 0, 0, 1])
+
+    band = core.Band(None, fill=np.nan)
+    masked = band.masked(np.array([np.nan, np.inf, 1.]))
+    np.testing.assert_equal(np.ma.getmaskarray(masked), [1, 1, 0])
@@ -0,0 +1,512 @@
+""" Tests for `tilezilla.db`
+"""
+import pytest
+import sqlalchemy as sa
+
+from tilezilla.db import (TableBand, TableBandDefinition, TableProduct,
+                          TableScene, TableTile, construct_filter)
+
+
+def test_tile_keys(indexed_cube):
+    datacube = indexed_cube.datacube
+    tiles = datacube.get_tiles()
+    # Tiles are indexed with, and returned in the order of, their keys
+    keys = [tile.key for tile in tiles]
+    assert keys == sorted(keys)
+    _tiles = datacube.db.get_tiles(datacube.tilespec_id)
+    assert [t.key for t in _tiles] == keys
+
+    # Range queries on keys
+    start, stop = keys[1], keys[-1]
+    assert datacube.get_tiles(key_range=(start, stop)) == tiles[1:-1]
+
+
+# Spatial index
+@pytest.mark.parametrize('rtree', [True, False])
+def test_tiles_intersecting(indexed_cube, rtree):
+    db = indexed_cube.datacube.db
+    assert db.rtree
+    db.rtree = rtree
+
+    def _search(**kwargs):
+        tiles = db.tiles_intersecting(**kwargs)
+        return sorted((t.horizontal, t.vertical) for t in
+                      db.session.query(TableTile).filter(tiles))
+
+    # Tiles are 500m wide, with upper left at (0, 1000)
+    assert _search(bounds=(100, 600, 200, 700)) == [(0, 0)]
+    assert _search(bounds=(400, 600, 600, 700)) == [(0, 0), (1, 0)]
+    # Touching edge intersects
+    assert _search(bounds=(500, 0, 600, 100)) == [(0, 1), (1, 1)]
+    assert _search(bounds=(2000, 2000, 3000, 3000)) == []
+
+    # Geometries are tested exactly, after finding tiles using their bounds
+    triangle = {'type': 'Polygon',
+                'coordinates': [[(10, 990), (990, 990), (990, 30),
+                                 (10, 990)]]}
+    assert _search(geometries=[triangle]) == [(0, 0), (1, 0), (1, 1)]
+
+
+def test_tiles_intersecting_crs(indexed_cube):
+    from rasterio.warp import transform_bounds
+    db = indexed_cube.datacube.db
+    bounds = transform_bounds('EPSG:5070', 'EPSG:4326', 100, 600, 200, 700)
+    tiles = db.tiles_intersecting(bounds=bounds, crs='EPSG:4326')
+    assert [(t.horizontal, t.vertical) for t in
+            db.session.query(TableTile).filter(tiles)] == [(0, 0)]
+
+
+def test_construct_filter_tiles(indexed_cube):
+    db = indexed_cube.datacube.db
+    tiles = db.tiles_intersecting(bounds=(100, 100, 200, 200))
+    query = construct_filter(db.session.query(TableProduct),
+                             ['timeseries_id = LT50000002001001XXX01'],
+                             tiles=tiles)
+    products = query.all()
+    assert len(products) == 1
+    assert (products[0].tile.horizontal, products[0].tile.vertical) == (0, 1)
+
+    query = construct_filter(db.session.query(TableBand),
+                             ['standard_name = cfmask'], tiles=tiles)
+    assert query.count() == 3
+
+
+# Indexed metadata
+def _product_with_metadata(t, **metadata):
+    import arrow
+    from tilezilla.core import BoundingBox
+    from tilezilla.products import ESPALandsat
+    return ESPALandsat(
+        timeseries_id='LT5012031200{}300LGS01'.format(t),
+        acquired=arrow.get(2000 + t, 10, 27),
+        processed=arrow.get(2016, 1, 1),
+        platform='LANDSAT_5', instrument='TM',
+        bounds=BoundingBox(0, 0, 1, 1), metadata=metadata)
+
+
+def test_create_scene_metadata(indexed_cube):
+    db = indexed_cube.datacube.db
+    product = _product_with_metadata(0, CLOUD_COVER='5.50', WRS_PATH='012',
+                                     DATA_TYPE='L1T', SUN_AZIMUTH=None,
+                                     OTHER='x')
+    # Only product's indexed keys are indexed by default
+    values = db.create_scene(product).metadata_values
+    assert sorted((m.key, m.value, m.number) for m in values) == [
+        ('CLOUD_COVER', '5.50', 5.5),
+        ('DATA_TYPE', 'L1T', None),
+        ('WRS_PATH', '012', 12.)
+    ]
+    values = db.create_scene(product, metadata_keys=['OTHER'])
+    assert [m.key for m in values.metadata_values] == ['OTHER']
+
+
+def test_construct_filter_metadata(indexed_cube):
+    db = indexed_cube.datacube.db
+    tile_id = db.get_tiles(indexed_cube.datacube.tilespec_id)[0].id
+    for t, (cloud, row) in enumerate([('5.5', '031'), ('50.0', '031'),
+                                      ('1.0', '032')]):
+        product = _product_with_metadata(t, CLOUD_COVER=cloud, WRS_ROW=row,
+                                         DATA_TYPE='L1T' if t else 'L1G')
+        db.ensure_product(tile_id, product)
+
+    def _search(*items):
+        query = construct_filter(db.session.query(TableProduct), items)
+        return sorted(p.timeseries_id[9:13] for p in query)
+
+    assert _search('metadata.CLOUD_COVER < 10') == ['2000', '2002']
+    assert _search('metadata.CLOUD_COVER < 10', 'metadata.WRS_ROW = 31') == \
+        ['2000']
+    assert _search('metadata.WRS_ROW in 31,33') == ['2000', '2001']
+    assert _search('metadata.DATA_TYPE = L1T') == ['2001', '2002']
+    assert _search('metadata.DATA_TYPE like L1%') == ['2000', '2001', '2002']
+
+    # Other tables are joined to products
+    query = construct_filter(db.session.query(TableTile),
+                             ['metadata.CLOUD_COVER > 10'])
+    assert [t.id for t in query] == [tile_id]
+
+
+# Normalized scenes and band definitions
+def test_scenes_shared_by_tiles(indexed_cube):
+    db = indexed_cube.datacube.db
+    # 4 tiles x 3 times, each with 3 bands
+    assert db.session.query(TableProduct).count() == 12
+    assert db.session.query(TableScene).count() == 3
+    assert db.session.query(TableBand).count() == 36
+    assert db.session.query(TableBandDefinition).count() == 3
+
+    product = db.session.query(TableProduct).first()
+    assert product.platform == 'LANDSAT_5'
+    assert product.scene.products[0].scene is product.scene
+    band = product.bands[0]
+    assert (band.units, band.fill) == ('reflectance', -9999)
+
+
+def test_construct_filter_scene_attributes(indexed_cube):
+    db = indexed_cube.datacube.db
+    query = construct_filter(db.session.query(TableProduct),
+                             ['platform = LANDSAT_5', 'instrument = TM'])
+    assert query.count() == 12
+    query = construct_filter(db.session.query(TableProduct),
+                             ['platform = LANDSAT_7'])
+    assert query.count() == 0
+    query = construct_filter(db.session.query(TableBand),
+                             ['units = reflectance', 'standard_name = cfmask'])
+    assert query.count() == 12
+
+
+# Number of bands
+def test_n_bands(indexed_cube):
+    from tilezilla.core import Band
+    db = indexed_cube.datacube.db
+    query = construct_filter(db.session.query(TableProduct), ['n_bands = 3'])
+    assert query.count() == 12
+    assert db.get_incomplete_products(3) == []
+
+    product = db.get_product(1)
+    db.ensure_band(product.id, Band('x.tif', standard_name='sr_band5',
+                                    long_name='sr_band5',
+                                    friendly_name='sr_band5',
+                                    units='reflectance', fill=-9999,
+                                    valid_min=-2000, valid_max=16000))
+    assert product.n_bands == 4
+    incomplete = db.get_incomplete_products(4)
+    assert len(incomplete) == 11 and product not in incomplete
+    assert len(db.get_incomplete_products(4, tile_ids=[product.tile_id])) == 2
+
+
+def test_index_product(indexed_cube):
+    db = indexed_cube.datacube.db
+    old = db.get_product(1)
+    product = db.create_product(_product_with_metadata(5))
+    product.tile_id = old.tile_id
+    product.scene_id = db.ensure_scene(_product_with_metadata(5)).id
+    bands = []
+    for band in indexed_cube.get_product(old.id).bands[:2]:
+        bands.append(db.create_band(band))
+        bands[-1].definition_id = db.ensure_band_definition(band)
+    product, bands = db.index_product(product, bands)
+    assert product.id and all(band.product_id == product.id
+                              for band in bands)
+    assert product.n_bands == 2
+
+    db.session.delete(bands[0])
+    db.session.commit()
+    db.update_band_count()
+    assert db.get_product(product.id).n_bands == 1
+
+
+def test_unknown_product_type(indexed_cube):
+    db = indexed_cube.datacube.db
+    product = indexed_cube.get_product(1)
+    assert product.description == 'ESPALandsat'
+
+    # Only map_cube collections are derived products; others must be known
+    scene = db.get_product(1).scene
+    scene.description = 'Unknown'
+    db.session.commit()
+    with pytest.raises(KeyError) as exc:
+        indexed_cube.get_product(1)
+    assert 'Unknown' in str(exc.value)
+
+
+def test_index_records(indexed_cube):
+    import pickle
+    from tilezilla.db import (band_record, definition_record, product_record,
+                              scene_record)
+    db = indexed_cube.datacube.db
+    old = db.get_product(1)
+    product = _product_with_metadata(5, CLOUD_COVER='7.5')
+    scene = scene_record(product)
+    bands = indexed_cube.get_product(old.id).bands
+    # One band with a new definition, and one with that already indexed
+    definitions = [definition_record(bands[0])._replace(units='percent'),
+                   definition_record(bands[1])]
+    records = [(old.tile_id,
+                product_record(timeseries_id=product.timeseries_id,
+                               acquired=product.acquired, clear_fraction=0.5),
+                [band_record(standard_name=band.standard_name, path='new',
+                             bidx=1, valid_fraction=0.25)
+                 for band in bands[:2]])]
+    # Records are plain data, without SQLAlchemy state
+    assert b'sqlalchemy' not in pickle.dumps((scene, definitions, records))
+
+    product_ids, band_ids = db.index_records(scene, definitions, records)
+    product = db.get_product(product_ids[0])
+    assert product.tile_id == old.tile_id
+    assert product.scene.timeseries_id == scene.timeseries_id
+    assert product.metadata_ == scene.metadata_
+    assert [(m.key, m.number) for m in product.scene.metadata_values] == [
+        ('CLOUD_COVER', 7.5)]
+    assert product.n_bands == 2 and product.clear_fraction == 0.5
+    assert sorted(band.id for band in product.bands) == sorted(band_ids)
+    assert all(band.definition_id and band.valid_fraction == 0.25
+               for band in product.bands)
+    units = dict((band.standard_name, band.units) for band in product.bands)
+    assert units == {bands[0].standard_name: 'percent',
+                     bands[1].standard_name: bands[1].units}
+    scene_id = product.scene_id
+
+    # Records of products and bands already indexed update them
+    band = product.bands[0]
+    records = [(old.tile_id,
+                product_record(product, cloud_fraction=0.1),
+                [band_record(id=band.id, standard_name=band.standard_name,
+                             path='updated', bidx=1)])]
+    assert db.index_records(scene, definitions, records) == (
+        product_ids, [band.id])
+    db.session.expire_all()
+    product = db.get_product(product_ids[0])
+    assert product.scene_id == scene_id
+    assert product.clear_fraction == 0.5 and product.cloud_fraction == 0.1
+    assert db.get_band(band.id).path == 'updated'
+    assert product.n_bands == 2
+
+
+def test_index_records_redefine(indexed_cube):
+    from tilezilla.db import (band_record, definition_record, product_record,
+                              scene_record)
+    db = indexed_cube.datacube.db
+    old = db.get_product(1)
+    band = old.bands[0]
+    old_definition_id = band.definition_id
+    scene = scene_record(indexed_cube.get_product(old.id))
+
+    # Overwriting a band with changed attributes redefines it
+    definition = definition_record(
+        indexed_cube.get_band(band.id))._replace(scale_factor=0.5)
+    records = [(old.tile_id, product_record(old),
+                [band_record(id=band.id, standard_name=band.standard_name,
+                             path=band.path, bidx=band.bidx)])]
+    db.index_records(scene, [definition], records)
+    db.session.expire_all()
+    band = db.get_band(band.id)
+    assert band.definition_id != old_definition_id
+    assert band.scale_factor == 0.5
+
+
+def test_upgrade_band_count(indexed_cube):
+    import sqlite3
+    from tilezilla.db._migrate import needs_upgrade, upgrade
+    if sqlite3.sqlite_version_info < (3, 35):
+        pytest.skip('SQLite cannot drop columns')
+    engine = indexed_cube.datacube.db.engine
+    with engine.begin() as conn:
+        conn.execute('DROP TABLE schema_version')
+        conn.execute('DROP INDEX ix_product_n_bands')
+        conn.execute('ALTER TABLE product DROP COLUMN n_bands')
+    assert needs_upgrade(engine) == ['band_count', 'indexes']
+    assert upgrade(engine) == ['band_count', 'indexes']
+    with engine.begin() as conn:
+        assert conn.execute('SELECT DISTINCT n_bands FROM product').fetchall() \
+            == [(3, )]
+
+
+# Upgrades
+def test_schema_version(indexed_cube):
+    from tilezilla.db._migrate import (SCHEMA_VERSION, needs_upgrade,
+                                       schema_version, upgrade)
+    engine = indexed_cube.datacube.db.engine
+    assert schema_version(engine) == SCHEMA_VERSION
+    assert needs_upgrade(engine) == []
+
+    # Composite indexes are created in databases without them
+    with engine.begin() as conn:
+        conn.execute('DELETE FROM schema_version')
+        conn.execute('DROP INDEX ix_band_product_standard_name')
+        conn.execute('CREATE INDEX ix_band_product_id ON band (product_id)')
+    assert schema_version(engine) == SCHEMA_VERSION - 1
+    assert upgrade(engine) == ['indexes']
+    indexes = [index['name'] for index in
+               sa.inspect(engine).get_indexes('band')]
+    assert 'ix_band_product_standard_name' in indexes
+    assert 'ix_band_product_id' not in indexes
+
+
+_OLD_LAYOUT = [
+    'CREATE TABLE tilespec (id INTEGER PRIMARY KEY, "desc" VARCHAR NOT NULL '
+    'UNIQUE, ul VARCHAR, crs VARCHAR, res VARCHAR, size VARCHAR)',
+    'CREATE TABLE tile (id INTEGER PRIMARY KEY, tilespec_id INTEGER, '
+    'storage VARCHAR, collection VARCHAR, horizontal INTEGER, '
+    'vertical INTEGER, bounds VARCHAR, CONSTRAINT _tilespec_tile_uc UNIQUE '
+    '(horizontal, vertical, tilespec_id, storage, collection))',
+    'CREATE TABLE product (created DATETIME, updated DATETIME, '
+    'id INTEGER PRIMARY KEY, tile_id INTEGER REFERENCES tile (id), '
+    'timeseries_id VARCHAR, platform VARCHAR, instrument VARCHAR, '
+    'acquired DATETIME, processed DATETIME, metadata_ TEXT, '
+    'metadata_files_ TEXT, CONSTRAINT _tile_store_collection_id_uc UNIQUE '
+    '(tile_id, timeseries_id))',
+    'CREATE INDEX ix_product_acquired ON product (acquired)',
+    'CREATE TABLE band (created DATETIME, updated DATETIME, '
+    'id INTEGER PRIMARY KEY, product_id INTEGER REFERENCES product (id), '
+    'path VARCHAR, bidx INTEGER, standard_name VARCHAR, long_name VARCHAR, '
+    'friendly_name VARCHAR, units VARCHAR, fill FLOAT, valid_min FLOAT, '
+    'valid_max FLOAT, scale_factor FLOAT)',
+    'CREATE INDEX ix_band_standard_name ON band (standard_name)',
+    "INSERT INTO tilespec VALUES (1, 'test', '0.0,1000.0', 'EPSG:5070', "
+    "'10.0,10.0', '50,50')",
+    "INSERT INTO tile VALUES (1, 1, 'GeoTIFF', 'ESPALandsat', 0, 0, "
+    "'0.0,500.0,500.0,1000.0')",
+    "INSERT INTO tile VALUES (2, 1, 'GeoTIFF', 'ESPALandsat', 1, 0, "
+    "'500.0,500.0,1000.0,1000.0')",
+]
+
+
+def _old_product(id_, tile_id, t, cloud):
+    return (
+        "INSERT INTO product VALUES ('2016-01-01 00:00:00.000000', "
+        "'2016-01-01 00:00:00.000000', {id}, {tile}, "
+        "'LT5012031200{t}300LGS01', 'LANDSAT_5', 'TM', "
+        "'200{t}-10-27 00:00:00.000000', '2016-01-01 00:00:00.000000', "
+        "'{{\"CLOUD_COVER\": \"{cloud}\", \"OTHER\": \"x\"}}', "
+        "'{{\"MTL\": \"h{tile}/mtl.txt\"}}')"
+        .format(id=id_, tile=tile_id, t=t, cloud=cloud))
+
+
+def _old_band(id_, product_id, name, fill):
+    return (
+        "INSERT INTO band VALUES ('2016-01-01 00:00:00.000000', "
+        "'2016-01-01 00:00:00.000000', {id}, {product}, '{name}_{id}.tif', "
+        "1, '{name}', '{name}', '{name}', 'reflectance', {fill}, -2000, "
+        "16000, NULL)".format(id=id_, product=product_id, name=name,
+                              fill=fill))
+
+
+def test_upgrade(tmpdir):
+    import sqlalchemy as sa
+    from tilezilla.db import Database
+    from tilezilla.db._migrate import (SCHEMA_VERSION, needs_upgrade,
+                                       schema_version, upgrade)
+
+    uri = 'sqlite:///' + str(tmpdir.join('old.db'))
+    engine = sa.create_engine(uri)
+    statements = _OLD_LAYOUT + [
+        _old_product(1, 1, 0, '5.5'), _old_product(2, 2, 0, '5.5'),
+        _old_product(3, 2, 1, '50.0')
+    ] + [
+        _old_band(id_, product_id, name, fill) for id_, (product_id, name,
+                                                         fill) in
+        enumerate([(p, name, fill) for p in (1, 2, 3) for name, fill in
+                   (('sr_band3', -9999), ('cfmask', 'NULL'))], 1)
+    ]
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(statement)
+    assert needs_upgrade(engine) == ['tile_columns', 'scenes', 'band_count',
+                                     'indexes']
+
+    db = Database.connect(uri)
+    assert upgrade(db.engine) == ['tile_columns', 'scenes', 'band_count',
+                                  'indexes']
+    assert upgrade(db.engine) == []
+    assert schema_version(db.engine) == SCHEMA_VERSION
+    db = Database.connect(uri)
+    assert db.rtree
+
+    tiles = db.get_tiles(1)
+    assert [(t.xmin, t.ymax) for t in tiles] == [(0, 1000), (500, 1000)]
+    assert all(t.key is not None for t in tiles)
+
+    assert db.session.query(TableScene).count() == 2
+    assert db.session.query(TableBandDefinition).count() == 2
+    product = db.get_product(2)
+    assert product.tile_id == 2
+    assert product.scene is db.get_product(1).scene
+    assert product.platform == 'LANDSAT_5'
+    assert product.metadata_['CLOUD_COVER'] == '5.5'
+    assert product.metadata_files_ == {'MTL': 'h2/mtl.txt'}
+    assert product.n_bands == 2
+    assert sorted((b.id, b.standard_name, b.fill)
+                  for b in product.bands) == [
+        (3, 'sr_band3', -9999), (4, 'cfmask', None)]
+
+    # Metadata indexed by the product type is indexed for searches
+    query = construct_filter(db.session.query(TableProduct),
+                             ['metadata.CLOUD_COVER < 10'])
+    assert sorted(p.id for p in query) == [1, 2]
+
+
+def test_ensure_tiles(indexed_cube):
+    from sqlalchemy.exc import IntegrityError
+    cube = indexed_cube.datacube
+    db = cube.db
+    tiles = [cube.tilespec[(v, h)] for h, v in
+             ((0, 0), (10, 5), (11, 5), (10, 6))]
+    existing = cube.get_tile_id('ESPALandsat', 0, 0)
+    ids = cube.ensure_tiles('ESPALandsat', tiles)
+    assert ids[0] == existing and len(set(ids)) == 4
+    assert cube.ensure_tiles('ESPALandsat', tiles) == ids
+    for id_, tile in zip(ids, tiles):
+        _tile = db.get_tile(id_)
+        assert (_tile.horizontal, _tile.vertical) == (tile.horizontal,
+                                                      tile.vertical)
+        assert _tile.key == tile.key
+        assert list(_tile.bounds) == list(tile.bounds)
+
+    # Only the tiles requested are selected, and errors are not hidden
+    assert cube.ensure_tiles('ESPALandsat', tiles[1:2] * 2) == ids[1:2] * 2
+    with pytest.raises(IntegrityError):
+        db.ensure_tiles(cube.tilespec_id, None, 'ESPALandsat',
+                        [cube.tilespec[(20, 20)]])
+
+
+def test_readonly(tmpdir):
+    from sqlalchemy.exc import OperationalError
+    from tilezilla.db import Database
+
+    path = str(tmpdir.join('tilezilla.db'))
+    db = Database.from_config({'drivername': 'sqlite', 'database': path})
+    db.ensure_tilespec('readonly', [0, 0], 'EPSG:5070', [1, 1], [1, 1])
+    db.session.remove()
+
+    db = Database.from_config({'drivername': 'sqlite', 'database': path},
+                              readonly=True)
+    assert db.readonly
+    spec = db.ensure_tilespec('readonly', [0, 0], 'EPSG:5070', [1, 1],
+                              [1, 1])
+    with pytest.raises(OperationalError):
+        db.ensure_tile(spec.id, 'GeoTIFF', 'ESPALandsat', 0, 0,
+                       [0, 0, 1, 1])
+
+
+# Concurrency
+def _ensure_tiles(args):
+    """ Ensure and read tiles from a new connection, as an ingest worker
+    """
+    from tilezilla.db import Database
+    path, worker = args
+    db = Database.from_config({'drivername': 'sqlite', 'database': path})
+    spec = db.get_tilespec_by_name('stress')
+    ids = {}
+    for i in range(20):
+        h, v = (worker + i) % 8, i % 4
+        tile = db.ensure_tile(spec.id, 'GeoTIFF', 'ESPALandsat', h, v,
+                              [h, v, h + 1, v + 1])
+        ids[(h, v)] = tile.id
+        assert len(db.get_tiles(spec.id)) >= len(ids)
+    db.session.remove()
+    return ids
+
+
+def test_concurrent_workers(tmpdir):
+    from concurrent.futures import ProcessPoolExecutor
+    from tilezilla.db import Database
+
+    path = str(tmpdir.join('tilezilla.db'))
+    db = Database.from_config({'drivername': 'sqlite', 'database': path})
+    assert db.engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    spec_id = db.ensure_tilespec('stress', [0, 0], 'EPSG:5070',
+                                 [1, 1], [1, 1]).id
+    db.session.remove()
+    db.engine.dispose()
+
+    with ProcessPoolExecutor(32) as executor:
+        results = list(executor.map(_ensure_tiles,
+                                    [(path, i) for i in range(32)]))
+    # Each tile is added once, and found by every worker
+    ids = {}
+    for result in results:
+        for index, id_ in result.items():
+            assert ids.setdefault(index, id_) == id_
+    assert len(ids) == 32
+    assert len(db.get_tiles(spec_id)) == 32
@@ -0,0 +1,83 @@
+""" Tests for `tilezilla.derived`
+"""
+from affine import Affine
+import numpy as np
+import pytest
+
+from tilezilla import derived
+from tilezilla.core import Band
+
+
+def _band(name, fill=-9999, valid_min=-2000, valid_max=16000):
+    return Band(None, standard_name=name, fill=fill,
+                valid_min=valid_min, valid_max=valid_max)
+
+
+def test_normalized_difference():
+    nir = np.ma.array([4000, 3000, 0, 100], mask=[0, 0, 0, 1])
+    red = np.ma.array([1000, 3000, 0, 100], mask=[0, 0, 0, 0])
+    nd = derived.normalized_difference(nir, red)
+    np.testing.assert_allclose(nd[:2], [0.6, 0.])
+    # Masked where inputs are masked or sum to zero
+    np.testing.assert_equal(np.ma.getmaskarray(nd), [0, 0, 1, 1])
+
+
+def test_cloud_mask():
+    cfmask = np.ma.array([0, 1, 2, 3, 4, 255], mask=[0, 0, 0, 0, 0, 1])
+    mask = derived.cloud_mask(cfmask)
+    np.testing.assert_equal(mask.filled(9), [0, 0, 1, 0, 1, 9])
+    np.testing.assert_equal(derived.cloud_mask(cfmask, values=[4]).data[:5],
+                            [0, 0, 0, 0, 1])
+
+
+def test_derived_band_compute():
+    band = derived.DerivedBand('ndvi', 'normalized_difference',
+                               ['sr_band4', 'sr_band3'])
+    assert band.dtype == np.int16
+    assert band.fill == -9999 and band.scale_factor == 0.0001
+    assert band.path is None
+
+    data = {'sr_band4': np.array([[4000, 3000], [-9999, 20000]], np.int16),
+            'sr_band3': np.array([[1000, 1000], [1000, 1000]], np.int16)}
+    bands = dict((name, _band(name)) for name in data)
+    transform = Affine(30., 0., 0., 0., -30., 60.)
+    result = band.compute(data, bands, transform, 'EPSG:5070')
+
+    assert result.dtype == np.int16
+    # Fill and values outside of the valid range become fill
+    np.testing.assert_equal(result, [[6000, 5000], [-9999, -9999]])
+    assert band.src.transform == transform
+    assert band.src.meta['dtype'] == 'int16'
+    assert band.src.meta['nodata'] == -9999
+
+
+def test_derived_band_overrides():
+    band = derived.DerivedBand('cloud', 'cloud_mask', ['cfmask'],
+                               kwargs={'values': [4]},
+                               long_name='Cloud mask', fill=99)
+    assert band.long_name == 'Cloud mask'
+    assert band.friendly_name == 'cloud'
+    assert band.dtype == np.uint8
+
+    data = {'cfmask': np.array([[0, 2], [4, 255]], np.uint8)}
+    bands = {'cfmask': _band('cfmask', fill=255, valid_min=0, valid_max=4)}
+    result = band.compute(data, bands, Affine.identity(), 'EPSG:5070')
+    np.testing.assert_equal(result, [[0, 0], [1, 99]])
+
+
+def test_derived_band_bad():
+    with pytest.raises(KeyError):
+        derived.DerivedBand('ndvi', 'ndvi', ['sr_band4', 'sr_band3'])
+    with pytest.raises(ValueError):
+        derived.DerivedBand('ndvi', 'normalized_difference', [])
+
+
+def test_derived_bands():
+    bands = derived.derived_bands({'derived': {
+        'nbr': {'function': 'normalized_difference',
+                'bands': ['sr_band4', 'sr_band7']},
+        'cloud': {'function': 'cloud_mask', 'bands': ['cfmask']}
+    }})
+    assert [b.standard_name for b in bands] == ['cloud', 'nbr']
+    assert bands[1].bands == ['sr_band4', 'sr_band7']
+    assert derived.derived_bands({}) == []
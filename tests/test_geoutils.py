@@ -0,0 +1,143 @@
+""" Tests for `tilezilla.geoutils`
+"""
+import affine
+import numpy as np
+import pytest
+import rasterio
+
+from tilezilla import geoutils, tilespec
+
+
+@pytest.fixture
+def spec():
+    return tilespec.TileSpec((0., 1000.), 'EPSG:5070', (10., 10.), (50, 50))
+
+
+@pytest.fixture
+def make_raster(tmpdir):
+    def _make_raster(ul, res=10., crs='EPSG:5070', shape=(60, 70)):
+        path = str(tmpdir.join('{}_{}_{}.tif'.format(ul[0], ul[1], res)))
+        data = np.arange(shape[0] * shape[1],
+                         dtype=np.int16).reshape(shape)
+        with rasterio.open(path, 'w', driver='GTiff', dtype='int16',
+                           count=1, width=shape[1], height=shape[0],
+                           crs=crs, nodata=-9999,
+                           transform=affine.Affine(res, 0, ul[0],
+                                                   0, -res, ul[1])) as dst:
+            dst.write(data, 1)
+        return path, data
+    return _make_raster
+
+
+@pytest.mark.parametrize(('transform', 'offset'), [
+    (affine.Affine(10., 0, 100., 0, -10., 900.), (0., 0.)),
+    (affine.Affine(10., 0, 103., 0, -10., 896.), (0.3, 0.4)),
+    (affine.Affine(10., 0, 108., 0, -10., 900.), (-0.2, 0.)),
+    (affine.Affine(30., 0, 100., 0, -30., 900.), None),
+])
+def test_grid_offset(spec, transform, offset):
+    result = geoutils.grid_offset(transform, spec)
+    if offset is None:
+        assert result is None
+    else:
+        np.testing.assert_allclose(result, offset, atol=1e-9)
+    assert geoutils.is_aligned(transform, spec) == (offset == (0., 0.))
+
+
+def test_read_window():
+    data = np.arange(20).reshape(4, 5)
+    view = geoutils.read_window(data, ((1, 3), (2, 5)))
+    assert np.shares_memory(view, data)
+    np.testing.assert_equal(view, data[1:3, 2:5])
+
+    padded = geoutils.read_window(data, ((-1, 2), (3, 7)), fill=-1)
+    np.testing.assert_equal(padded, [[-1, -1, -1, -1],
+                                     [3, 4, -1, -1],
+                                     [8, 9, -1, -1]])
+
+
+def test_reproject_as_needed_aligned(spec, make_raster):
+    path, data = make_raster((100., 900.))
+    with rasterio.open(path) as src:
+        with geoutils.reproject_as_needed(src, spec) as dst:
+            assert dst is src
+
+
+def test_reproject_as_needed_snap(spec, make_raster):
+    # Within half a pixel of the grid: shift the pixels onto it
+    path, data = make_raster((103., 896.))
+    with rasterio.open(path) as src:
+        with geoutils.reproject_as_needed(src, spec) as dst:
+            assert dst is not src
+            assert geoutils.is_aligned(dst.transform, spec)
+            assert dst.transform.c == 100. and dst.transform.f == 900.
+            np.testing.assert_equal(dst.read(1), data)
+
+
+@pytest.mark.parametrize('ul', [(105., 895.), (125., 875.), (95., 905.)])
+def test_snap_transform_half_pixel(spec, ul):
+    # Exactly half a pixel off the grid: snap by the offset found
+    transform = affine.Affine(10., 0, ul[0], 0, -10., ul[1])
+    dx, dy = geoutils.grid_offset(transform, spec)
+    snapped = geoutils.snap_transform(transform, spec.ul)
+    assert snapped.c == ul[0] - dx * 10.
+    assert snapped.f == ul[1] + dy * 10.
+    assert geoutils.is_aligned(snapped, spec)
+
+
+def test_reproject_as_needed_warp(spec, make_raster):
+    path, data = make_raster((103., 896.))
+    with rasterio.open(path) as src:
+        with geoutils.reproject_as_needed(src, spec, 'bilinear') as dst:
+            assert geoutils.is_aligned(dst.transform, spec)
+
+
+# Aggregation
+@pytest.mark.parametrize(('transform', 'factor'), [
+    (affine.Affine(10., 0, 0., 0, -10., 0.), (1, 1)),
+    (affine.Affine(2.5, 0, 0., 0, -5., 0.), (2, 4)),
+    (affine.Affine(3., 0, 0., 0, -3., 0.), None),
+    (affine.Affine(20., 0, 0., 0, -20., 0.), None),
+])
+def test_aggregation_factor(spec, transform, factor):
+    assert geoutils.aggregation_factor(transform, spec) == factor
+
+
+def test_aggregate_mean():
+    data = np.array([[1, 2, 3, 4],
+                     [5, 6, -1, -1],
+                     [-1, -1, -1, 9]], dtype=np.int16)
+    out = geoutils.aggregate(data, (2, 2), 'mean', fill=-1)
+    assert out.dtype == np.int16
+    np.testing.assert_equal(out, [[4, 4], [-1, 9]])
+
+    # Offset blocks: first block starts one row and column before data
+    out = geoutils.aggregate(data, (2, 2), 'mean', fill=-1, offset=(1, 1))
+    np.testing.assert_equal(out, [[1, 2, 4], [5, 6, 9]])
+
+
+def test_aggregate_mode():
+    data = np.array([[0, 0, 4, 255],
+                     [0, 2, 2, 255],
+                     [255, 255, 1, 1]], dtype=np.uint8)
+    out = geoutils.aggregate(data, (2, 2), 'mode', fill=255)
+    # Ties prefer the least value
+    np.testing.assert_equal(out, [[0, 2], [255, 1]])
+    # Leading dimensions (e.g., bands) are aggregated separately
+    out = geoutils.aggregate(np.stack([data, data]), (3, 4), 'mode', fill=255)
+    np.testing.assert_equal(out, [[[0]], [[0]]])
+
+
+def test_reproject_as_needed_aggregate(make_raster):
+    spec = tilespec.TileSpec((0., 1000.), 'EPSG:5070', (40., 40.), (50, 50))
+    # Source starts one source pixel right of and below a 40m pixel edge
+    path, data = make_raster((110., 890.), shape=(8, 8))
+    with rasterio.open(path) as src:
+        with geoutils.reproject_as_needed(src, spec, 'average') as dst:
+            assert dst.transform.c == 80. and dst.transform.f == 920.
+            assert geoutils.is_aligned(dst.transform, spec)
+            out = dst.read(1)
+    assert out.shape == (3, 3)
+    np.testing.assert_equal(out, geoutils.aggregate(data, (4, 4),
+                                                    offset=(3, 3)))
+    assert out[0, 0] == data[0, 0]
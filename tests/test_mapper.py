@@ -0,0 +1,94 @@
+""" Tests for `tilezilla.mapper`
+"""
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from tilezilla import api, mapper
+
+
+def band_diff(data, times, scale=1):
+    """ Mean difference of the first two bands through time
+    """
+    return scale * (data[:, 1] - data[:, 0]).mean(axis=0)
+
+
+def first_last(data, times):
+    return np.stack([data[0, 0], data[-1, 0]])
+
+
+def total(data, times):
+    return data.sum()
+
+
+def fail_after(data, times, calls=None, n=1):
+    """ First band of the first observation, failing after ``n`` blocks
+    """
+    calls.append(None)
+    if len(calls) > n:
+        raise RuntimeError('Failed on block {}'.format(len(calls)))
+    return data[0, 0]
+
+
+@pytest.mark.parametrize(('executor', 'njob'), [
+    ('serial', 1),
+    ('process', 2),
+])
+def test_map_cube(tmpdir, indexed_cube, executor, njob):
+    root = str(tmpdir.join('derived'))
+    results = mapper.map_cube(band_diff, indexed_cube,
+                              ['sr_band3', 'sr_band4'], 'diff', root,
+                              executor=executor, njob=njob, scale=2,
+                              dtype='int16', out_bands=['diff'])
+    assert sorted(results) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    # Results are indexed as a product of a new collection
+    datacube = indexed_cube.datacube
+    tile_id = datacube.get_tile_id('diff', 1, 0)
+    products = indexed_cube.get_products_by_tile(tile_id)
+    assert [p.timeseries_id for p in products] == ['diff']
+    assert products[0].description == 'Derived'
+    assert products[0].metadata['function'] == 'band_diff'
+    band = products[0].bands[0]
+    assert band.standard_name == 'diff'
+    assert band.valid_min == band.valid_max == 2000
+    with rasterio.open(band.path) as src:
+        assert src.dtypes[0] == 'int16'
+        assert src.transform == datacube.tilespec[(0, 1)].transform
+        assert np.all(src.read(1) == 2000)
+
+
+def test_map_cube_read_results(tmpdir, indexed_cube, cube_value):
+    tiles = [indexed_cube.datacube.tilespec[(0, 0)]]
+    mapper.map_cube(first_last, indexed_cube, ['cfmask'], 'first_last',
+                    str(tmpdir), tiles=tiles)
+
+    reader = api.TimeSeriesReader(indexed_cube)
+    arrays = reader.read(tiles[0].bounds,
+                         ['first_last_1', 'first_last_2'],
+                         collection='first_last')
+    rows, cols = np.mgrid[0:50, 0:50]
+    np.testing.assert_equal(arrays['first_last_1'][0],
+                            cube_value(0, 'cfmask', rows, cols))
+    np.testing.assert_equal(arrays['first_last_2'][0],
+                            cube_value(2, 'cfmask', rows, cols))
+
+
+def test_map_cube_bad_shape(tmpdir, indexed_cube):
+    tiles = [indexed_cube.datacube.tilespec[(0, 0)]]
+    with pytest.raises(ValueError):
+        mapper.map_cube(total, indexed_cube, ['cfmask'], 'total',
+                        str(tmpdir), tiles=tiles)
+
+
+def test_map_cube_failure_cleanup(tmpdir, indexed_cube):
+    tiles = [indexed_cube.datacube.tilespec[(0, 0)]]
+    root = str(tmpdir.join('derived'))
+    with pytest.raises(RuntimeError):
+        mapper.map_cube(fail_after, indexed_cube, ['cfmask'], 'fail', root,
+                        tiles=tiles, block_shape=(16, 16), calls=[])
+    # Partially written results are removed
+    assert not [f for _, _, files in os.walk(root) for f in files]
+    assert not indexed_cube.datacube.get_tile_id('fail', 0, 0)
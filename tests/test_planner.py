@@ -0,0 +1,135 @@
+""" Tests for `tilezilla.planner`
+"""
+import numpy as np
+import pytest
+import rasterio
+
+from tilezilla import planner
+
+
+@pytest.fixture
+def tiled_image(tmpdir):
+    """ A 100x80 tiled GeoTIFF with 16x16 blocks and 2 bands
+    """
+    path = str(tmpdir.join('tiled.tif'))
+    data = np.arange(2 * 100 * 80, dtype=np.int16).reshape(2, 100, 80)
+    with rasterio.open(path, 'w', driver='GTiff', dtype='int16', count=2,
+                       width=80, height=100, tiled=True,
+                       blockxsize=16, blockysize=16) as dst:
+        dst.write(data)
+    return path, data
+
+
+# merge_blocks ----------------------------------------------------------------
+@pytest.mark.parametrize(('blocks', 'answer'), [
+    ([(0, 0)], [((0, 1), (0, 1))]),
+    ([(0, 0), (0, 1), (1, 0), (1, 1)], [((0, 2), (0, 2))]),
+    ([(0, 0), (0, 2)], [((0, 1), (0, 1)), ((0, 1), (2, 3))]),
+    ([(0, 0), (0, 1), (1, 0)], [((0, 1), (0, 2)), ((1, 2), (0, 1))]),
+    ([(0, 0), (2, 0)], [((0, 1), (0, 1)), ((2, 3), (0, 1))]),
+    ([], []),
+])
+def test_merge_blocks(blocks, answer):
+    assert planner.merge_blocks(blocks) == answer
+
+
+# ReadPlan --------------------------------------------------------------------
+def test_plan_block_aligned(tiled_image):
+    path, data = tiled_image
+    plan = planner.ReadPlan((16, 16), (100, 80), np.int16)
+    plan.add(path, 1, (10, 20), (5, 40), key='a')
+
+    assert len(plan.reads) == 1
+    read = plan.reads[0]
+    assert read.rows == (0, 32) and read.cols == (0, 48)
+    assert plan.planned_bytes == 32 * 48 * 2
+    assert plan.naive_bytes == 100 * 80 * 2
+    assert plan.bytes_saved == plan.naive_bytes - plan.planned_bytes
+
+
+def test_plan_merge_adjacent(tiled_image):
+    path, data = tiled_image
+    plan = planner.ReadPlan((16, 16), (100, 80), np.int16)
+    # Two requests in adjacent blocks and one sharing a block
+    plan.add(path, 1, (0, 5), (0, 5), key='a')
+    plan.add(path, 1, (3, 9), (20, 30), key='b')
+    plan.add(path, 1, (1, 2), (1, 2), key='c')
+    # Different band of same file is read separately
+    plan.add(path, 2, (96, 100), (70, 80), key='d')
+
+    assert len(plan.reads) == 2
+    assert plan.reads[0].rows == (0, 16) and plan.reads[0].cols == (0, 32)
+    assert plan.reads[1].rows == (96, 100) and plan.reads[1].cols == (64, 80)
+    assert plan.summary()['n_files'] == 1
+
+
+def test_plan_requests_of_reads():
+    # Many small, scattered requests, as for points
+    rng = np.random.RandomState(42)
+    plan = planner.ReadPlan((16, 16), (100, 80), np.int16)
+    for key in range(200):
+        r, c = rng.randint(0, 95), rng.randint(0, 75)
+        plan.add('a.tif', 1, (r, r + rng.randint(1, 6)),
+                 (c, c + rng.randint(1, 6)), key=key)
+
+    for read in plan.reads:
+        overlapping = [
+            req for req in plan.requests
+            if (req.rows[0] < read.rows[1] and req.rows[1] > read.rows[0] and
+                req.cols[0] < read.cols[1] and req.cols[1] > read.cols[0])
+        ]
+        assert read.requests == overlapping
+    assert (sum(len(read.requests) for read in plan.reads) >=
+            len(plan.requests))
+
+
+@pytest.mark.parametrize('njob', [1, 3])
+def test_plan_execute(tiled_image, njob):
+    path, data = tiled_image
+    plan = planner.ReadPlan((16, 16), (100, 80), np.int16)
+    windows = {
+        'a': (1, (0, 5), (0, 5)),
+        'b': (1, (3, 40), (20, 30)),
+        'c': (2, (50, 100), (0, 80)),
+        'd': (2, (17, 18), (79, 80)),
+    }
+    for key, (bidx, rows, cols) in windows.items():
+        plan.add(path, bidx, rows, cols, key=key)
+
+    results = dict(plan.execute(njob))
+    assert set(results) == set(windows)
+    for key, (bidx, rows, cols) in windows.items():
+        np.testing.assert_equal(
+            results[key],
+            data[bidx - 1, rows[0]:rows[1], cols[0]:cols[1]])
+
+
+def test_plan_execute_datasets(tiled_image):
+    path, data = tiled_image
+    plan = planner.ReadPlan((16, 16), (100, 80), np.int16)
+    plan.add(path, 1, (0, 5), (0, 5), key='a')
+
+    with planner.DatasetCache() as datasets:
+        for _ in range(2):
+            results = dict(plan.execute(3, datasets=datasets))
+            np.testing.assert_equal(results['a'], data[0, :5, :5])
+        # File is kept open between executions
+        src = datasets.open(path)
+        assert len(datasets) == 1 and not src.closed
+    assert src.closed and len(datasets) == 0
+
+
+def test_dataset_cache_max_open(tiled_image, tmpdir):
+    path, _ = tiled_image
+    other = str(tmpdir.join('other.tif'))
+    with rasterio.open(path) as src, \
+            rasterio.open(other, 'w', **src.profile) as dst:
+        dst.write(src.read())
+
+    datasets = planner.DatasetCache(max_open=1)
+    src = datasets.open(path)
+    assert datasets.open(path) is src
+    # Least recently used dataset is closed when too many are open
+    datasets.open(other)
+    assert src.closed and len(datasets) == 1
+    datasets.close()
@@ -0,0 +1,39 @@
+""" Tests for `tilezilla.stats`
+"""
+import numpy as np
+import pytest
+
+from tilezilla import stats
+from tilezilla.core import Band
+
+
+def test_band_statistics():
+    band = Band(None, standard_name='sr_band3', fill=-9999,
+                valid_min=-2000, valid_max=16000)
+    data = np.array([[-9999, 100], [300, 20000]], dtype=np.int16)
+    result = stats.band_statistics(band, data)
+    assert result == {'valid_fraction': 0.5, 'data_min': 100,
+                      'data_max': 300, 'data_mean': 200.}
+    assert set(result) == set(stats.BAND_STATISTICS)
+
+
+def test_band_statistics_all_fill():
+    band = Band(None, standard_name='sr_band3', fill=-9999)
+    result = stats.band_statistics(band, np.full((2, 2), -9999, np.int16))
+    assert result['valid_fraction'] == 0
+    assert result['data_min'] is None and result['data_mean'] is None
+
+
+def test_band_statistics_cfmask():
+    band = Band(None, standard_name='cfmask', fill=255,
+                valid_min=0, valid_max=4)
+    data = np.array([0, 0, 1, 2, 3, 4, 4, 255], dtype=np.uint8)
+    result = stats.band_statistics(band, data)
+    assert set(result) == (set(stats.BAND_STATISTICS) |
+                           set(stats.PRODUCT_STATISTICS))
+    assert result['clear_fraction'] == pytest.approx(3 / 8.)
+    assert result['water_fraction'] == pytest.approx(1 / 8.)
+    assert result['shadow_fraction'] == pytest.approx(1 / 8.)
+    assert result['snow_fraction'] == pytest.approx(1 / 8.)
+    assert result['cloud_fraction'] == pytest.approx(2 / 8.)
+    assert result['valid_fraction'] == pytest.approx(7 / 8.)
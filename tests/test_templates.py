@@ -0,0 +1,87 @@
+""" Tests for `tilezilla.templates`
+"""
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from tilezilla import config, templates, tilespec
+from tilezilla.errors import ConfigException
+
+
+@pytest.fixture
+def spec():
+    return tilespec.TileSpec((0., 100.), 'EPSG:5070', (1., 1.), (10, 10))
+
+
+@pytest.mark.parametrize(('pattern', 'names'), [
+    ('h{horizontal:04d}v{vertical:04d}', ('horizontal', 'vertical')),
+    ('{tilespec.desc}/{index[0]}_{index[1]}', ('tilespec', 'index')),
+    ('tiles', ()),
+])
+def test_tile_template_names(pattern, names):
+    assert templates.TileTemplate(pattern).names == names
+
+
+@pytest.mark.parametrize('pattern', [
+    'h{horizontal}v{vert}',
+    'h{}',
+    'h{horizontal',
+    '{product.timeseries_id}',
+    None,
+])
+def test_tile_template_invalid(pattern):
+    with pytest.raises(ValueError):
+        templates.TileTemplate(pattern)
+
+
+def test_tile_template_render(spec):
+    template = templates.TileTemplate('h{horizontal:04d}v{vertical:04d}')
+    tiles = [spec[(2, 10)], spec[(3, 1)]]
+    assert template.render(tiles[0]) == 'h0010v0002'
+    assert template.render_many(tiles) == ['h0010v0002', 'h0001v0003']
+    assert template.render_many(tiles) == [t.str_format(template.pattern)
+                                           for t in tiles]
+    assert (template.render_index(np.array([10, 1]), np.array([2, 3])) ==
+            template.render_many(tiles))
+
+
+def test_tile_template_render_index_attributes():
+    template = templates.TileTemplate('{tilespec.desc}_{horizontal}')
+    with pytest.raises(ValueError):
+        template.render_index([0], [0])
+
+
+def test_template_compile():
+    pattern = 'h{horizontal}v{vertical}'
+    template = templates.TileTemplate.compile(pattern)
+    assert templates.TileTemplate.compile(pattern) is template
+    assert templates.TileTemplate.compile(template) is template
+    assert template == templates.TileTemplate(pattern)
+    # Templates of different kinds are compiled separately
+    with pytest.raises(ValueError):
+        templates.ProductTemplate.compile(pattern)
+
+
+def test_product_template_render():
+    Product = namedtuple('Product', ('timeseries_id', ))
+    Band = namedtuple('Band', ('standard_name', ))
+    template = templates.ProductTemplate.compile(
+        '{product.timeseries_id}_{band.standard_name}.tif')
+    assert (template.render(Product('LT5'), Band('sr_band1')) ==
+            'LT5_sr_band1.tif')
+
+
+def test_parse_store(spec):
+    cfg = {'tilespec': spec,
+           'store': {'tile_dirpattern': 'h{horizontal:02d}v{vertical:02d}'}}
+    cfg = config._parse_store(cfg)
+    assert isinstance(cfg['store']['tile_dirpattern'],
+                      templates.TileTemplate)
+    assert isinstance(cfg['store']['tile_imgpattern'],
+                      templates.ProductTemplate)
+
+    # Errors formatting a tile are found when parsing
+    cfg['store']['tile_dirpattern'] = 'h{horizontal:s}'
+    with pytest.raises(ConfigException):
+        config._parse_store(cfg)
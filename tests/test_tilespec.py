@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from tilezilla import tilespec
@@ -39,3 +40,240 @@ def test_tilespec_fail_1(example_spec):
 def test_tilespec_fail_2(example_spec):
     with pytest.raises(TypeError):
         example_spec[([0, 1], [0, 1])]
+
+
+# Point to tile
+def test_point_to_tile_index(example_spec):
+    x = example_spec.ul[0] + np.array([1, 150001, -1])
+    y = example_spec.ul[1] - np.array([1, 300001, 1])
+    rows, cols = example_spec.point_to_tile_index(x, y)
+    np.testing.assert_equal(rows, [0, 2, 0])
+    np.testing.assert_equal(cols, [0, 1, -1])
+
+    for i in range(len(x)):
+        tile = example_spec.point_to_tile((x[i], y[i]))
+        assert tile.index == (rows[i], cols[i])
+
+
+# Vectorized tile indexes and bounds
+def test_index_to_bounds(example_spec):
+    rows, cols = np.array([0, 3, -1]), np.array([0, 2, 5])
+    bounds = example_spec.index_to_bounds(rows, cols)
+    assert bounds.shape == (3, 4)
+    for i in range(len(rows)):
+        tile = example_spec[(int(rows[i]), int(cols[i]))]
+        np.testing.assert_allclose(bounds[i], tile.bounds)
+    np.testing.assert_allclose(example_spec.index_to_bounds(3, 2), bounds[1])
+
+
+def test_bounds_to_tile_index(example_spec):
+    px = example_spec.size[0] * example_spec.res[0]
+    py = example_spec.size[1] * example_spec.res[1]
+    ulx, uly = example_spec.ul
+    bounds = np.array([
+        # Within one tile
+        [ulx + 1, uly - 2, ulx + 2, uly - 1],
+        # Spanning 2x3 tiles
+        [ulx + px / 2, uly - 1.5 * py, ulx + 2.5 * px, uly - py / 2],
+        # Exactly one tile, touching neighbors to the right and below
+        [ulx + px, uly - 2 * py, ulx + 2 * px, uly - py],
+    ])
+    rows, cols, which = example_spec.bounds_to_tile_index(bounds)
+    np.testing.assert_equal(np.bincount(which), [1, 6, 4])
+    assert (rows[0], cols[0]) == (0, 0)
+    assert set(zip(rows[which == 1], cols[which == 1])) == set(
+        (r, c) for r in (0, 1) for c in (0, 1, 2))
+
+    # Same as tiles found one bounds at a time
+    for i, b in enumerate(bounds):
+        tiles = [tile.index for tile in example_spec.bounds_to_tiles(b)]
+        assert tiles == list(zip(rows[which == i], cols[which == i]))
+
+
+def test_point_to_tile_index_many(example_spec):
+    n = 1000000
+    rng = np.random.RandomState(42)
+    px = example_spec.size[0] * example_spec.res[0]
+    x = example_spec.ul[0] + rng.uniform(0, 100 * px, n)
+    y = example_spec.ul[1] - rng.uniform(0, 100 * px, n)
+    rows, cols = example_spec.point_to_tile_index(x, y)
+    assert rows.shape == cols.shape == (n, )
+    bounds = example_spec.index_to_bounds(rows, cols)
+    assert np.all((bounds[:, 0] <= x) & (x < bounds[:, 2]) &
+                  (bounds[:, 1] < y) & (y <= bounds[:, 3]))
+
+
+# ROI to tiles
+@pytest.fixture
+def grid_spec():
+    return tilespec.TileSpec((0., 100.), 'EPSG:5070', (1., 1.), (10, 10),
+                             desc='grid')
+
+
+def test_roi_to_tile_index_diagonal(grid_spec):
+    import shapely.geometry
+    # Thin diagonal from upper left to lower right of 5x5 tiles
+    roi = shapely.geometry.LineString([(1, 97), (49, 51)]).buffer(0.5)
+    bbox_tiles = [t.index for t in grid_spec.bounds_to_tiles(
+        tilespec.BoundingBox(*roi.bounds))]
+    rows, cols = grid_spec.roi_to_tile_index(roi)
+    assert len(bbox_tiles) == 25
+    assert list(zip(rows, cols)) == [
+        index for index in bbox_tiles
+        if roi.intersects(grid_spec[index].polygon)]
+    assert len(rows) < len(bbox_tiles) / 2
+    assert [t.index for t in grid_spec.roi_to_tiles(roi)] == \
+        list(zip(rows, cols))
+
+
+def test_roi_to_tile_index_multipolygon(grid_spec):
+    import shapely.geometry
+    roi = shapely.geometry.MultiPolygon([
+        shapely.geometry.box(2, 92, 8, 98),
+        shapely.geometry.box(42, 52, 48, 58)
+    ])
+    rows, cols, windows = grid_spec.roi_to_tile_index(roi, windows=True)
+    assert list(zip(rows, cols)) == [(0, 0), (4, 4)]
+    assert windows == [((2, 8), (2, 8)), ((2, 8), (2, 8))]
+
+
+def test_roi_to_tile_index_windows(grid_spec):
+    import shapely.geometry
+    # Touches tile (1, 1) at its upper left corner
+    roi = shapely.geometry.Polygon([(5, 95), (15, 95), (5, 85)])
+    rows, cols, windows = grid_spec.roi_to_tile_index(roi, windows=True)
+    assert list(zip(rows, cols)) == [(0, 0), (0, 1), (1, 0)]
+    assert windows == [((5, 10), (5, 10)), ((5, 10), (0, 5)),
+                       ((0, 5), (5, 10))]
+
+
+def test_roi_to_tile_index_edges(grid_spec):
+    import shapely.geometry
+    # Points and lines along tile edges select the tiles they touch
+    point = shapely.geometry.Point(10, 95)
+    rows, cols = grid_spec.roi_to_tile_index(point)
+    assert list(zip(rows, cols)) == [(0, 0), (0, 1)]
+    line = shapely.geometry.LineString([(10, 98), (10, 92)])
+    rows, cols = grid_spec.roi_to_tile_index(line)
+    assert list(zip(rows, cols)) == [(0, 0), (0, 1)]
+    # Polygons sharing an edge with a tile do not select it
+    box = shapely.geometry.box(2, 92, 10, 98)
+    rows, cols = grid_spec.roi_to_tile_index(box)
+    assert list(zip(rows, cols)) == [(0, 0)]
+
+
+def test_rois_to_tile_index_many(grid_spec):
+    import shapely.geometry
+    rng = np.random.RandomState(0)
+    rois = [shapely.geometry.Point(x, y).buffer(r)
+            for x, y, r in zip(rng.uniform(0, 200, 5000),
+                               rng.uniform(-100, 100, 5000),
+                               rng.uniform(0.5, 15, 5000))]
+    rows, cols, which = grid_spec.rois_to_tile_index(rois)
+    # Same as testing each tile within the bounds of each ROI
+    expected = []
+    for i in range(0, 5000, 250):
+        for index in [t.index for t in grid_spec.bounds_to_tiles(
+                tilespec.BoundingBox(*rois[i].bounds))]:
+            box = grid_spec[index].polygon
+            if rois[i].intersects(box) and not rois[i].touches(box):
+                expected.append((i, ) + index)
+    found = set(zip(which, rows, cols))
+    assert set(expected) <= found
+    assert set(f for f in found if f[0] % 250 == 0) == set(expected)
+    assert list(which) == sorted(which)
+
+
+def test_rois_to_tile_index_geojson():
+    import json
+    import os
+    from rasterio.warp import transform_geom
+    import shapely.geometry
+
+    spec = tilespec.TILESPECS['WELD_CONUS']
+    path = os.path.join(os.path.dirname(__file__), 'data',
+                        'test_rois.geojson')
+    with open(path) as f:
+        features = json.load(f)['features']
+    rois = [shapely.geometry.shape(
+                transform_geom('EPSG:4326', spec.crs, feat['geometry']))
+            for feat in features]
+
+    rows, cols, which = spec.rois_to_tile_index(rois)
+    assert set(which) == set(range(len(rois)))
+    for r, c, i in zip(rows, cols, which):
+        assert rois[i].intersects(spec[(int(r), int(c))].polygon)
+        assert (r, c) in [t.index for t in
+                          spec.bounds_to_tiles(
+                              tilespec.BoundingBox(*rois[i].bounds))]
+
+
+# Tiles and the tile cache
+def test_tile_cached_attributes(grid_spec):
+    tile = grid_spec[(1, 2)]
+    assert not hasattr(tile, '__dict__')
+    assert tile.transform is tile.transform
+    assert tile.polygon is tile.polygon
+    assert tile.polygon.bounds == tuple(tile.bounds)
+    assert tile.str_format('h{horizontal}v{vertical}') == 'h2v1'
+
+
+@pytest.mark.parametrize(('cache_size', 'n_cached'), [
+    (None, 10),
+    (0, 0),
+    (3, 3),
+])
+def test_tile_cache(cache_size, n_cached):
+    spec = tilespec.TileSpec((0., 100.), 'EPSG:5070', (1., 1.), (10, 10),
+                             cache_size=cache_size)
+    tiles = [spec[(0, i)] for i in range(10)]
+    assert len(spec._tiles) == n_cached
+
+    # Recreated tiles are equal to the originals
+    assert [spec[(0, i)] for i in range(10)] == tiles
+    assert len(set(tiles + [spec[(0, 0)]])) == 10
+
+
+def test_tile_cache_lru():
+    spec = tilespec.TileSpec((0., 100.), 'EPSG:5070', (1., 1.), (10, 10),
+                             cache_size=2)
+    a, b = spec[(0, 0)], spec[(0, 1)]
+    assert spec[(0, 0)] is a  # (0, 1) is now least recently used
+    spec[(0, 2)]
+    assert list(spec._tiles) == [(0, 0), (0, 2)]
+    assert spec[(0, 1)] is not b
+
+
+# Space-filling curve keys
+@pytest.mark.parametrize('order', ['morton', 'hilbert'])
+def test_tile_keys_unique(grid_spec, order):
+    rows, cols = np.mgrid[-8:8, -8:8]
+    keys = grid_spec.tile_keys(rows.ravel(), cols.ravel(), order=order)
+    assert len(np.unique(keys)) == rows.size
+    # Scalar indexes give scalar keys
+    assert grid_spec.tile_keys(2, 3, order=order) == keys[(2 + 8) * 16 + 11]
+
+
+def test_tile_keys_hilbert_locality():
+    # Consecutive tiles along a Hilbert curve are neighbors
+    rows, cols = [x.ravel() for x in np.mgrid[-8:8, -8:8]]
+    keys = tilespec.hilbert_key(cols, rows, bits=4)
+    idx = np.argsort(keys)
+    assert np.all(keys[idx] == np.arange(256))
+    steps = np.abs(np.diff(rows[idx])) + np.abs(np.diff(cols[idx]))
+    assert np.all(steps == 1)
+
+
+def test_tile_keys_errors(grid_spec):
+    with pytest.raises(KeyError):
+        grid_spec.tile_keys(0, 0, order='peano')
+    with pytest.raises(ValueError):
+        tilespec.morton_key(2 ** 15, 0)
+
+
+def test_bounds_to_tiles_order(grid_spec):
+    bounds = tilespec.BoundingBox(0.5, 60.5, 39.5, 99.5)
+    tiles = list(grid_spec.bounds_to_tiles(bounds))
+    ordered = list(grid_spec.bounds_to_tiles(bounds, order='hilbert'))
+    assert set(tiles) == set(ordered)
+    assert [t.key for t in ordered] == sorted(t.key for t in tiles)
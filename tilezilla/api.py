@@ -0,0 +1,480 @@
+""" Read-oriented access to tiled and indexed datasets
+
+The :class:`TimeSeriesReader` searches the index (through
+:class:`tilezilla.db.DatasetResource`) for products within an extent and
+time range and returns a :class:`TimeSeriesArray` for each band requested.
+No pixels are read until a :class:`TimeSeriesArray` is indexed, and only the
+observations and pixels selected are read.
+
+Example:
+
+    .. code-block:: python
+
+        spec, storage, db, cube, dataset = config_to_resources(config)
+        reader = TimeSeriesReader(dataset, njob=4)
+        arrays = reader.read(bounds, ['sr_band3', 'sr_band4'],
+                             start='2000-01-01', end='2010-12-31')
+        # Data are read only when indexed
+        red = arrays['sr_band3'][:, 100:200, 100:200]
+
+"""
+from collections import OrderedDict
+import logging
+
+import affine
+import arrow
+import numpy as np
+import rasterio
+
+from ._util import lazy_property
+from .core import BoundingBox
+from .geoutils import bounds_to_window
+from .planner import ReadPlan
+
+logger = logging.getLogger('tilezilla')
+
+
+class TimeSeriesArray(object):
+    """ A lazily read (time, y, x) array of one band through time
+
+    The array may span more than one tile. Each observation is assembled from
+    the windows of each tile that overlap the array, so only the pixels
+    selected are read and no intermediate mosaic is created. Pixels not
+    covered by any tile indexed for an observation are filled with ``fill``.
+
+    Indexing this array with integers, slices, or (along the time dimension)
+    sequences of integers reads the pixels selected from each observation
+    selected. Reads are planned by :class:`tilezilla.planner.ReadPlan` and
+    executed using up to ``njob`` concurrent reads. Use :meth:`plan` to
+    inspect the reads needed for a selection.
+
+    Args:
+        name (str): Name of the band
+        times (list[Arrow]): Acquisition date and time of each observation
+        sources (list[list[tuple]]): For each observation, a list of
+            ``(path, bidx, (row_off, col_off))`` for each tile containing
+            the band, where ``row_off`` and ``col_off`` locate the upper left
+            pixel of the tile relative to the upper left of this array
+        shape (tuple): Number of rows and columns in the array
+        tile_shape (tuple): Number of rows and columns in each tile
+        transform (affine.Affine): Affine transform of this array
+        crs (CRS): Coordinate reference system of this array
+        fill (int or float): Fill value for pixels not observed
+        njob (int): Number of concurrent reads
+    """
+    def __init__(self, name, times, sources, shape, tile_shape,
+                 transform, crs, fill=None, njob=1):
+        self.name = name
+        self.times = times
+        self.sources = sources
+        self._shape = tuple(shape)
+        self.tile_shape = tile_shape
+        self.transform = transform
+        self.crs = crs
+        self._fill = fill
+        self.njob = njob
+
+    def __repr__(self):
+        return ('<{0.__class__.__name__}(name={0.name}, shape={0.shape}, '
+                'dtype={0.dtype})>'.format(self))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def shape(self):
+        """ tuple: Number of observations, rows, and columns
+        """
+        return (len(self.sources), ) + self._shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    @lazy_property
+    def _profile(self):
+        """ Datatype and block shape of the band, from the first source
+        """
+        for pieces in self.sources:
+            for path, bidx, _ in pieces:
+                with rasterio.open(path) as src:
+                    return (np.dtype(src.dtypes[bidx - 1]),
+                            tuple(src.block_shapes[bidx - 1]))
+        return np.dtype(np.float32), self.tile_shape
+
+    @property
+    def dtype(self):
+        """ np.dtype: Datatype of the band
+        """
+        return self._profile[0]
+
+    @property
+    def block_shape(self):
+        """ tuple: Number of rows and columns in each internal block of the
+            band's files
+        """
+        return self._profile[1]
+
+    @property
+    def fill(self):
+        """ int or float: Fill value, cast to be usable with :attr:`dtype`
+        """
+        return _fill_value(self._fill, self.dtype)
+
+    def __getitem__(self, key):
+        t_idx, y_idx, x_idx, squeeze = self._parse_key(key)
+
+        if not t_idx.size or not y_idx.size or not x_idx.size:
+            out = np.empty((t_idx.size, y_idx.size, x_idx.size),
+                           dtype=self.dtype)
+        else:
+            rows = (int(y_idx.min()), int(y_idx.max()) + 1)
+            cols = (int(x_idx.min()), int(x_idx.max()) + 1)
+            data = self._read(t_idx, rows, cols)
+            out = data[np.ix_(np.arange(t_idx.size),
+                              y_idx - rows[0], x_idx - cols[0])]
+
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+    def plan(self, key=slice(None)):
+        """ Return the I/O plan for reading a selection, without reading it
+
+        Args:
+            key (tuple): A selection, as used to index this array
+
+        Returns:
+            ReadPlan: The plan of reads needed for the selection
+        """
+        t_idx, y_idx, x_idx, _ = self._parse_key(key)
+        plan = ReadPlan(self.block_shape, self.tile_shape, self.dtype)
+        if t_idx.size and y_idx.size and x_idx.size:
+            rows = (int(y_idx.min()), int(y_idx.max()) + 1)
+            cols = (int(x_idx.min()), int(x_idx.max()) + 1)
+            self._add_to_plan(plan, t_idx, rows, cols)
+        return plan
+
+    def _parse_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for {}-dimensional array'
+                             .format(self.ndim))
+        key = key + (slice(None), ) * (self.ndim - len(key))
+
+        idx = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        squeeze = tuple(i for i, _idx in enumerate(idx) if np.ndim(_idx) == 0)
+        t_idx, y_idx, x_idx = [np.atleast_1d(_idx) for _idx in idx]
+        return t_idx, y_idx, x_idx, squeeze
+
+    def read_window(self, rows, cols, datasets=None):
+        """ Read a window of all observations
+
+        Args:
+            rows (tuple): Start and stop rows of the window
+            cols (tuple): Start and stop columns of the window
+            datasets (DatasetCache): Read from datasets kept open in this
+                cache, instead of opening each file for this read (see
+                :class:`tilezilla.planner.DatasetCache`)
+
+        Returns:
+            np.ndarray: The (time, y, x) data
+        """
+        return self._read(np.arange(len(self)), rows, cols,
+                          datasets=datasets)
+
+    def read(self):
+        """ Read and return all observations within the array
+
+        Returns:
+            np.ndarray: The (time, y, x) data
+        """
+        return self[:]
+
+    def to_xarray(self):
+        """ Read all observations as an ``xarray.DataArray``
+
+        Requires ``xarray`` to be installed.
+
+        Returns:
+            xarray.DataArray: The (time, y, x) data with coordinates
+        """
+        import xarray as xr
+
+        nt, ny, nx = self.shape
+        x = self.transform.c + (np.arange(nx) + 0.5) * self.transform.a
+        y = self.transform.f + (np.arange(ny) + 0.5) * self.transform.e
+        time = [t.datetime for t in self.times]
+
+        return xr.DataArray(self.read(),
+                            coords=[('time', time), ('y', y), ('x', x)],
+                            name=self.name,
+                            attrs={'crs': str(self.crs),
+                                   '_FillValue': self.fill})
+
+    def _read(self, t_idx, rows, cols, datasets=None):
+        """ Read a window, relative to this array, for observations
+        """
+        out = np.full((len(t_idx), rows[1] - rows[0], cols[1] - cols[0]),
+                      self.fill, dtype=self.dtype)
+
+        plan = ReadPlan(self.block_shape, self.tile_shape, self.dtype)
+        self._add_to_plan(plan, t_idx, rows, cols)
+        logger.debug('Reading {}'.format(plan))
+        for (i, (dr0, dr1), (dc0, dc1)), data in plan.execute(
+                self.njob, datasets=datasets):
+            out[i, dr0:dr1, dc0:dc1] = data
+
+        return out
+
+    def _add_to_plan(self, plan, t_idx, rows, cols):
+        for i, t in enumerate(t_idx):
+            for path, bidx, offset in self.sources[t]:
+                windows = _overlap(rows, cols, offset, self.tile_shape)
+                if windows:
+                    src_rows, src_cols, dst_rows, dst_cols = windows
+                    plan.add(path, bidx, src_rows, src_cols,
+                             key=(i, dst_rows, dst_cols))
+
+
+class TimeSeriesReader(object):
+    """ Read time series of bands from an indexed datacube
+
+    Args:
+        dataset (DatasetResource): Products and bands of a datacube
+        njob (int): Number of concurrent reads used by arrays returned
+    """
+    def __init__(self, dataset, njob=1):
+        self.dataset = dataset
+        self.datacube = dataset.datacube
+        self.tilespec = dataset.datacube.tilespec
+        self.njob = njob
+
+    def read(self, bounds, bands, start=None, end=None, collection=None):
+        """ Return lazily read arrays of bands within an extent and time range
+
+        Extents spanning more than one tile are stitched together from
+        the windows of each tile overlapping ``bounds``.
+
+        Args:
+            bounds (BoundingBox): Extent to read, in the coordinate reference
+                system of the tile specification
+            bands (list[str]): ``standard_name`` of bands to read
+            start (str, datetime, or Arrow): Read products acquired on or
+                after this date (default: None)
+            end (str, datetime, or Arrow): Read products acquired on or
+                before this date (default: None)
+            collection (str): Name of product collection
+
+        Returns:
+            OrderedDict[str, TimeSeriesArray]: Arrays for each band in
+                ``bands``
+        """
+        bounds = BoundingBox(*bounds)
+        tiles = self.tilespec.bounds_to_tiles(bounds)
+        return self._read_tiles(tiles, bounds, bands, start, end, collection)
+
+    def read_roi(self, roi, bands, start=None, end=None, collection=None):
+        """ Return lazily read arrays of bands within a region of interest
+
+        Only tiles intersecting the geometry of ``roi`` are read. Pixels of
+        tiles within the bounds of ``roi`` that do not intersect it are
+        filled.
+
+        Args:
+            roi (shapely.geometry.Polygon): A geometry in the coordinate
+                reference system of the tile specification
+            bands (list[str]): ``standard_name`` of bands to read
+            start (str, datetime, or Arrow): Read products acquired on or
+                after this date (default: None)
+            end (str, datetime, or Arrow): Read products acquired on or
+                before this date (default: None)
+            collection (str): Name of product collection
+
+        Returns:
+            OrderedDict[str, TimeSeriesArray]: Arrays for each band in
+                ``bands``, covering the bounds of ``roi``
+        """
+        bounds = BoundingBox(*roi.bounds)
+        tiles = self.tilespec.roi_to_tiles(roi)
+        return self._read_tiles(tiles, bounds, bands, start, end, collection)
+
+    def read_points(self, x, y, bands, start=None, end=None,
+                    collection=None):
+        """ Yield time series of bands at many points, one tile at a time
+
+        Points are grouped by the tile, and by the internal block of the
+        tile's band files, that contain them. Each band file is opened once
+        and each block containing points is read once, no matter how many
+        points fall within it.
+
+        Args:
+            x (np.ndarray): X coordinates in the coordinate reference system
+                of the tile specification
+            y (np.ndarray): Y coordinates in the coordinate reference system
+                of the tile specification
+            bands (list[str]): ``standard_name`` of bands to read
+            start (str, datetime, or Arrow): Read products acquired on or
+                after this date (default: None)
+            end (str, datetime, or Arrow): Read products acquired on or
+                before this date (default: None)
+            collection (str): Name of product collection
+
+        Yields:
+            tuple (np.ndarray, list[BaseProduct], OrderedDict): The indices
+                of the points within a tile, the products in this tile, and
+                the (time, point) values for each band in ``bands``. Points
+                in tiles that are not indexed are not yielded
+        """
+        start = arrow.get(start) if start is not None else None
+        end = arrow.get(end) if end is not None else None
+
+        x, y = np.atleast_1d(x).astype(float), np.atleast_1d(y).astype(float)
+        spec = self.tilespec
+        tile_rows, tile_cols = spec.point_to_tile_index(x, y)
+
+        # Pixel of each point within its tile
+        tile_bounds = spec.index_to_bounds(tile_rows, tile_cols)
+        ny, nx = spec.size[1], spec.size[0]
+        rows = np.clip(np.floor((tile_bounds[:, 3] - y) / spec.res[1]),
+                       0, ny - 1).astype(int)
+        cols = np.clip(np.floor((x - tile_bounds[:, 0]) / spec.res[0]),
+                       0, nx - 1).astype(int)
+
+        tile_index, tile_inverse = np.unique(
+            np.column_stack((tile_rows, tile_cols)), axis=0,
+            return_inverse=True)
+        tile_inverse = tile_inverse.ravel()
+
+        for i, (v, h) in enumerate(tile_index):
+            tile_id = self.datacube.get_tile_id(collection, int(h), int(v))
+            if not tile_id:
+                continue
+            idx = np.where(tile_inverse == i)[0]
+            products = self.dataset.get_products_by_tile(tile_id, start, end)
+            values = OrderedDict(
+                (name, self._sample_tile(products, name, rows[idx],
+                                         cols[idx]))
+                for name in bands)
+            yield idx, products, values
+
+    def _sample_tile(self, products, name, rows, cols):
+        """ Sample a band at pixels in a tile, reading each block once
+        """
+        sources = [(t, _find_band(product, name))
+                   for t, product in enumerate(products)]
+        sources = [(t, band) for t, band in sources if band]
+        if not sources:
+            return np.full((len(products), rows.size), np.nan)
+
+        with rasterio.open(sources[0][1].path) as src:
+            bidx = sources[0][1].bidx
+            dtype = np.dtype(src.dtypes[bidx - 1])
+            block_shape = src.block_shapes[bidx - 1]
+            raster_shape = (src.height, src.width)
+        out = np.full((len(products), rows.size),
+                      _fill_value(sources[0][1].fill, dtype), dtype=dtype)
+
+        # Request each block containing points from each product's band
+        bh, bw = block_shape
+        blocks = (rows // bh) * (raster_shape[1] // bw + 1) + cols // bw
+        blocks = [np.where(blocks == block)[0] for block in np.unique(blocks)]
+        plan = ReadPlan(block_shape, raster_shape, dtype)
+        for t, band in sources:
+            for in_block in blocks:
+                br = rows[in_block[0]] // bh * bh
+                bc = cols[in_block[0]] // bw * bw
+                plan.add(band.path, band.bidx,
+                         (br, min(br + bh, raster_shape[0])),
+                         (bc, min(bc + bw, raster_shape[1])),
+                         key=(t, in_block, br, bc))
+
+        logger.debug('Reading {}'.format(plan))
+        for (t, in_block, br, bc), data in plan.execute(self.njob):
+            out[t, in_block] = data[rows[in_block] - br,
+                                    cols[in_block] - bc]
+        return out
+
+    def _read_tiles(self, tiles, bounds, bands, start, end, collection):
+        start = arrow.get(start) if start is not None else None
+        end = arrow.get(end) if end is not None else None
+
+        (r0, r1), (c0, c1) = bounds_to_window(bounds, self.tilespec.transform)
+        transform = self.tilespec.transform * affine.Affine.translation(c0, r0)
+        tile_shape = (self.tilespec.size[1], self.tilespec.size[0])
+
+        # Products, by observation, in each tile
+        observations = OrderedDict()
+        for tile in tiles:
+            offset = (tile.vertical * tile_shape[0] - r0,
+                      tile.horizontal * tile_shape[1] - c0)
+            if not _overlap((0, r1 - r0), (0, c1 - c0), offset, tile_shape):
+                continue
+            tile_id = self.datacube.get_tile_id(collection, tile.horizontal,
+                                                tile.vertical)
+            if not tile_id:
+                continue
+            for product in self.dataset.get_products_by_tile(tile_id,
+                                                             start, end):
+                observations.setdefault(product.timeseries_id, []).append(
+                    (product, offset))
+        observations = sorted(observations.values(),
+                              key=lambda obs: obs[0][0].acquired)
+        times = [obs[0][0].acquired for obs in observations]
+
+        arrays = OrderedDict()
+        for name in bands:
+            sources, fill = [], None
+            for obs in observations:
+                pieces = []
+                for product, offset in obs:
+                    band = _find_band(product, name)
+                    if band:
+                        pieces.append((band.path, band.bidx, offset))
+                        fill = band.fill if fill is None else fill
+                sources.append(pieces)
+            arrays[name] = TimeSeriesArray(
+                name, times, sources, (r1 - r0, c1 - c0), tile_shape,
+                transform, self.tilespec.crs, fill=fill, njob=self.njob)
+
+        return arrays
+
+
+def _overlap(rows, cols, offset, tile_shape):
+    """ Return the source and destination windows of a tile overlapping a
+    window of an array, or None if they do not overlap
+
+    Args:
+        rows (tuple): Start and stop rows of the window
+        cols (tuple): Start and stop columns of the window
+        offset (tuple): Row and column of the tile's upper left pixel,
+            relative to the array
+        tile_shape (tuple): Number of rows and columns in the tile
+
+    Returns:
+        tuple: The start and stop rows and columns to read from the tile,
+            and the start and stop rows and columns to write to, relative to
+            the window
+    """
+    r0, r1 = max(rows[0], offset[0]), min(rows[1], offset[0] + tile_shape[0])
+    c0, c1 = max(cols[0], offset[1]), min(cols[1], offset[1] + tile_shape[1])
+    if r0 >= r1 or c0 >= c1:
+        return None
+    return ((r0 - offset[0], r1 - offset[0]),
+            (c0 - offset[1], c1 - offset[1]),
+            (r0 - rows[0], r1 - rows[0]),
+            (c0 - cols[0], c1 - cols[0]))
+
+
+def _fill_value(fill, dtype):
+    """ Return a fill value usable with a datatype
+    """
+    if fill is None or (np.isnan(fill) and dtype.kind in 'iub'):
+        return np.nan if dtype.kind == 'f' else 0
+    return fill
+
+
+def _find_band(product, standard_name):
+    for band in product.bands:
+        if band.standard_name == standard_name:
+            return band
+    return None
@@ -1,13 +1,16 @@
+import json
 import logging
 
 import click
 
 
-def config_to_resources(config):
+def config_to_resources(config, readonly=False):
     """ Return `tilezilla` resources from a configuration dict
 
     Args:
         config (dict): `tilezilla` configuration
+        readonly (bool): Only read from the database (see
+            :meth:`tilezilla.db.Database.connect`)
 
     Return:
         tuple[TileSpec, str, Database, DatacubeResource, DatasetResource]: A
@@ -16,12 +19,51 @@ def config_to_resources(config):
     from ..db import Database, DatacubeResource, DatasetResource
     spec = config['tilespec']
     store_name = config['store']['name']
-    db = Database.from_config(config['database'])
+    db = Database.from_config(config['database'], readonly=readonly)
     datacube = DatacubeResource(db, spec, store_name)
     dataset = DatasetResource(db, datacube)
     return spec, store_name, db, datacube, dataset
 
 
+def config_to_targets(config, db):
+    """ Return the datacube of each tile specification to ingest into
+
+    Args:
+        config (dict): `tilezilla` configuration
+        db (Database): Database connection
+
+    Return:
+        list[tuple[dict, DatacubeResource]]: The "tilespec" and "store"
+            configuration of each target (see ``targets`` in the
+            configuration file), and its datacube resource
+    """
+    from ..db import DatacubeResource
+    targets = config.get('targets') or [{'tilespec': config['tilespec'],
+                                         'store': config['store']}]
+    return [(target, DatacubeResource(db, target['tilespec'],
+                                      target['store']['name']))
+            for target in targets]
+
+
+def read_geometries(f):
+    """ Return the geometries of a GeoJSON file
+
+    Args:
+        f (file): GeoJSON geometry, feature, or feature collection
+
+    Returns:
+        list[dict]: GeoJSON-like geometries, skipping features without one
+    """
+    data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        geoms = [feat['geometry'] for feat in data['features']]
+    elif data.get('type') == 'Feature':
+        geoms = [data['geometry']]
+    else:
+        geoms = [data]
+    return [geom for geom in geoms if geom]
+
+
 class Echoer(object):
     """ Stylistic wrapper around loggers for communicating with user
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+""" Temporal composites of tiled datasets
+"""
+from collections import OrderedDict
+import concurrent.futures
+import logging
+import os
+
+import click
+
+from . import cliutils, options
+
+#: str: Name of band used to mask clouds and select best available pixels
+MASK_BAND = 'cfmask'
+#: list[str]: Names of compositing methods
+METHODS = ['median', 'percentile', 'max_ndvi', 'best_pixel']
+
+
+def composite_tile(config, index, path, bands, method, method_kwargs,
+                   start, end, collection, mask, block_njob,
+                   creation_options):
+    """ Composite the time series of bands within one tile
+
+    Returns:
+        str: The path to the composite, or None if the tile has no
+            observations within the time range
+    """
+    from ..api import TimeSeriesReader
+    from ..composite import write_composite
+    from .._util import mkdir_p
+
+    spec, storage_name, database, cube, dataset = (
+        cliutils.config_to_resources(config, readonly=True))
+    reader = TimeSeriesReader(dataset)
+    tile = spec[index]
+
+    names = list(bands) + ([MASK_BAND] if mask and MASK_BAND not in bands
+                           else [])
+    arrays = reader.read(tile.bounds, names, start=start, end=end,
+                         collection=collection)
+    # Make sure to close database connection
+    database.session.close()
+
+    mask_array = arrays[MASK_BAND] if mask else None
+    arrays = OrderedDict((name, arrays[name]) for name in bands)
+    if not len(mask_array if mask else arrays[bands[0]]):
+        return None
+
+    mkdir_p(os.path.dirname(path))
+    try:
+        return write_composite(path, arrays, method=method, mask=mask_array,
+                               njob=block_njob,
+                               creation_options=creation_options,
+                               **method_kwargs)
+    except:
+        # Don't leave partially written composites behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+@click.command(short_help='Composite time series of tiled data')
+@options.opt_multiprocess_method
+@options.opt_multiprocess_njob
+@options.opt_creation_options
+@options.opt_overwrite
+@click.option('--method', '-m', type=click.Choice(METHODS),
+              default='median', show_default=True,
+              help='Compositing method')
+@click.option('--band', '-b', 'bands', multiple=True, required=True,
+              help='Standard name of band to composite (repeat for more '
+                   'bands)')
+@click.option('--q', type=float, default=50, show_default=True,
+              help='Percentile to composite (for "percentile")')
+@click.option('--red', default='sr_band3', show_default=True,
+              help='Red band (for "max_ndvi")')
+@click.option('--nir', default='sr_band4', show_default=True,
+              help='Near infrared band (for "max_ndvi")')
+@click.option('--target_doy', type=click.IntRange(1, 366), default=None,
+              help='Preferred day of year (for "best_pixel")')
+@click.option('--mask/--no-mask', default=True, show_default=True,
+              help='Use only clear observations, according to "cfmask" '
+                   '(tiles without "cfmask" fail unless --no-mask)')
+@click.option('--start', type=str, default=None,
+              help='Composite observations acquired on or after this date')
+@click.option('--end', type=str, default=None,
+              help='Composite observations acquired on or before this date')
+@click.option('--collection', type=str, default=None,
+              help='Product collection to composite')
+@click.option('--tile', 'tiles', type=(int, int), multiple=True,
+              metavar='H V',
+              help='Horizontal and vertical index of a tile to composite '
+                   '(repeat for more tiles; default: all indexed tiles)')
+@click.option('--block_njob', type=int, default=1, show_default=True,
+              help='Number of blocks to composite concurrently within '
+                   'each tile')
+@click.option('--name', type=str, default=None,
+              help='Output filename, without extension (default: the '
+                   'compositing method)')
+@click.argument('destination',
+                type=click.Path(file_okay=False, resolve_path=True,
+                                writable=True))
+@click.pass_context
+def composite(ctx, destination, name, block_njob, tiles, collection, end,
+              start, mask, target_doy, nir, red, q, bands, method,
+              overwrite, creation_options, njob, executor):
+    """ Composite time series of bands in each tile
+
+    Each tile is composited separately, and can be processed in parallel
+    using ``--parallel-executor``. Within each tile, the time series are
+    read and composited one block of the tile's band files at a time, so
+    memory use does not depend on the length of the time series times the
+    size of the tile. Blocks within a tile can be composited concurrently
+    using ``--block_njob``.
+
+    Composites are written as one GeoTIFF per tile, with one band per band
+    composited, within DESTINATION using the "tile_dirpattern" of the
+    configuration file's "store".
+
+    \b
+    Compositing methods:
+        median: Median of clear observations
+        percentile: Percentile (--q) of clear observations
+        max_ndvi: Clear observation with the maximum NDVI
+        best_pixel: Best available pixel according to "cfmask", preferring
+            clear, snow, cloud shadow, and then cloud observations, and
+            then the observation closest to --target_doy or the most recent
+
+    Example:
+
+    \b
+    1. Peak of growing season composite for 2010 using 4 processes
+        > tilez composite -pe process -j 4 -m max_ndvi
+            -b sr_band3 -b sr_band4 -b sr_band5
+            --start 2010-01-01 --end 2010-12-31 composites/
+    """
+    from ..templates import TileTemplate
+
+    config = options.fetch_config(ctx)
+    logger = logging.getLogger('tilez')
+    echoer = cliutils.Echoer(logger)
+
+    if method == 'best_pixel' and not mask:
+        raise click.BadParameter('Best available pixel composites require '
+                                 'the "{}" band'.format(MASK_BAND),
+                                 param_hint='--mask')
+    method_kwargs = {
+        'median': {},
+        'percentile': {'q': q},
+        'max_ndvi': {'red': red, 'nir': nir},
+        'best_pixel': {'target_doy': target_doy}
+    }[method]
+    if method == 'max_ndvi':
+        bands = tuple(bands) + tuple(b for b in (red, nir) if b not in bands)
+    if not name:
+        name = 'p{:g}'.format(q) if method == 'percentile' else method
+
+    spec, storage_name, database, cube, dataset = (
+        cliutils.config_to_resources(config))
+    if tiles:
+        tiles = [spec[(v, h)] for h, v in tiles]
+    else:
+        tiles = list(OrderedDict.fromkeys(cube.get_tiles(collection)))
+    database.session.close()
+
+    echoer.process('Compositing {n} tiles using method "{m}"'
+                   .format(n=len(tiles), m=method))
+    futures = {}
+    tile_dirpattern = TileTemplate.compile(config['store']['tile_dirpattern'])
+    for tile in tiles:
+        path = os.path.join(destination, tile_dirpattern.render(tile),
+                            name + os.extsep + 'tif')
+        if os.path.exists(path) and not overwrite:
+            echoer.item('Skipping tile h{0.horizontal}v{0.vertical}: '
+                        'composite already exists'.format(tile))
+            continue
+        future = executor.submit(composite_tile, config, tile.index, path,
+                                 bands, method, method_kwargs,
+                                 start, end, collection, mask, block_njob,
+                                 creation_options)
+        futures[future] = tile
+
+    n_done = 0
+    for future in concurrent.futures.as_completed(futures):
+        tile = futures[future]
+        try:
+            path = future.result()
+        except Exception as exc:
+            echoer.warning('Composite of tile h{0.horizontal}v{0.vertical} '
+                           'produced exception: {exc}'
+                           .format(tile, exc=exc))
+        else:
+            if path:
+                n_done += 1
+                echoer.item('Composited tile h{0.horizontal}v{0.vertical}: '
+                            '{path}'.format(tile, path=path))
+            else:
+                echoer.item('No observations in tile '
+                            'h{0.horizontal}v{0.vertical}'.format(tile))
+
+    echoer.process('Composited {n} tiles'.format(n=n_done))
@@ -66,17 +66,39 @@ def info(ctx, table, filter_):
         }))
 
 
+def _tiles_filter(db, bbox, roi, crs):
+    """ Return a clause selecting tiles intersecting --bbox or --roi
+    """
+    if bbox and roi:
+        raise click.BadParameter('Use only one of --bbox or --roi',
+                                 param_hint='--bbox')
+    if bbox:
+        return db.tiles_intersecting(bounds=bbox, crs=crs)
+    elif roi:
+        return db.tiles_intersecting(
+            geometries=cliutils.read_geometries(roi), crs=crs)
+    return None
+
+
 @db.command(short_help='Search database')
 @options.arg_db_table
 @options.opt_db_select
 @options.opt_db_filter
 @options.opt_db_distinct
 @options.opt_db_groupby
+@options.opt_db_bbox
+@options.opt_db_roi
+@options.opt_db_crs
 @click.option('--quiet', '-q', is_flag=True, help='Suppress excessive text')
 @click.pass_context
-def search(ctx, quiet, group_by, distinct, filter_, select, table):
+def search(ctx, quiet, crs, roi, bbox, group_by, distinct, filter_, select,
+           table):
     """ Search a table according to some filters
 
+    Searches of tiles, products, or bands may be limited to the tiles
+    intersecting --bbox or the geometries within --roi, which are found
+    using the spatial index of tiles.
+
     Example:
 
     \b
@@ -84,6 +106,11 @@ def search(ctx, quiet, group_by, distinct, filter_, select, table):
         > tilez db search -h --filter "n_bands = 8"
             --group_by timeseries_id product
 
+    \b
+    2. Print IDs of products within a region
+        > tilez db search --crs EPSG:4326 --bbox -72 41 -71 42
+            --select id product
+
     """
     # TODO: add conjunction argument -- or / and
     import sqlalchemy_utils as sau
@@ -91,6 +118,7 @@ def search(ctx, quiet, group_by, distinct, filter_, select, table):
 
     db = _db_from_ctx(ctx)
     table_columns = sau.get_columns(table)
+    tiles = _tiles_filter(db, bbox, roi, crs)
 
     if '*' in select:
         select = table_columns.keys()
@@ -100,8 +128,11 @@ def search(ctx, quiet, group_by, distinct, filter_, select, table):
                     fg='blue', bold=True)
         for filter_item in filter_:
             click.echo('    {}'.format(filter_item))
+        if bbox or roi:
+            click.echo('    intersecting {}'.format(
+                bbox if bbox else roi.name))
 
-    query = construct_filter(db.session.query(table), filter_)
+    query = construct_filter(db.session.query(table), filter_, tiles=tiles)
 
     if distinct:
         try:
@@ -140,8 +171,30 @@ def search(ctx, quiet, group_by, distinct, filter_, select, table):
 @options.opt_db_filter
 @options.opt_db_distinct
 @options.opt_db_groupby
+@options.opt_db_bbox
+@options.opt_db_roi
+@options.opt_db_crs
 @click.pass_context
-def id(ctx, group_by, distinct, filter_, table):
+def id(ctx, crs, roi, bbox, group_by, distinct, filter_, table):
     """ Useful for piping into `tilez spew`
     """
     ctx.forward(search, select=('id', ), quiet=True)
+
+
+@db.command(short_help='Upgrade database created by an earlier version')
+@click.pass_context
+def upgrade(ctx):
+    """ Upgrade the database, in place, to the current layout
+
+    Back up the database before upgrading it.
+    """
+    from ..db._migrate import upgrade as upgrade_db
+    db = _db_from_ctx(ctx)
+    echoer = cliutils.Echoer(logging.getLogger('tilez'))
+
+    db.session.close()
+    steps = upgrade_db(db.engine)
+    if steps:
+        echoer.info('Upgraded database: {}'.format(', '.join(steps)))
+    else:
+        echoer.info('Database is up to date')
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+""" Extract time series of tiled datasets at many points
+"""
+import concurrent.futures
+import csv
+import logging
+import os
+import shutil
+import tempfile
+
+import click
+
+from . import cliutils, options
+
+
+def extract_tile(config, ids, x, y, bands, start, end, collection, path):
+    """ Extract time series for points within one tile
+
+    Rows of the output CSV, ordered by point and then by acquisition, are
+    written to ``path`` as they are extracted, instead of being kept in
+    memory and sent back to the parent process.
+
+    Returns:
+        int: Number of rows written
+    """
+    from ..api import TimeSeriesReader
+
+    spec, storage_name, database, cube, dataset = (
+        cliutils.config_to_resources(config, readonly=True))
+    reader = TimeSeriesReader(dataset)
+
+    n_rows = 0
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        for idx, products, values in reader.read_points(
+                x, y, bands, start=start, end=end, collection=collection):
+            for i, pt in enumerate(idx):
+                for t, product in enumerate(products):
+                    writer.writerow(
+                        [ids[pt], x[pt], y[pt], product.timeseries_id,
+                         product.acquired.isoformat()] +
+                        [values[b][t, i].item() for b in bands])
+                    n_rows += 1
+
+    # Make sure to close database connection
+    database.session.close()
+    return n_rows
+
+
+@click.command(short_help='Extract time series of tiled data at points')
+@options.opt_multiprocess_method
+@options.opt_multiprocess_njob
+@click.option('--band', '-b', 'bands', multiple=True, required=True,
+              help='Standard name of band to extract (repeat for more bands)')
+@click.option('--start', type=str, default=None,
+              help='Extract observations acquired on or after this date')
+@click.option('--end', type=str, default=None,
+              help='Extract observations acquired on or before this date')
+@click.option('--collection', type=str, default=None,
+              help='Product collection to extract')
+@click.option('--crs', type=str, default=None,
+              help='Coordinate reference system of points, if not the '
+                   'tile specification CRS')
+@click.option('--x_col', default='x', show_default=True,
+              help='Name of the X coordinate column')
+@click.option('--y_col', default='y', show_default=True,
+              help='Name of the Y coordinate column')
+@click.option('--id_col', default=None, show_default=True,
+              help='Name of the point ID column (default: row number)')
+@click.argument('points', type=click.File('r'))
+@click.argument('output', type=click.File('w'))
+@click.pass_context
+def extract(ctx, output, points, id_col, y_col, x_col, crs,
+            collection, end, start, bands, njob, executor):
+    """ Extract time series of bands at points listed in a CSV file
+
+    Time series are written to OUTPUT as CSV with one row per point per
+    observation. Point coordinates are written in the tile specification's
+    coordinate reference system.
+
+    Points are grouped by tile and by the blocks within each tile's band
+    files, so that each block is read once per product band no matter how
+    many points it contains. Each tile's time series are written to a
+    temporary file while they are extracted, and copied to OUTPUT as each
+    tile finishes.
+
+    Example:
+
+    \b
+    1. Extract red and NIR time series at training data locations
+        > tilez extract -pe process -j 8 -b sr_band3 -b sr_band4
+            --crs EPSG:4326 training.csv training_ts.csv
+    """
+    import numpy as np
+
+    config = options.fetch_config(ctx)
+    logger = logging.getLogger('tilez')
+    echoer = cliutils.Echoer(logger)
+    spec = config['tilespec']
+
+    reader = csv.DictReader(points)
+    ids, x, y = [], [], []
+    for i, row in enumerate(reader):
+        ids.append(row[id_col] if id_col else i)
+        x.append(float(row[x_col]))
+        y.append(float(row[y_col]))
+    x, y = np.asarray(x), np.asarray(y)
+    if crs:
+        from rasterio.warp import transform
+        x, y = map(np.asarray, transform(crs, spec.crs, x, y))
+
+    tile_rows, tile_cols = spec.point_to_tile_index(x, y)
+    tile_index, tile_inverse = np.unique(
+        np.column_stack((tile_rows, tile_cols)), axis=0, return_inverse=True)
+    tile_inverse = tile_inverse.ravel()
+    echoer.info('Extracting {n} points from {t} tiles'
+                .format(n=len(ids), t=len(tile_index)))
+
+    writer = csv.writer(output)
+    writer.writerow(['id', 'x', 'y', 'timeseries_id', 'acquired'] +
+                    list(bands))
+
+    tmpdir = tempfile.mkdtemp(prefix='tilez_extract_')
+    try:
+        futures = {}
+        for i, (v, h) in enumerate(tile_index):
+            idx = np.where(tile_inverse == i)[0]
+            path = os.path.join(tmpdir, 'h{h}v{v}.csv'.format(h=h, v=v))
+            future = executor.submit(extract_tile, config,
+                                     [ids[j] for j in idx], x[idx], y[idx],
+                                     bands, start, end, collection, path)
+            futures[future] = (h, v, path)
+
+        n_rows = 0
+        for future in concurrent.futures.as_completed(futures):
+            h, v, path = futures[future]
+            try:
+                n = future.result()
+            except Exception as exc:
+                echoer.warning('Extraction from tile h{h}v{v} produced '
+                               'exception: {exc}'.format(h=h, v=v, exc=exc))
+            else:
+                with open(path) as f:
+                    shutil.copyfileobj(f, output)
+                n_rows += n
+                echoer.item('Extracted {n} observations from tile h{h}v{v}'
+                            .format(n=n, h=h, v=v))
+            if os.path.exists(path):
+                os.remove(path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    echoer.process('Extracted {n} observations'.format(n=n_rows))
@@ -1,9 +1,335 @@
+# -*- coding: utf-8 -*-
 """ CLI utilities for exporting tiled dataset information
 """
+from collections import OrderedDict
+import csv
+import itertools
+import json
+import logging
+import os
+import struct
+
 import click
 
+from . import cliutils, options
+
+#: OrderedDict: Output formats, and the file extensions that imply them
+FORMATS = OrderedDict([
+    ('geojsonseq', ('.geojsonl', '.geojsons', '.geojsonseq')),
+    ('gpkg', ('.gpkg', )),
+    ('csv', ('.csv', ))
+])
+#: list[str]: Attributes written for each tile
+FIELDS = ['horizontal', 'vertical', 'key', 'left', 'bottom', 'right', 'top']
+#: int: Number of tiles described at once
+CHUNK_SIZE = 4096
+#: str: Name of the GeoPackage layer of tiles
+GPKG_LAYER = 'tiles'
+
+
+def tile_records(spec, rows, cols, counts=None, chunk_size=CHUNK_SIZE):
+    """ Yield the attributes of tiles, without creating any :class:`Tile`
+
+    Args:
+        spec (TileSpec): Tile specification
+        rows (np.ndarray): Tile row (vertical) indexes
+        cols (np.ndarray): Tile column (horizontal) indexes
+        counts (dict[tuple, int]): If given, also yield the number of
+            products in each ``(vertical, horizontal)`` tile
+        chunk_size (int): Number of tiles described at once
+
+    Yields:
+        tuple: :attr:`FIELDS` of each tile, followed by the number of products
+            if ``counts`` is given
+    """
+    for i in range(0, len(rows), chunk_size):
+        _rows, _cols = rows[i:i + chunk_size], cols[i:i + chunk_size]
+        keys = spec.tile_keys(_rows, _cols)
+        bounds = spec.index_to_bounds(_rows, _cols)
+        for h, v, key, b in zip(_cols.tolist(), _rows.tolist(),
+                                keys.tolist(), bounds.tolist()):
+            record = (h, v, key) + tuple(b)
+            if counts is not None:
+                record += (counts.get((v, h), 0), )
+            yield record
+
+
+def write_csv(f, fields, records):
+    """ Write tiles as CSV
+    """
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    n = 0
+    for record in records:
+        writer.writerow(record)
+        n += 1
+    return n
+
+
+def write_geojsonseq(f, fields, records):
+    """ Write tiles as newline delimited GeoJSON features
+    """
+    n = 0
+    for record in records:
+        l, b, r, t = record[3:7]
+        feature = {
+            'type': 'Feature',
+            'properties': dict(zip(fields, record)),
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[l, b], [r, b], [r, t], [l, t], [l, b]]]
+            }
+        }
+        f.write(json.dumps(feature) + '\n')
+        n += 1
+    return n
+
+
+def write_gpkg(path, fields, records, crs, layer=GPKG_LAYER):
+    """ Write tiles as polygons to a GeoPackage
+
+    The GeoPackage is written directly using ``sqlite3``, inserting tiles in
+    batches of :attr:`CHUNK_SIZE` within one transaction.
+    """
+    import sqlite3
+    from rasterio.crs import CRS
+
+    epsg = crs.to_epsg()
+    srs_id = epsg or 100000
+    con = sqlite3.connect(path)
+    try:
+        con.execute('PRAGMA application_id = 1196444487')  # "GPKG"
+        con.execute('PRAGMA user_version = 10200')
+        for sql in _GPKG_TABLES:
+            con.execute(sql)
+        con.executemany(
+            'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined',
+                 None),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+                ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+                 CRS.from_epsg(4326).to_wkt(), None)
+            ])
+        if srs_id != 4326:
+            con.execute(
+                'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                (crs.to_string(), srs_id, 'EPSG' if epsg else 'NONE',
+                 srs_id, crs.to_wkt(), None))
+
+        columns = ['"{}" {}'.format(name, 'REAL' if name in FIELDS[3:7]
+                                    else 'INTEGER') for name in fields]
+        con.execute('CREATE TABLE "{layer}" (fid INTEGER PRIMARY KEY '
+                    'AUTOINCREMENT NOT NULL, geom POLYGON, {columns})'
+                    .format(layer=layer, columns=', '.join(columns)))
+        insert = ('INSERT INTO "{layer}" (geom, {names}) VALUES (?, {qs})'
+                  .format(layer=layer,
+                          names=', '.join('"{}"'.format(n) for n in fields),
+                          qs=', '.join('?' * len(fields))))
+
+        n, extent = 0, [float('inf'), float('inf'),
+                        -float('inf'), -float('inf')]
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, CHUNK_SIZE))
+            if not chunk:
+                break
+            con.executemany(insert, [(_gpkg_polygon(record[3:7], srs_id), ) +
+                                     tuple(record) for record in chunk])
+            for record in chunk:
+                l, b, r, t = record[3:7]
+                extent = [min(extent[0], l), min(extent[1], b),
+                          max(extent[2], r), max(extent[3], t)]
+            n += len(chunk)
+
+        if not n:
+            extent = [None] * 4
+        con.execute('INSERT INTO gpkg_contents (table_name, data_type, '
+                    'identifier, min_x, min_y, max_x, max_y, srs_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [layer, 'features', layer] + extent + [srs_id])
+        con.execute('INSERT INTO gpkg_geometry_columns VALUES '
+                    '(?, ?, ?, ?, ?, ?)',
+                    (layer, 'geom', 'POLYGON', srs_id, 0, 0))
+        con.commit()
+    finally:
+        con.close()
+    return n
+
 
-@click.command(short_help='Get shapes of tiled datasets')
+def _gpkg_polygon(bounds, srs_id):
+    """ Return a GeoPackage geometry blob of a (left, bottom, right, top)
+    rectangle
+    """
+    l, b, r, t = bounds
+    # Header: magic, version, flags (little endian, XY envelope), SRS ID,
+    # envelope, followed by the little endian WKB polygon of one ring
+    return (struct.pack('<2sBBi4d', b'GP', 0, 0b011, srs_id, l, r, b, t) +
+            struct.pack('<BIII10d', 1, 3, 1, 5,
+                        l, b, r, b, r, t, l, t, l, b))
+
+
+_GPKG_TABLES = [
+    """CREATE TABLE gpkg_spatial_ref_sys (
+        srs_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL PRIMARY KEY,
+        organization TEXT NOT NULL,
+        organization_coordsys_id INTEGER NOT NULL,
+        definition TEXT NOT NULL,
+        description TEXT)""",
+    """CREATE TABLE gpkg_contents (
+        table_name TEXT NOT NULL PRIMARY KEY,
+        data_type TEXT NOT NULL,
+        identifier TEXT UNIQUE,
+        description TEXT DEFAULT '',
+        last_change DATETIME NOT NULL
+            DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+        srs_id INTEGER,
+        CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id)
+            REFERENCES gpkg_spatial_ref_sys(srs_id))""",
+    """CREATE TABLE gpkg_geometry_columns (
+        table_name TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        geometry_type_name TEXT NOT NULL,
+        srs_id INTEGER NOT NULL,
+        z TINYINT NOT NULL,
+        m TINYINT NOT NULL,
+        CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+        CONSTRAINT fk_gc_tn FOREIGN KEY (table_name)
+            REFERENCES gpkg_contents(table_name),
+        CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id)
+            REFERENCES gpkg_spatial_ref_sys(srs_id))"""
+]
+
+
+def _read_rois(f, crs, dst_crs):
+    """ Return the geometries of a GeoJSON file, in ``dst_crs``
+    """
+    import shapely.geometry
+
+    geoms = cliutils.read_geometries(f)
+    if crs:
+        from rasterio.warp import transform_geom
+        geoms = [transform_geom(crs, dst_crs, geom) for geom in geoms]
+    return [shapely.geometry.shape(geom) for geom in geoms]
+
+
+@click.command(short_help='Export the tiles of a tile specification')
+@options.opt_overwrite
+@click.option('--bbox', type=(float, float, float, float), default=None,
+              metavar='LEFT BOTTOM RIGHT TOP',
+              help='Export tiles intersecting these bounds')
+@click.option('--roi', type=click.File('r'), default=None,
+              help='Export tiles intersecting the geometries of this '
+                   'GeoJSON file')
+@click.option('--crs', type=str, default=None,
+              help='Coordinate reference system of --bbox or --roi, if not '
+                   'the tile specification CRS')
+@click.option('--counts', is_flag=True,
+              help='Include the number of products indexed in each tile')
+@click.option('--collection', type=str, default=None,
+              help='Count (and, without --bbox or --roi, export tiles of) '
+                   'only this product collection')
+@click.option('--order', type=click.Choice(['hilbert', 'morton']),
+              default=None,
+              help='Export tiles along a space-filling curve instead of in '
+                   'row-major order')
+@click.option('--format', '-f', 'fmt', type=click.Choice(list(FORMATS)),
+              default=None,
+              help='Output format (default: guessed from OUTPUT extension)')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
 @click.pass_context
-def shapes(ctx):
-    pass
+def tiles(ctx, output, fmt, order, collection, counts, crs, roi, bbox,
+          overwrite):
+    """ Export the tiles of a tile specification
+
+    Tiles intersecting --bbox or the geometries within --roi, or, if neither
+    is given, the tiles indexed in the database, are written to OUTPUT
+    with their index, key, and bounds in the tile specification's
+    coordinate reference system. Tiles are written as they are found, so
+    even large grids are written quickly and in little memory.
+
+    OUTPUT may be "-" to write CSV or GeoJSON-seq to stdout.
+
+    Example:
+
+    \b
+    1. Tiles covering CONUS with the number of products in each tile
+        > tilez tiles --crs EPSG:4326 --bbox -125 24 -66 50
+            --counts conus_tiles.gpkg
+    """
+    import numpy as np
+
+    config = options.fetch_config(ctx)
+    logger = logging.getLogger('tilez')
+    echoer = cliutils.Echoer(logger)
+    spec = config['tilespec']
+
+    if not fmt:
+        ext = os.path.splitext(output)[1].lower()
+        fmt = [k for k, exts in FORMATS.items() if ext in exts]
+        if not fmt:
+            raise click.BadParameter('Cannot guess output format from '
+                                     'extension "{}"'.format(ext),
+                                     param_hint='--format')
+        fmt = fmt[0]
+    if output == '-':
+        if fmt == 'gpkg':
+            raise click.BadParameter('Cannot write GeoPackage to stdout',
+                                     param_hint='OUTPUT')
+        # Keep messages out of output
+        echoer.logger.setLevel(logging.WARNING)
+    elif os.path.exists(output):
+        if not overwrite:
+            raise click.ClickException('Output exists (use --overwrite): {}'
+                                       .format(output))
+        os.remove(output)
+    if bbox and roi:
+        raise click.BadParameter('Use only one of --bbox or --roi',
+                                 param_hint='--bbox')
+
+    database = None
+    if counts or not (bbox or roi):
+        spec, storage_name, database, cube, dataset = (
+            cliutils.config_to_resources(config))
+
+    if bbox:
+        if crs:
+            from ..geoutils import reproject_bounds
+            bbox = reproject_bounds(bbox, crs, spec.crs)
+        rows, cols, _ = spec.bounds_to_tile_index(bbox)
+    elif roi:
+        rows, cols, _ = spec.rois_to_tile_index(
+            _read_rois(roi, crs, spec.crs))
+        # Tiles intersecting many geometries are written once
+        index = np.unique(np.column_stack((rows, cols)), axis=0)
+        rows, cols = index[:, 0], index[:, 1]
+    else:
+        index = list(OrderedDict.fromkeys(
+            (t.vertical, t.horizontal) for t in
+            database.get_tiles(cube.tilespec_id, storage_name,
+                               collection)))
+        index = np.array(index, dtype=int).reshape(-1, 2)
+        rows, cols = index[:, 0], index[:, 1]
+    if order:
+        idx = spec.sort_tile_index(rows, cols, order=order)
+        rows, cols = rows[idx], cols[idx]
+
+    fields = list(FIELDS)
+    tile_counts = None
+    if counts:
+        fields.append('n_products')
+        tile_counts = cube.count_products_by_tile(collection)
+    if database:
+        database.session.close()
+
+    echoer.process('Exporting {n} tiles to {out}'
+                   .format(n=len(rows), out=output))
+    records = tile_records(spec, rows, cols, counts=tile_counts)
+    if fmt == 'gpkg':
+        n = write_gpkg(output, fields, records, spec.crs)
+    else:
+        writer = write_csv if fmt == 'csv' else write_geojsonseq
+        with click.open_file(output, 'w') as f:
+            n = writer(f, fields, records)
+    echoer.process('Exported {n} tiles'.format(n=n))
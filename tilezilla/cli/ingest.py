@@ -3,6 +3,7 @@
 """
 from collections import defaultdict
 import concurrent.futures
+import itertools
 import logging
 import os
 
@@ -13,23 +14,46 @@ import six
 from . import cliutils, options
 from .. import multiprocess, products
 from .._util import decompress_to, include_bands, mkdir_p
+from ..db import band_record, definition_record, product_record, scene_record
+from ..derived import derived_bands
 from ..errors import FillValueException
 from ..geoutils import reproject_as_needed, reproject_bounds
+from ..stats import BAND_STATISTICS
 from ..stores import destination_path, STORAGE_TYPES
+from ..templates import TileTemplate
+from ..tilespec import TILE_KEY_ORDER
 
 
 def ingest_source(config, source, overwrite, log_name):
     """ Ingest (tile and index) a source
 
+    Each source is decompressed and read once, and then tiled into each
+    tile specification ingested into (see ``targets`` in the configuration
+    file). Bands derived from the bands of the source (see ``derived`` in
+    the configuration of products) are computed from the data read.
+
     Table entries for indexing are created and returned by this function so
-    that database writes can be performed in parent process/context.
+    that database writes can be performed in parent process/context (see
+    :func:`index_source`). The database is only read from, to find tiles,
+    products, and bands already indexed.
+
+    The scene, band definitions, products, and bands are returned as records
+    (see :mod:`tilezilla.db._records`), which are smaller to send to the
+    parent process than ORM objects.
+
+    Returns:
+        tuple[SceneRecord, list[DefinitionRecord], list]: The scene of the
+            source, the definitions of its bands, and the product and bands
+            of each tile (``(key, ProductRecord,
+            list[BandRecord])``, where ``key`` is the tile specification ID
+            and tile ``(horizontal, vertical)`` index)
     """
     mlogger = multiprocess.get_logger_multiproc(name=os.path.basename(source),
                                                 filename=log_name)
     echoer = cliutils.Echoer(logger=mlogger)
 
     spec, storage_name, database, cube, dataset = (
-        cliutils.config_to_resources(config))
+        cliutils.config_to_resources(config, readonly=True))
 
     echoer.info('Decompressing: {}'.format(os.path.basename(source)))
     with decompress_to(source) as tmpdir:
@@ -49,93 +73,235 @@ def ingest_source(config, source, overwrite, log_name):
             desired_bands = include_bands(product.bands, band_filter,
                                           regex=band_filter_regex)
 
-        # Reprojection option
+        # Reprojection option, optionally overridden for some bands (e.g.,
+        # "mode" for categorical bands)
         resampling = product_config.get('resampling', 'nearest')
+        band_resampling = product_config.get('band_resampling', {})
 
-        # Retrieve bounding box in tilespec's CRS
-        bbox = reproject_bounds(product.bounds, 'EPSG:4326', spec.crs)
+        # Metadata indexed for searches (default: that of the product type)
+        metadata_keys = product_config.get('index_metadata', None)
+        scene = scene_record(product, metadata_keys=metadata_keys)
 
-        # Find tiles for product & IDs of these tiles in database
-        tiles = list(spec.bounds_to_tiles(bbox))
-        tiles_id = [
-            cube.ensure_tile(
-                collection_name, tile.horizontal, tile.vertical)
-            for tile in tiles
+        targets = [
+            _IngestTarget(target, _cube, product)
+            for target, _cube in cliutils.config_to_targets(config, database)
+        ]
+
+        # Bands derived from other bands, whose input bands are kept in
+        # memory (and read even if not tiled themselves)
+        derived = derived_bands(product_config)
+        tiled = set(band.standard_name for band in desired_bands)
+        inputs = set(name for dband in derived for name in dband.bands)
+        missing = inputs - set(band.standard_name for band in product.bands)
+        if missing:
+            echoer.warning('Cannot derive bands from bands not in product: '
+                           '{}'.format(', '.join(sorted(missing))))
+            derived = [dband for dband in derived
+                       if not missing.intersection(dband.bands)]
+            inputs -= missing
+        read_bands = list(desired_bands) + [
+            band for band in product.bands
+            if band.standard_name in inputs and
+            band.standard_name not in tiled
         ]
-        tiles_product = {
-            tile_id: database.get_product_by_name(
-                tile_id, product.timeseries_id)
-            for tile_id in tiles_id
-        }
 
+        definitions = {}
         indexed_products, indexed_bands = {}, defaultdict(list)
-        for band in desired_bands:
+        for band in read_bands:
             echoer.info('Reprojecting band: {}'.format(band))
-            with reproject_as_needed(band.src, spec, resampling) as src:
-                band.src = src
-                echoer.process('Tiling: {}'.format(band.long_name))
-                for tile, tile_id in zip(tiles, tiles_id):
-                    db_product = tiles_product[tile_id]
-                    if db_product:
-                        # If product is in DB, check if we have bands to add
-                        _band_names = [b.standard_name for b
-                                       in db_product.bands]
-                        if band.standard_name in _band_names and not overwrite:
-                            echoer.item('Already tiled -- skipping')
-                            continue
-                    else:
-                        # Product not in DB -- need to create
-                        db_product = database.create_product(product)
-                        db_product.tile_id = tile_id
-                        tiles_product[tile_id] = db_product
-
-                    # Setup dataset store
-                    path = destination_path(config, tile, product)
-                    store_cls = STORAGE_TYPES[config['store']['name']]
-                    store = store_cls(path, tile,
-                                      meta_options=config['store']['co'])
-
-                    # Save and record path
-                    try:
-                        dst_path = store.store_variable(
-                            product, band,
-                            img_pattern=config['store']['tile_imgpattern'],
-                            overwrite=overwrite)
-                    except FillValueException:
-                        # TODO: skip tile but complain
-                        continue
-                    band.path = dst_path
-
-                    # Copy over metadata files
-                    for md_name, md_file in six.iteritems(
-                            product.metadata_files):
-                        if md_file:
-                            dst_path = store.store_file(product, md_file)
-                            product.metadata_files[md_name] = dst_path
-
-                    # Update index with new product/band entry
-                    if db_product.id:
-                        db_band = (
-                            database.get_band_by_name(db_product.id,
-                                                      band.standard_name)
-                            or database.create_band(band)
-                        )
+            _resampling = band_resampling.get(band.standard_name, resampling)
+            band_src, band_data = band.src, None
+            for target in targets:
+                with reproject_as_needed(band_src, target.spec,
+                                         _resampling) as src:
+                    band.src = src
+                    # Read once, and cut each tile from the data
+                    if src is band_src:
+                        if band_data is None:
+                            band_data = src.read(1)
+                        data = band_data
                     else:
-                        db_product = database.create_product(product)
-                        db_product.tile_id = tile_id
-                        db_band = database.create_band(band)
+                        data = src.read(1)
+                    if band.standard_name in inputs:
+                        target.keep_input(band, data)
+                    if band.standard_name in tiled:
+                        echoer.process('Tiling: {} ({})'.format(
+                            band.long_name, target.spec.desc))
+                        target.tile_band(band, data, overwrite, echoer,
+                                         definitions, indexed_products,
+                                         indexed_bands)
+            band.src = band_src
 
-                    indexed_products[tile_id] = db_product
-                    indexed_bands[tile_id].append(db_band)
-
-                    # TODO: delete file if index went bad
-                    echoer.item('Tiled band for tile {}'.format(
-                        tile.str_format(config['store']['tile_dirpattern'])
-                    ))
+        for target in targets:
+            for dband in derived:
+                echoer.process('Deriving: {} ({})'.format(
+                    dband.long_name, target.spec.desc))
+                data = target.derive_band(dband)
+                target.tile_band(dband, data, overwrite, echoer,
+                                 definitions, indexed_products, indexed_bands)
+            target.inputs.clear()
 
     # Make sure to close database connection
     database.session.close()
-    return indexed_products, indexed_bands
+    records = [(key, product_record(**indexed_products[key]),
+                indexed_bands[key])
+               for key in sorted(indexed_products)]
+    return scene, list(definitions.values()), records
+
+
+def index_source(database, cubes, scene, definitions, records):
+    """ Index the tiles, products, and bands of a source ingested
+
+    Tiles are added to the database if needed before the products and
+    bands, and the scene and band definitions they share, are added in bulk
+    (see :meth:`Database.index_records`).
+
+    Args:
+        database (Database): Database connection
+        cubes (dict[int, DatacubeResource]): Datacube of each tile
+            specification ingested into, by tile specification ID
+        scene, definitions, records: The results of :func:`ingest_source`
+
+    Returns:
+        tuple[list[int], list[int]]: IDs of the products and bands indexed
+    """
+    # Add all the tiles of each tile specification at once
+    tile_ids = {}
+    for tilespec_id, keys in itertools.groupby(
+            [key for key, _, _ in records], key=lambda key: key[0]):
+        keys = list(keys)
+        cube = cubes[tilespec_id]
+        tiles = [cube.tilespec[(v, h)] for _, h, v in keys]
+        tile_ids.update(zip(keys, cube.ensure_tiles(scene.description, tiles)))
+
+    return database.index_records(
+        scene, definitions,
+        [(tile_ids[key], product, bands) for key, product, bands in records])
+
+
+class _IngestTarget(object):
+    """ Tiles of a product within one tile specification being ingested into
+    """
+    def __init__(self, target, cube, product):
+        self.spec = target['tilespec']
+        self.store = target['store']
+        self.product = product
+        #: dict: Data of input bands of derived bands, by standard_name
+        self.inputs = {}
+        self._input_bands = {}
+
+        bbox = reproject_bounds(product.bounds, 'EPSG:4326', self.spec.crs)
+
+        # Find tiles for product & products already indexed in these tiles.
+        # Tiles not yet in the database are added when indexed
+        tiles = list(self.spec.bounds_to_tiles(bbox, order=TILE_KEY_ORDER))
+        self.tiles_key = [(cube.tilespec_id, tile.horizontal, tile.vertical)
+                          for tile in tiles]
+        #: dict: Columns of the product in each tile, if already indexed
+        self.tiles_product = {}
+        #: dict: IDs of the bands of each product already indexed, by name
+        self.tiles_band_ids = {}
+        for key, tile in zip(self.tiles_key, tiles):
+            tile_id = cube.get_tile_id(product.description,
+                                       tile.horizontal, tile.vertical)
+            db_product = tile_id and cube.db.get_product_by_name(
+                tile_id, product.timeseries_id)
+            if db_product:
+                self.tiles_product[key] = product_record(db_product)._asdict()
+                self.tiles_band_ids[key] = dict(
+                    (db_band.standard_name, db_band.id)
+                    for db_band in db_product.bands)
+        #: dict: Paths of metadata files copied into each tile
+        self.tiles_metadata_files = {}
+        # Format tile paths & names once, not once per band
+        store_cls = STORAGE_TYPES[self.store['name']]
+        self.tiles_store = [
+            store_cls(destination_path(target, tile, product), tile,
+                      meta_options=self.store['co'])
+            for tile in tiles
+        ]
+        self.tiles_name = TileTemplate.compile(
+            self.store['tile_dirpattern']).render_many(tiles)
+
+    def keep_input(self, band, data):
+        """ Keep the data of an input band of derived bands
+        """
+        self.inputs[band.standard_name] = data
+        self._input_bands[band.standard_name] = (
+            band, band.src.transform, band.src.crs, data.shape)
+
+    def derive_band(self, band):
+        """ Compute a derived band from the data of its input bands
+
+        Raises:
+            ValueError: if the input bands are not aligned to each other
+        """
+        grids = set((transform, shape) for _, transform, _, shape in
+                    (self._input_bands[name] for name in band.bands))
+        if len(grids) > 1:
+            raise ValueError('Cannot derive band "{}" from bands that are '
+                             'not aligned'.format(band.standard_name))
+        inputs = dict((name, self._input_bands[name][0])
+                      for name in band.bands)
+        _, transform, crs, _ = self._input_bands[band.bands[0]]
+        return band.compute(self.inputs, inputs, transform, crs)
+
+    def tile_band(self, band, data, overwrite, echoer, definitions,
+                  indexed_products, indexed_bands):
+        """ Tile a band, whose source is aligned to the tile specification
+        """
+        product = self.product
+        for key, store, tile_name in zip(self.tiles_key, self.tiles_store,
+                                         self.tiles_name):
+            band_ids = self.tiles_band_ids.setdefault(key, {})
+            if band.standard_name in band_ids and not overwrite:
+                # Product is in DB, and already has this band
+                echoer.item('Already tiled -- skipping')
+                continue
+            if key not in self.tiles_product:
+                # Product not in DB -- need to create
+                self.tiles_product[key] = dict(
+                    timeseries_id=product.timeseries_id,
+                    acquired=product.acquired)
+            db_product = self.tiles_product[key]
+
+            # Save and record path, and statistics of the tile's data
+            stats = {}
+            try:
+                dst_path = store.store_variable(
+                    product, band,
+                    img_pattern=self.store['tile_imgpattern'],
+                    overwrite=overwrite, data=data, stats=stats)
+            except FillValueException:
+                # TODO: skip tile but complain
+                continue
+            band.path = dst_path
+
+            # Copy over metadata files, once per tile
+            if key not in self.tiles_metadata_files:
+                self.tiles_metadata_files[key] = dict(
+                    (md_name, store.store_file(product, md_file))
+                    for md_name, md_file in
+                    six.iteritems(product.metadata_files) if md_file)
+                db_product['metadata_files_'] = self.tiles_metadata_files[key]
+
+            # Record new product/band entry for index
+            if band.standard_name not in definitions:
+                definitions[band.standard_name] = definition_record(band)
+            db_band = band_record(
+                id=band_ids.get(band.standard_name),
+                standard_name=band.standard_name, path=dst_path,
+                bidx=band.bidx,
+                **dict((name, stats.get(name)) for name in BAND_STATISTICS))
+            db_product.update((name, value) for name, value in
+                              six.iteritems(stats)
+                              if name not in BAND_STATISTICS)
+
+            indexed_products[key] = db_product
+            indexed_bands[key].append(db_band)
+
+            # TODO: delete file if index went bad
+            echoer.item('Tiled band for tile {}'.format(tile_name))
 
 
 @click.command(short_help='Ingest known products into tile dataset format')
@@ -154,13 +320,20 @@ def ingest(ctx, sources, overwrite, log_dir, njob, executor):
     logger = logging.getLogger('tilez')
     echoer = cliutils.Echoer(logger)
 
+    # All index writes are made here, so workers only read from the index
     spec, storage_name, database, cube, dataset = (
         cliutils.config_to_resources(config))
+    cubes = dict((_cube.tilespec_id, _cube) for _, _cube in
+                 cliutils.config_to_targets(config, database))
 
     echoer.info('Ingesting {} products'.format(len(sources)))
     if log_dir:
         mkdir_p(log_dir)
 
+    # Workers open their own connections, and must not inherit ours
+    database.session.remove()
+    database.engine.dispose()
+
     product_ids, band_ids = [], []
     futures = {
         executor.submit(ingest_source, config, src, overwrite,
@@ -173,24 +346,16 @@ def ingest(ctx, sources, overwrite, log_dir, njob, executor):
     for future in concurrent.futures.as_completed(futures):
         src = futures[future]
         try:
-            indexed_products, indexed_bands = future.result()
-            for k in indexed_products:
-                prod = indexed_products[k]
-                with database.scope() as txn:
-                    txn.merge(prod) if prod.id else txn.add(prod)
-                    txn.flush()
-                    for b in indexed_bands[k]:
-                        b.product_id = prod.id
-                        txn.merge(b) if b.id else txn.add(b)
-                product_ids.append(prod.id)
-                band_ids.extend([b.id for b in indexed_bands[k]])
+            _product_ids, _band_ids = index_source(database, cubes,
+                                                   *future.result())
+            product_ids.extend(_product_ids)
+            band_ids.extend(_band_ids)
         except Exception as exc:
             echoer.warning('Ingest of {} produced exception: {}'
                            .format(src, exc))
         else:
             echoer.item('Ingested: {} (product IDs: {})'
-                        .format(src, [p.id for p in indexed_products.values()])
-            )
+                        .format(src, _product_ids))
             sources_indexed += 1
 
     echoer.process('Indexed {nprod} products to {ntile} tiles of {nband} bands'
@@ -111,6 +111,23 @@ opt_db_select = click.option(
     help='Print (select) one or more columns'
 )
 
+opt_db_bbox = click.option(
+    '--bbox', type=(float, float, float, float), default=None,
+    metavar='LEFT BOTTOM RIGHT TOP',
+    help='Search only tiles intersecting these bounds'
+)
+
+opt_db_roi = click.option(
+    '--roi', type=click.File('r'), default=None,
+    help='Search only tiles intersecting the geometries of this GeoJSON file'
+)
+
+opt_db_crs = click.option(
+    '--crs', type=str, default=None,
+    help='Coordinate reference system of --bbox or --roi, if not that of '
+         'each tile specification'
+)
+
 opt_creation_options = click.option(
     '--co',
     'creation_options',
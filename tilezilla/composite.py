@@ -0,0 +1,403 @@
+""" Temporal composites of tiled time series
+
+Composites reduce the time series of each pixel to one value per band. The
+time series are streamed through one block of the tile's band files at a
+time, so memory use is bounded by the size of one block of every
+observation, not by the size of the tile. Blocks may be composited
+concurrently.
+
+Compositing methods are functions with the signature
+``method(data, mask=None, times=None, **kwargs)``, where ``data`` is an
+``OrderedDict`` of band name to (time, y, x) ``float64`` arrays with
+unobserved pixels as NaN, ``mask`` is the (time, y, x) ``cfmask`` band (or
+None), and ``times`` are the acquisition dates of each observation. Methods
+return an ``OrderedDict`` of band name to (y, x) composite.
+
+Example:
+
+    .. code-block:: python
+
+        reader = TimeSeriesReader(dataset)
+        tile = dataset.datacube.tilespec[(vertical, horizontal)]
+        arrays = reader.read(tile.bounds, ['sr_band3', 'sr_band4', 'cfmask'])
+        mask = arrays.pop('cfmask')
+        write_composite('median.tif', arrays, 'median', mask=mask, njob=4)
+
+"""
+from collections import OrderedDict
+import concurrent.futures
+import itertools
+import logging
+import threading
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from .planner import DatasetCache
+
+logger = logging.getLogger('tilezilla')
+
+#: tuple: ``cfmask`` values of clear land and clear water pixels
+CFMASK_CLEAR = (0, 1)
+#: dict: Preference for ``cfmask`` classes when selecting the best available
+#: pixel (lower is preferred). Classes not listed (e.g., fill) are never used
+CFMASK_PRIORITY = OrderedDict([
+    (0, 0),  # clear land
+    (1, 0),  # clear water
+    (3, 1),  # snow
+    (2, 2),  # cloud shadow
+    (4, 3),  # cloud
+])
+
+
+# Compositing methods
+def median(data, mask=None, times=None):
+    """ Median of clear observations
+
+    Args:
+        data (OrderedDict): (time, y, x) arrays of each band
+        mask (np.ndarray): (time, y, x) ``cfmask`` band, if available
+        times (list[Arrow]): Acquisition date of each observation
+
+    Returns:
+        OrderedDict: (y, x) median of each band
+    """
+    return percentile(data, mask=mask, times=times, q=50)
+
+
+def percentile(data, mask=None, times=None, q=50):
+    """ Percentile of clear observations
+
+    Args:
+        data (OrderedDict): (time, y, x) arrays of each band
+        mask (np.ndarray): (time, y, x) ``cfmask`` band, if available
+        times (list[Arrow]): Acquisition date of each observation
+        q (float): Percentile to compute, between 0 and 100
+
+    Returns:
+        OrderedDict: (y, x) percentile of each band
+    """
+    q = float(q)
+    if not 0 <= q <= 100:
+        raise ValueError('Percentile must be between 0 and 100 ({} given)'
+                         .format(q))
+    data = _mask_clear(data, mask)
+    with warnings.catch_warnings():
+        # All-NaN pixels are expected and remain NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return OrderedDict((name, np.nanpercentile(arr, q, axis=0))
+                           for name, arr in data.items())
+
+
+def max_ndvi(data, mask=None, times=None, red='sr_band3', nir='sr_band4'):
+    """ Clear observation with the maximum NDVI
+
+    Args:
+        data (OrderedDict): (time, y, x) arrays of each band
+        mask (np.ndarray): (time, y, x) ``cfmask`` band, if available
+        times (list[Arrow]): Acquisition date of each observation
+        red (str): Name of the red band
+        nir (str): Name of the near infrared band
+
+    Returns:
+        OrderedDict: (y, x) values of each band from the observation with
+            the maximum NDVI
+    """
+    for name in (red, nir):
+        if name not in data:
+            raise KeyError('Maximum NDVI composites require the "{}" band'
+                           .format(name))
+    data = _mask_clear(data, mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = (data[nir] - data[red]) / (data[nir] + data[red])
+    score = np.where(np.isfinite(ndvi), -ndvi, np.inf)
+    return _select(data, score)
+
+
+def best_pixel(data, mask=None, times=None, target_doy=None):
+    """ Best available pixel according to ``cfmask``
+
+    Observations are preferred according to :attr:`CFMASK_PRIORITY`. Ties
+    are broken by preferring the observation closest to a target day of
+    year, if given, or otherwise the most recent observation.
+
+    Args:
+        data (OrderedDict): (time, y, x) arrays of each band
+        mask (np.ndarray): (time, y, x) ``cfmask`` band
+        times (list[Arrow]): Acquisition date of each observation
+        target_doy (int): Preferred day of year
+
+    Returns:
+        OrderedDict: (y, x) values of each band from the best observation
+
+    Raises:
+        ValueError: if ``mask`` is not provided
+    """
+    if mask is None:
+        raise ValueError('Best available pixel composites require a cfmask '
+                         'band')
+    nt = mask.shape[0]
+
+    priority = np.full(mask.shape, np.inf)
+    for value, rank in CFMASK_PRIORITY.items():
+        priority[mask == value] = rank
+    for arr in data.values():
+        priority[np.isnan(arr)] = np.inf
+
+    if target_doy is not None and times:
+        doy = np.array([t.timetuple().tm_yday for t in times], dtype=float)
+        dist = np.abs(doy - float(target_doy))
+        tiebreak = np.minimum(dist, 366 - dist) / 367.
+    else:
+        tiebreak = (nt - 1 - np.arange(nt, dtype=float)) / max(nt, 1)
+    score = priority + tiebreak[:, np.newaxis, np.newaxis]
+
+    return _select(data, score)
+
+
+#: dict: Compositing methods available, by name
+COMPOSITE_METHODS = OrderedDict([
+    ('median', median),
+    ('percentile', percentile),
+    ('max_ndvi', max_ndvi),
+    ('best_pixel', best_pixel),
+])
+#: tuple: Methods that select an observation, rather than computing a
+#: statistic, so their composites can keep the datatype of the bands
+SELECTION_METHODS = ('max_ndvi', 'best_pixel')
+
+
+# Streaming over blocks
+def block_windows(shape, block_shape):
+    """ Yield the windows of blocks covering an array
+
+    Args:
+        shape (tuple): Number of rows and columns in the array
+        block_shape (tuple): Number of rows and columns in each block
+
+    Yields:
+        tuple: Start and stop rows, and start and stop columns, of each
+            block in row-major order
+    """
+    (ny, nx), (bh, bw) = shape, block_shape
+    for r0, c0 in itertools.product(range(0, ny, bh), range(0, nx, bw)):
+        yield (r0, min(r0 + bh, ny)), (c0, min(c0 + bw, nx))
+
+
+def composite_blocks(arrays, method='median', mask=None, block_shape=None,
+                     njob=1, **kwargs):
+    """ Yield composites of time series, one block at a time
+
+    Each block is read from every observation, composited, and released
+    before more blocks are read. Up to ``njob`` blocks are composited
+    concurrently, and at most ``2 * njob`` blocks are in memory at once.
+    Each thread compositing blocks keeps the band files it reads open (see
+    :class:`tilezilla.planner.DatasetCache`) until all blocks are done.
+
+    Args:
+        arrays (OrderedDict[str, TimeSeriesArray]): Time series of each band
+            to composite, all covering the same extent and observations
+        method (str or callable): Compositing method, either a name from
+            :attr:`COMPOSITE_METHODS` or a function
+        mask (TimeSeriesArray): Time series of the ``cfmask`` band, if
+            used by ``method``
+        block_shape (tuple): Number of rows and columns in each block
+            (default: the internal block shape of the band files)
+        njob (int): Number of blocks to composite concurrently
+        kwargs: Additional keyword arguments passed to ``method``
+
+    Yields:
+        tuple (tuple, OrderedDict): Start and stop rows and columns of a
+            block, and the (y, x) composite of each band within it
+
+    Raises:
+        ValueError: Raise if ``mask`` is given but its band is not indexed
+            for any observation
+    """
+    func = _get_method(method)
+    first = _reference(arrays)
+    _check_mask(mask)
+    block_shape = block_shape or first.block_shape
+    windows = block_windows(first.shape[1:], block_shape)
+
+    # Open datasets can't be shared among threads, so each has its own
+    local, caches = threading.local(), []
+
+    def _datasets():
+        if not hasattr(local, 'datasets'):
+            local.datasets = DatasetCache()
+            caches.append(local.datasets)
+        return local.datasets
+
+    def _composite(window):
+        rows, cols = window
+        datasets = _datasets()
+        data = OrderedDict()
+        for name, arr in arrays.items():
+            block = arr.read_window(rows, cols, datasets).astype(np.float64)
+            if arr.fill is not None and not np.isnan(arr.fill):
+                block[block == arr.fill] = np.nan
+            data[name] = block
+        _mask = (mask.read_window(rows, cols, datasets)
+                 if mask is not None else None)
+        return func(data, mask=_mask, times=first.times, **kwargs)
+
+    try:
+        if njob <= 1:
+            for window in windows:
+                yield window, _composite(window)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(njob) as executor:
+            futures = dict((executor.submit(_composite, window), window)
+                           for window in itertools.islice(windows, 2 * njob))
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    window = futures.pop(future)
+                    yield window, future.result()
+                    for _window in itertools.islice(windows, 1):
+                        futures[executor.submit(_composite,
+                                                _window)] = _window
+    finally:
+        for datasets in caches:
+            datasets.close()
+
+
+def write_composite(path, arrays, method='median', mask=None,
+                    block_shape=None, njob=1, creation_options=None,
+                    **kwargs):
+    """ Composite time series and write each band to a GeoTIFF
+
+    Composites from :attr:`SELECTION_METHODS` are written using the datatype
+    and fill value of the bands. Other composites are written as
+    ``float32`` with NaN as the fill value.
+
+    Args:
+        path (str): Output filename
+        arrays (OrderedDict[str, TimeSeriesArray]): Time series of each band
+            to composite, all covering the same extent and observations
+        method (str or callable): Compositing method, either a name from
+            :attr:`COMPOSITE_METHODS` or a function
+        mask (TimeSeriesArray): Time series of the ``cfmask`` band, if
+            used by ``method``
+        block_shape (tuple): Number of rows and columns in each block
+            (default: the internal block shape of the band files)
+        njob (int): Number of blocks to composite concurrently
+        creation_options (dict): Additional creation options for ``rasterio``
+        kwargs: Additional keyword arguments passed to ``method``
+
+    Returns:
+        str: The path to the composite
+
+    Raises:
+        ValueError: Raise if ``mask`` is given but its band is not indexed
+            for any observation
+    """
+    first = _reference(arrays)
+    _check_mask(mask)
+    block_shape = block_shape or first.block_shape
+
+    if method in SELECTION_METHODS:
+        dtype, nodata = first.dtype, first.fill
+    else:
+        dtype, nodata = np.dtype(np.float32), np.nan
+
+    meta = {
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockysize': block_shape[0],
+        'blockxsize': block_shape[1],
+        'compress': 'deflate'
+    }
+    if block_shape[0] % 16 or block_shape[1] % 16:
+        # GeoTIFF blocks must be multiples of 16 in size
+        meta['tiled'] = False
+        del meta['blockysize'], meta['blockxsize']
+    meta.update(creation_options or {})
+    meta.update({
+        'count': len(arrays),
+        'dtype': dtype.name,
+        'nodata': nodata,
+        'height': first.shape[1],
+        'width': first.shape[2],
+        'transform': first.transform,
+        'crs': first.crs
+    })
+
+    with rasterio.open(path, 'w', **meta) as dst:
+        for bidx, name in enumerate(arrays, 1):
+            dst.set_band_description(bidx, name)
+        blocks = composite_blocks(arrays, method=method, mask=mask,
+                                  block_shape=block_shape, njob=njob,
+                                  **kwargs)
+        for ((r0, r1), (c0, c1)), composites in blocks:
+            window = Window(c0, r0, c1 - c0, r1 - r0)
+            for bidx, name in enumerate(arrays, 1):
+                comp = composites[name]
+                if dtype.kind != 'f':
+                    comp = np.where(np.isnan(comp), nodata, comp)
+                dst.write(comp.astype(dtype), bidx, window=window)
+
+    return path
+
+
+def _get_method(method):
+    if callable(method):
+        return method
+    try:
+        return COMPOSITE_METHODS[method]
+    except KeyError:
+        raise KeyError('Unknown compositing method "{}". Available methods '
+                       'are: {}'.format(method,
+                                        ', '.join(COMPOSITE_METHODS)))
+
+
+def _reference(arrays):
+    """ Return the first array with any observations of its band
+    """
+    for arr in arrays.values():
+        if any(arr.sources):
+            return arr
+    return next(iter(arrays.values()))
+
+
+def _check_mask(mask):
+    """ Raise if a mask is given but none of its observations are indexed,
+    since every pixel would be masked
+    """
+    if mask is not None and len(mask) and not any(mask.sources):
+        raise ValueError('The mask band "{}" is not indexed for any '
+                         'observation. Composite without a mask instead'
+                         .format(mask.name))
+
+
+def _mask_clear(data, mask):
+    """ Return data with observations that are not clear set to NaN
+    """
+    if mask is None:
+        return data
+    cloudy = ~np.isin(mask, CFMASK_CLEAR)
+    out = OrderedDict()
+    for name, arr in data.items():
+        arr = arr.copy()
+        arr[cloudy] = np.nan
+        out[name] = arr
+    return out
+
+
+def _select(data, score):
+    """ Select, for each pixel, the observation with the lowest score
+
+    Pixels without any finite score are NaN.
+    """
+    idx = np.argmin(score, axis=0)
+    valid = np.isfinite(np.take_along_axis(score, idx[np.newaxis], 0)[0])
+    out = OrderedDict()
+    for name, arr in data.items():
+        sel = np.take_along_axis(arr, idx[np.newaxis], 0)[0]
+        out[name] = np.where(valid, sel, np.nan)
+    return out
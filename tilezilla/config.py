@@ -41,6 +41,9 @@ def parse_config(path):
     # Final parsing
     cfg = _parse_database(cfg)
     cfg = _parse_tilespec(cfg)
+    cfg = _parse_store(cfg)
+    cfg = _parse_targets(cfg)
+    cfg = _parse_products(cfg)
 
     return cfg
 
@@ -71,6 +74,79 @@ def _parse_tilespec(cfg):
     return cfg
 
 
+def _parse_store(cfg):
+    from .stores.geotiff import IMG_PATTERN
+    from .templates import ProductTemplate, TileTemplate
+
+    store = cfg['store']
+    store.setdefault('tile_imgpattern', IMG_PATTERN)
+    store.setdefault('co', {})
+    try:
+        store['tile_dirpattern'] = TileTemplate.compile(
+            store['tile_dirpattern'])
+        store['tile_imgpattern'] = ProductTemplate.compile(
+            store['tile_imgpattern'])
+        # Catch patterns that parse but don't format (e.g., bad format spec)
+        store['tile_dirpattern'].render(cfg['tilespec'][(0, 0)])
+    except (AttributeError, IndexError, KeyError, TypeError,
+            ValueError) as exc:
+        raise ConfigException('Invalid "store" pattern: {}'.format(exc))
+
+    return cfg
+
+
+def _parse_targets(cfg):
+    """ Parse the tile specifications and stores to ingest into
+
+    The "tilespec" and "store" sections are the first target, followed by
+    any "targets". Targets may override any parts of the "store" section.
+    """
+    targets = [{'tilespec': cfg['tilespec'], 'store': cfg['store']}]
+    for target in cfg.get('targets', []):
+        store = cfg['store'].copy()
+        store.update(target.get('store', {}))
+        targets.append(_parse_store(_parse_tilespec({
+            'tilespec': target['tilespec'],
+            'store': store
+        })))
+
+    descs, paths = set(), set()
+    for target in targets:
+        desc = target['tilespec'].desc
+        if desc in descs:
+            raise ConfigException('Each tile specification ingested into '
+                                  'must have a unique name ("{}" is used '
+                                  'more than once)'.format(desc))
+        descs.add(desc)
+        # Targets can share a store only if paths include the tilespec
+        dirpattern = target['store']['tile_dirpattern']
+        path = (target['store']['root'], dirpattern.pattern,
+                'tilespec' in dirpattern.names and desc)
+        if path in paths:
+            raise ConfigException(
+                'Tile specifications ingested into the same store "root" '
+                'must use different "tile_dirpattern", such as one '
+                'including "{tilespec.desc}"')
+        paths.add(path)
+
+    cfg['targets'] = targets
+    return cfg
+
+
+def _parse_products(cfg):
+    """ Check the bands derived for each product collection
+    """
+    from .derived import derived_bands
+
+    for collection, product_config in cfg.get('products', {}).items():
+        try:
+            derived_bands(product_config or {})
+        except (KeyError, ValueError) as exc:
+            raise ConfigException('Invalid "derived" band of product "{c}": '
+                                  '{e}'.format(c=collection, e=exc))
+    return cfg
+
+
 # UTIL
 def _expand_envvars(d):
     """ Recursively convert lookup that look like environment vars in a dict
@@ -71,3 +71,24 @@ class Band(object):
         """ rasterio.Band: The band from ``self.src`` opened with rasterio
         """
         return rasterio.band(self.src, self.bidx)
+
+    def masked(self, data):
+        """ Mask the fill value and values outside the valid range of data
+
+        Args:
+            data (np.ndarray): Data of this band
+
+        Returns:
+            np.ma.MaskedArray: ``data``, masked where equal to the fill value,
+                not finite, or outside of the valid range
+        """
+        mask = np.zeros(data.shape, dtype=bool)
+        if self.fill is not None and not np.isnan(self.fill):
+            mask |= data == self.fill
+        if data.dtype.kind == 'f':
+            mask |= ~np.isfinite(data)
+        if self.valid_min is not None:
+            mask |= data < self.valid_min
+        if self.valid_max is not None:
+            mask |= data > self.valid_max
+        return np.ma.array(data, mask=mask)
@@ -28,9 +28,13 @@ TODO:
     * http://sqlalchemy-utils.readthedocs.org/en/latest/aggregates.html
 """
 from ._tables import (TABLES,
-                      TableTileSpec, TableTile, TableProduct, TableBand)
+                      TableTileSpec, TableTile, TableScene, TableProduct,
+                      TableBandDefinition, TableBand, TableMetadata)
 from ._db import Database
 from ._queries import construct_filter, convert_query_type
+from ._records import (SceneRecord, DefinitionRecord, ProductRecord,
+                       BandRecord, scene_record, definition_record,
+                       product_record, band_record)
 from ._resources import DatacubeResource, DatasetResource
 
 
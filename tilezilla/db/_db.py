@@ -1,39 +1,110 @@
+from collections import OrderedDict
 from contextlib import contextmanager
+import datetime as dt
+import logging
+import math
 
 import sqlalchemy as sa
 
-from ._tables import (Base, TableTileSpec, TableTile,
-                      TableProduct, TableBand)
+from ._records import DEFINITION_FIELDS, DefinitionRecord
+from ._spatial import bounds_clause, create_rtree, has_rtree
+from ._tables import (TableTileSpec, TableTile, TableScene,
+                      TableProduct, TableBandDefinition, TableBand,
+                      TableMetadata)
+
+logger = logging.getLogger('tilezilla')
+
+# Number of tile indexes selected per query by :meth:`Database.ensure_tiles`
+_TILE_INDEX_CHUNK = 400
+
+#: OrderedDict: Pragmas set on each connection to SQLite databases, so that
+#: many processes may read while one writes (see :func:`set_sqlite_pragmas`)
+SQLITE_PRAGMAS = OrderedDict([
+    # Readers do not block the writer, and the writer does not block readers
+    ('journal_mode', 'WAL'),
+    # Wait for other writers (milliseconds), instead of "database is locked"
+    ('busy_timeout', 60000),
+    # Safe with WAL, and only syncs at checkpoints
+    ('synchronous', 'NORMAL'),
+    # Page cache of each connection (negative values are KiB)
+    ('cache_size', -65536),
+    ('temp_store', 'MEMORY')
+])
 
 
 class Database(object):
     """ The database connection
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+        session (sqlalchemy.orm.scoped_session): Database session
+        readonly (bool): True if this connection only reads from the
+            database (e.g., in ingest workers, see :meth:`connect`)
     """
 
-    def __init__(self, engine, session):
+    def __init__(self, engine, session, readonly=False):
         self.engine = engine
         self.session = session
+        self.readonly = readonly
+        #: bool: True if tile bounds are indexed using an SQLite R*Tree
+        self.rtree = (has_rtree(engine) if readonly else
+                      create_rtree(engine))
+        # IDs of band definitions, by their attributes
+        self._definitions = {}
 
     @classmethod
-    def connect(cls, uri, connect_args=None, debug=False):
+    def connect(cls, uri, connect_args=None, debug=False,
+                sqlite_pragmas=None, pool_size=None, readonly=False):
         """ Return a Database for a given URI
 
         Args:
             URI (str): Resource location
             connect_args (dict): Optional connection arguments
             debug (bool): Turn on sqlalchemy debug echo
+            sqlite_pragmas (dict): Pragmas set on each connection to SQLite
+                databases, overriding :attr:`SQLITE_PRAGMAS`. Pragmas set to
+                None are not set
+            pool_size (int): Number of connections kept open by each process
+                (default: that of the SQLAlchemy dialect)
+            readonly (bool): Only read from the database, which is not
+                created or upgraded if needed. Connections to SQLite
+                databases refuse to write (``PRAGMA query_only``)
 
         Returns:
             Database
         """
-        engine = sa.create_engine(uri, echo=debug, connect_args=connect_args)
-        Base.metadata.create_all(engine)
+        url = sa.engine.url.make_url(uri)
+        engine_kwargs = {}
+        if url.get_backend_name() == 'sqlite':
+            if url.database not in (None, '', ':memory:'):
+                # Reuse connections to files, instead of reconnecting and
+                # setting pragmas for each transaction
+                engine_kwargs['poolclass'] = sa.pool.QueuePool
+            else:
+                pool_size = None
+        if pool_size is not None:
+            engine_kwargs['pool_size'] = pool_size
+        engine = sa.create_engine(url, echo=debug,
+                                  connect_args=connect_args or {},
+                                  **engine_kwargs)
+        if engine.dialect.name == 'sqlite':
+            pragmas = SQLITE_PRAGMAS.copy()
+            pragmas.update(sqlite_pragmas or {})
+            if readonly:
+                pragmas['query_only'] = 'ON'
+            set_sqlite_pragmas(engine, pragmas)
+
+        from ._migrate import create_schema, needs_upgrade
+        if (needs_upgrade(engine) if readonly else create_schema(engine)):
+            logger.warning('Database "{}" was created by an earlier version '
+                           'and needs to be upgraded using "tilez db '
+                           'upgrade"'.format(engine.url))
         session = sa.orm.scoped_session(sa.orm.sessionmaker(bind=engine))
 
-        return cls(engine, session)
+        return cls(engine, session, readonly=readonly)
 
     @classmethod
-    def from_config(cls, config=None):
+    def from_config(cls, config=None, readonly=False):
         # http://docs.sqlalchemy.org/en/latest/core/engines.html#database-urls
         config = config or {}
         uri_config = {
@@ -50,7 +121,10 @@ class Database(object):
 
         return cls.connect(uri=sa.engine.url.URL(**uri_config),
                            connect_args=connect_args,
-                           debug=config.get('debug', False))
+                           debug=config.get('debug', False),
+                           sqlite_pragmas=config.get('sqlite_pragmas', None),
+                           pool_size=config.get('pool_size', None),
+                           readonly=readonly)
 
     def scope(self):
         """ Session as a context manager
@@ -101,22 +175,127 @@ class Database(object):
 
     def get_tile_by_tile_index(self, tilespec_id, storage, collection,
                                horizontal, vertical):
-        return (self.session.query(TableTile)
-                .filter_by(horizontal=horizontal,
-                           vertical=vertical,
-                           tilespec_id=tilespec_id).first())
+        query = (self.session.query(TableTile)
+                 .filter_by(horizontal=horizontal,
+                            vertical=vertical,
+                            tilespec_id=tilespec_id,
+                            storage=storage))
+        if collection is not None:
+            query = query.filter_by(collection=collection)
+        return query.order_by(TableTile.id).first()
+
+    def get_tiles(self, tilespec_id, storage=None, collection=None,
+                  key_range=None):
+        """ Return tiles in a tile specification
+
+        Args:
+            tilespec_id (int): ID of tile specification
+            storage (str): Return only tiles using this storage method
+            collection (str): Return only tiles of this product collection
+            key_range (tuple[int]): Return only tiles with a key within this
+                ``(start, stop)`` range, including ``start`` but not ``stop``
+
+        Returns:
+            list[TableTile]: Tiles, ordered by key, and then by vertical and
+                horizontal index
+        """
+        query = self.session.query(TableTile).filter_by(
+            tilespec_id=tilespec_id)
+        if storage is not None:
+            query = query.filter_by(storage=storage)
+        if collection is not None:
+            query = query.filter_by(collection=collection)
+        if key_range is not None:
+            query = query.filter(TableTile.key >= key_range[0],
+                                 TableTile.key < key_range[1])
+        return query.order_by(TableTile.key, TableTile.vertical,
+                              TableTile.horizontal).all()
+
+    def count_products_by_tile(self, tilespec_id, storage=None,
+                               collection=None):
+        """ Return the number of products in each tile, in one query
+
+        Args:
+            tilespec_id (int): ID of tile specification
+            storage (str): Count only tiles using this storage method
+            collection (str): Count only tiles of this product collection
+
+        Returns:
+            dict[tuple, int]: Number of products in each tile, keyed by tile
+                ``(vertical, horizontal)`` index, summed across collections
+        """
+        query = (self.session.query(TableTile.vertical, TableTile.horizontal,
+                                    sa.func.count(TableProduct.id))
+                 .outerjoin(TableProduct, TableProduct.tile_id == TableTile.id)
+                 .filter(TableTile.tilespec_id == tilespec_id))
+        if storage is not None:
+            query = query.filter(TableTile.storage == storage)
+        if collection is not None:
+            query = query.filter(TableTile.collection == collection)
+        query = query.group_by(TableTile.vertical, TableTile.horizontal)
+        return dict(((v, h), n) for v, h, n in query)
+
+    def tiles_intersecting(self, bounds=None, geometries=None, crs=None):
+        """ Return a clause selecting tiles intersecting bounds or geometries
+
+        Tiles are found using the spatial index of tile bounds within each
+        tile specification in the database. Tiles found for ``geometries``
+        are then tested against the geometries themselves.
+
+        Args:
+            bounds (BoundingBox): Bounds (left, bottom, right, top)
+            geometries (list[dict]): GeoJSON-like geometries
+            crs (str or CRS): Coordinate reference system of ``bounds`` or
+                ``geometries`` (default: that of each tile specification)
+
+        Returns:
+            sqlalchemy.sql.ClauseElement: A clause on :class:`TableTile`
+        """
+        import shapely.geometry
+        from rasterio.warp import transform_bounds, transform_geom
+
+        clauses = []
+        for spec in self.session.query(TableTileSpec):
+            if geometries is not None:
+                geoms = geometries if not crs else [
+                    transform_geom(crs, spec.crs, geom)
+                    for geom in geometries]
+                geoms = [shapely.geometry.shape(geom) for geom in geoms]
+                _bounds = [geom.bounds for geom in geoms if not geom.is_empty]
+            else:
+                _bounds = [bounds if not crs else
+                           transform_bounds(crs, spec.crs, *bounds)]
+            if not _bounds:
+                continue
+            clause = sa.or_(*[bounds_clause(b, self.rtree) for b in _bounds])
+            if geometries is not None:
+                candidates = (self.session
+                              .query(TableTile.id, TableTile.xmin,
+                                     TableTile.ymin, TableTile.xmax,
+                                     TableTile.ymax)
+                              .filter(TableTile.tilespec_id == spec.id)
+                              .filter(clause))
+                ids = [row[0] for row in candidates
+                       if any(geom.intersects(shapely.geometry.box(*row[1:]))
+                              for geom in geoms)]
+                clause = TableTile.id.in_(ids)
+            clauses.append(sa.and_(TableTile.tilespec_id == spec.id, clause))
+        return sa.or_(*clauses) if clauses else sa.false()
 
     def create_tile(self, tilespec_id, storage, collection,
-                    horizontal, vertical, bounds):
+                    horizontal, vertical, bounds, key=None):
+        xmin, ymin, xmax, ymax = bounds
         return TableTile(tilespec_id=tilespec_id,
                          storage=storage,
                          collection=collection,
                          horizontal=horizontal,
                          vertical=vertical,
-                         bounds=bounds)
+                         bounds=bounds,
+                         xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
+                         key=key)
 
     def ensure_tile(self, tilespec_id, storage, collection,
-                    horizontal, vertical, bounds):
+                    horizontal, vertical, bounds, key=None):
         tile = self.get_tile_by_tile_index(
             tilespec_id, storage, collection, horizontal, vertical)
         if not tile:
@@ -126,7 +305,8 @@ class Database(object):
                 collection=collection,
                 horizontal=horizontal,
                 vertical=vertical,
-                bounds=bounds)
+                bounds=bounds,
+                key=key)
             try:
                 with self.scope() as txn:
                     txn.add(tile)
@@ -137,6 +317,62 @@ class Database(object):
                     raise
         return tile
 
+    def ensure_tiles(self, tilespec_id, storage, collection, tiles):
+        """ Get or add many tiles to the database, adding all in one statement
+
+        Args:
+            tilespec_id (int): ID of tile specification
+            storage (str): Name of storage method
+            collection (str): Collection name
+            tiles (list[Tile]): Tiles of the tile specification
+
+        Returns:
+            list[int]: Database ID of each tile
+
+        Raises:
+            sqlalchemy.exc.IntegrityError: if the tiles missing cannot be
+                added
+        """
+        def _existing():
+            ids = {}
+            indexes = sorted(set((tile.horizontal, tile.vertical)
+                                 for tile in tiles))
+            # Select the exact (horizontal, vertical) pairs, a few at a time
+            # to stay within the number of parameters allowed
+            for i in range(0, len(indexes), _TILE_INDEX_CHUNK):
+                query = (self.session.query(TableTile.id,
+                                            TableTile.horizontal,
+                                            TableTile.vertical)
+                         .filter_by(tilespec_id=tilespec_id, storage=storage,
+                                    collection=collection)
+                         .filter(sa.or_(*[
+                             sa.and_(TableTile.horizontal == h,
+                                     TableTile.vertical == v)
+                             for h, v in indexes[i:i + _TILE_INDEX_CHUNK]])))
+                ids.update(((h, v), id_) for id_, h, v in query)
+            return ids
+
+        ids = _existing()
+        missing = OrderedDict(((tile.horizontal, tile.vertical), tile)
+                              for tile in tiles
+                              if (tile.horizontal, tile.vertical) not in ids)
+        if missing:
+            # Only one process writes tiles (see ``tilez ingest``), so any
+            # error adding them is a real error
+            with self.scope() as txn:
+                txn.execute(TableTile.__table__.insert(), [
+                    dict(tilespec_id=tilespec_id, storage=storage,
+                         collection=collection,
+                         horizontal=tile.horizontal,
+                         vertical=tile.vertical,
+                         bounds=list(tile.bounds), key=tile.key,
+                         xmin=tile.bounds[0], ymin=tile.bounds[1],
+                         xmax=tile.bounds[2], ymax=tile.bounds[3])
+                    for tile in missing.values()
+                ])
+            ids = _existing()
+        return [ids[(tile.horizontal, tile.vertical)] for tile in tiles]
+
 # PRODUCTS
     def get_product(self, id_):
         return self.session.query(TableProduct).filter_by(id=id_).first()
@@ -150,30 +386,225 @@ class Database(object):
         return (self.session.query(TableProduct)
                 .filter_by(timeseries_id=name).all())
 
+    def get_products_by_tile(self, tile_id, start=None, end=None):
+        """ Return products in a tile, optionally within a time range
+
+        Args:
+            tile_id (int): ID of tile containing products
+            start (datetime or Arrow): Return products acquired on or after
+                this date (default: None)
+            end (datetime or Arrow): Return products acquired on or before
+                this date (default: None)
+
+        Returns:
+            list[TableProduct]: Products, ordered by acquisition date
+        """
+        query = self.session.query(TableProduct).filter_by(tile_id=tile_id)
+        if start is not None:
+            query = query.filter(TableProduct.acquired >= start)
+        if end is not None:
+            query = query.filter(TableProduct.acquired <= end)
+        return query.order_by(TableProduct.acquired).all()
+
     def create_product(self, product):
+        """ :class:`BaseProduct` to :class:`TableProduct` without a `tile_id`
+        or `scene_id`
+
+        Args:
+            product (BaseProduct): A product
+
+        Returns:
+            TableProduct: The product, not yet added to the database
+        """
         return TableProduct(
             timeseries_id=product.timeseries_id,
-            platform=product.platform,
-            instrument=product.instrument,
             acquired=product.acquired,
-            processed=product.processed,
-            metadata_=getattr(product, 'metadata', {}),
-            metadata_files_=getattr(product, 'metadata_files', {})
+            metadata_files_=dict(getattr(product, 'metadata_files', {}))
         )
 
-    def ensure_product(self, tile_id, product):
+    def get_incomplete_products(self, n_bands, tile_ids=None):
+        """ Return products with fewer than some number of bands
+
+        Products are found by their number of bands (``n_bands``), which
+        is indexed, instead of by counting their bands.
+
+        Args:
+            n_bands (int): Number of bands of a complete product
+            tile_ids (iterable[int]): Return only products in these tiles
+
+        Returns:
+            list[TableProduct]: Products missing bands, ordered by tile and
+                acquisition date
+        """
+        query = self.session.query(TableProduct).filter(
+            TableProduct.n_bands < n_bands)
+        if tile_ids is not None:
+            query = query.filter(TableProduct.tile_id.in_(list(tile_ids)))
+        return query.order_by(TableProduct.tile_id,
+                              TableProduct.acquired).all()
+
+    def index_product(self, product, bands):
+        """ Add or update a product within a tile, and its bands
+
+        The product and its bands are written in one transaction, and the
+        product's number of bands is updated.
+
+        Args:
+            product (TableProduct): A product, with a `tile_id` and a
+                `scene_id`
+            bands (list[TableBand]): Bands of the product, with a
+                `definition_id`
+
+        Returns:
+            tuple[TableProduct, list[TableBand]]: The product and bands, as
+                added to the database
+        """
+        with self.scope() as txn:
+            if product.id:
+                product = txn.merge(product)
+            else:
+                txn.add(product)
+            txn.flush()
+            added = []
+            for band in bands:
+                band.product_id = product.id
+                if band.id:
+                    band = txn.merge(band)
+                else:
+                    txn.add(band)
+                added.append(band)
+            txn.flush()
+            self._update_band_count(txn, [product.id])
+        return product, added
+
+    def index_records(self, scene, definitions, records):
+        """ Add or update products within tiles, and their bands, in bulk
+
+        Unlike :meth:`index_product`, the products and bands of many tiles
+        are written from records (see :mod:`tilezilla.db._records`) using a
+        few statements in one transaction, without ORM objects. The scene of
+        the products and the definitions of their bands are added if needed.
+        Records of products and bands with an `id` update the product or
+        band, and others are added.
+
+        Args:
+            scene (SceneRecord): The scene of the products
+            definitions (list[DefinitionRecord]): Definitions of the bands
+                added
+            records (list[tuple[int, ProductRecord, list[BandRecord]]]): The
+                tile ID, product, and bands of each product
+
+        Returns:
+            tuple[list[int], list[int]]: IDs of the products and bands indexed
+        """
+        product, band = TableProduct.__table__, TableBand.__table__
+        now = dt.datetime.utcnow()
+        added_definitions = {}
+        with self.scope() as txn:
+            scene_id = self._index_scene(txn, scene)
+            definition_ids = {}
+            for definition in definitions:
+                key = _definition_key(definition._asdict())
+                if key not in self._definitions:
+                    added_definitions[key] = self._index_definition(
+                        txn, definition._asdict())
+                definition_ids[definition.standard_name] = (
+                    self._definitions.get(key) or added_definitions[key])
+
+            new, updated = [], []
+            for tile_id, product_, _ in records:
+                values = product_._asdict()
+                if product_.id is None:
+                    del values['id']
+                    values.update(tile_id=tile_id, scene_id=scene_id)
+                    new.append(values)
+                else:
+                    values.update(scene_id=scene_id, updated=now)
+                    updated.append(values)
+            _bulk_insert(txn, product, new)
+            _bulk_update(txn, product, updated)
+
+            # Find IDs of products added, by tile and name
+            keys = [(tile_id, product_.timeseries_id)
+                    for tile_id, product_, _ in records]
+            query = (sa.select([product.c.id, product.c.tile_id,
+                                product.c.timeseries_id])
+                     .where(product.c.tile_id.in_(set(k[0] for k in keys)))
+                     .where(product.c.timeseries_id.in_(
+                         set(k[1] for k in keys))))
+            ids = dict(((row.tile_id, row.timeseries_id), row.id)
+                       for row in txn.execute(query))
+            product_ids = [ids[key] for key in keys]
+
+            new, updated = [], []
+            for product_id, (_, _, bands) in zip(product_ids, records):
+                for band_ in bands:
+                    values = band_._asdict()
+                    # Bands updated may be redefined (e.g., on overwrite)
+                    values['definition_id'] = definition_ids[
+                        band_.standard_name]
+                    if band_.id is None:
+                        del values['id']
+                        values.update(product_id=product_id)
+                        new.append(values)
+                    else:
+                        values.update(updated=now)
+                        updated.append(values)
+            _bulk_insert(txn, band, new)
+            _bulk_update(txn, band, updated)
+
+            query = (sa.select([band.c.id, band.c.product_id,
+                                band.c.standard_name])
+                     .where(band.c.product_id.in_(product_ids)))
+            ids = dict(((row.product_id, row.standard_name), row.id)
+                       for row in txn.execute(query))
+            band_ids = [ids[(product_id, band_.standard_name)]
+                        for product_id, (_, _, bands) in zip(product_ids,
+                                                             records)
+                        for band_ in bands]
+            self._update_band_count(txn, product_ids)
+        # Remember definitions only once they are committed
+        self._definitions.update(added_definitions)
+        return product_ids, band_ids
+
+    def update_band_count(self, product_ids=None):
+        """ Update the number of bands of products by counting their bands
+
+        The number of bands is updated as bands are indexed by
+        :meth:`ensure_band`, :meth:`update_band`, and :meth:`index_product`,
+        so this is only needed after bands are added or removed otherwise.
+
+        Args:
+            product_ids (iterable[int]): Update only these products (default:
+                all products)
+        """
+        with self.scope() as txn:
+            self._update_band_count(
+                txn, None if product_ids is None else list(product_ids))
+
+    def _update_band_count(self, txn, product_ids):
+        txn.execute(band_count_update(product_ids))
+        for obj in txn.identity_map.values():
+            if isinstance(obj, TableProduct) and (
+                    product_ids is None or obj.id in product_ids):
+                txn.expire(obj, ['n_bands'])
+
+    def ensure_product(self, tile_id, product, metadata_keys=None):
         product_ = self.get_product_by_name(tile_id, product.timeseries_id)
         if not product_:
+            scene_id = self.ensure_scene(product, metadata_keys).id
             with self.scope() as txn:
                 product_ = self.create_product(product)
-                product.tile_id = tile_id
+                product_.tile_id = tile_id
+                product_.scene_id = scene_id
                 txn.add(product_)
         return product_
 
-    def update_product(self, tile_id, product):
+    def update_product(self, tile_id, product, metadata_keys=None):
         product_ = self.get_product_by_name(tile_id, product.timeseries_id)
         new_product = self.create_product(product)
         new_product.tile_id = tile_id
+        new_product.scene_id = self.ensure_scene(product, metadata_keys).id
         with self.scope() as txn:
             if product_:
                 new_product.id = product_.id
@@ -182,6 +613,96 @@ class Database(object):
                 txn.add(new_product)
         return new_product
 
+# SCENES
+    def get_scene_by_name(self, name, description):
+        return (self.session.query(TableScene)
+                .filter_by(timeseries_id=name, description=description)
+                .first())
+
+    def create_scene(self, product, metadata_keys=None):
+        """ :class:`BaseProduct` to :class:`TableScene`
+
+        Args:
+            product (BaseProduct): A product
+            metadata_keys (iterable[str]): Keys of the product's metadata to
+                index for searches (default: ``product.indexed_metadata``)
+
+        Returns:
+            TableScene: The scene, not yet added to the database
+        """
+        metadata = getattr(product, 'metadata', {})
+        if metadata_keys is None:
+            metadata_keys = getattr(product, 'indexed_metadata', ())
+        return TableScene(
+            timeseries_id=product.timeseries_id,
+            description=product.description,
+            platform=product.platform,
+            instrument=product.instrument,
+            processed=product.processed,
+            metadata_=metadata,
+            metadata_values=[self.create_metadata(key, metadata[key])
+                             for key in metadata_keys
+                             if metadata.get(key) is not None]
+        )
+
+    def ensure_scene(self, product, metadata_keys=None):
+        """ Get or add the scene of a product to the database
+
+        Args:
+            product (BaseProduct): A product
+            metadata_keys (iterable[str]): Keys of the product's metadata to
+                index for searches, if its scene is added (default:
+                ``product.indexed_metadata``)
+
+        Returns:
+            TableScene: The scene, as indexed
+        """
+        scene = self.get_scene_by_name(product.timeseries_id,
+                                       product.description)
+        if not scene:
+            scene = self.create_scene(product, metadata_keys=metadata_keys)
+            try:
+                with self.scope() as txn:
+                    txn.add(scene)
+            except sa.exc.IntegrityError:
+                scene = self.get_scene_by_name(product.timeseries_id,
+                                               product.description)
+                if not scene:
+                    raise
+        return scene
+
+    def _index_scene(self, txn, scene):
+        """ Return the ID of the scene of a :class:`SceneRecord`, adding the
+        scene and its metadata if needed
+        """
+        table = TableScene.__table__
+        id_ = txn.execute(
+            sa.select([table.c.id])
+            .where(table.c.timeseries_id == scene.timeseries_id)
+            .where(table.c.description == scene.description)).scalar()
+        if id_ is None:
+            values = scene._asdict()
+            metadata_values = values.pop('metadata_values')
+            id_ = txn.execute(table.insert(), values).inserted_primary_key[0]
+            _bulk_insert(txn, TableMetadata.__table__, [
+                dict(scene_id=id_, key=key, value=value, number=number)
+                for key, value, number in metadata_values])
+        return id_
+
+    def create_metadata(self, key, value):
+        """ Metadata to :class:`TableMetadata` without a `scene_id`
+
+        Args:
+            key (str): Metadata key
+            value (object): Metadata value
+
+        Returns:
+            TableMetadata: The metadata, with its value as a number if it
+                is numeric
+        """
+        return TableMetadata(key=key, value=str(value),
+                             number=_metadata_number(value))
+
 # BANDS
     def get_band(self, id_):
         return self.session.query(TableBand).filter_by(id=id_).first()
@@ -194,36 +715,170 @@ class Database(object):
     def ensure_band(self, product_id, band):
         band_ = self.get_band_by_name(product_id, band.standard_name)
         if not band_:
+            definition_id = self.ensure_band_definition(band)
             with self.scope() as txn:
-                band_ = self._create_band(band)
+                band_ = self.create_band(band)
                 band_.product_id = product_id
+                band_.definition_id = definition_id
                 txn.add(band_)
+                txn.flush()
+                self._update_band_count(txn, [product_id])
         return band_
 
     def update_band(self, product_id, band):
         band_ = self.get_band_by_name(product_id, band.standard_name)
         new_band = self.create_band(band)
         new_band.product_id = product_id
+        new_band.definition_id = self.ensure_band_definition(band)
         with self.scope() as txn:
             if band_:
                 new_band.id = band_.id
                 txn.merge(new_band)
             else:
                 txn.add(new_band)
+                txn.flush()
+                self._update_band_count(txn, [product_id])
         return new_band
 
     def create_band(self, band):
-        """ :class:`Band` to :class:`TableBand` without a `product_id`
+        """ :class:`Band` to :class:`TableBand` without a `product_id` or
+        `definition_id`
         """
         return TableBand(
             standard_name=band.standard_name,
             path=band.path,
-            bidx=band.bidx,
-            long_name=band.long_name,
-            friendly_name=band.friendly_name,
-            units=band.units,
-            fill=band.fill,
-            valid_min=band.valid_min,
-            valid_max=band.valid_max,
-            scale_factor=band.scale_factor
+            bidx=band.bidx
         )
+
+# BAND DEFINITIONS
+    def ensure_band_definition(self, band):
+        """ Get or add the definition of a band to the database
+
+        Args:
+            band (Band or DefinitionRecord): A band, or the record of its
+                definition
+
+        Returns:
+            int: Database ID of the band's definition
+        """
+        attrs = (band._asdict() if isinstance(band, DefinitionRecord) else
+                 _definition_attrs(band))
+        key = _definition_key(attrs)
+        if key not in self._definitions:
+            with self.scope() as txn:
+                id_ = self._index_definition(txn, attrs)
+            self._definitions[key] = id_
+        return self._definitions[key]
+
+    def _index_definition(self, txn, attrs):
+        """ Return the ID of a band definition, adding it if needed
+        """
+        table = TableBandDefinition.__table__
+        query = sa.select([table.c.id])
+        for name, value in attrs.items():
+            column = table.c[name]
+            query = query.where(column.is_(None) if value is None
+                                else column == value)
+        id_ = txn.execute(query.limit(1)).scalar()
+        if id_ is None:
+            id_ = txn.execute(table.insert(), attrs).inserted_primary_key[0]
+        return id_
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    """ Set pragmas on each new connection to an SQLite database
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Engine of an SQLite database
+        pragmas (dict): Values of pragmas, by name. Pragmas set to None are
+            not set
+    """
+    pragmas = [(name, value) for name, value in pragmas.items()
+               if value is not None]
+
+    @sa.event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+
+def band_count_update(product_ids=None):
+    """ Return a statement updating the number of bands of products
+
+    Args:
+        product_ids (list[int]): Update only these products (default: all
+            products)
+
+    Returns:
+        sqlalchemy.sql.Update: The statement
+    """
+    product, band = TableProduct.__table__, TableBand.__table__
+    count = (sa.select([sa.func.count(band.c.id)])
+             .where(band.c.product_id == product.c.id)
+             .as_scalar())
+    update = product.update().values(n_bands=count)
+    if product_ids is not None:
+        update = update.where(product.c.id.in_(product_ids))
+    return update
+
+
+def _bulk_insert(conn, table, rows):
+    """ Insert many rows, each with the same columns, in one statement
+    """
+    if rows:
+        conn.execute(table.insert(), rows)
+
+
+def _bulk_update(conn, table, rows):
+    """ Update many rows by their ``id``, each with the same columns
+    """
+    if rows:
+        names = [name for name in rows[0] if name != 'id']
+        update = (table.update()
+                  .where(table.c.id == sa.bindparam('_id'))
+                  .values(**dict((name, sa.bindparam('_' + name))
+                                 for name in names)))
+        conn.execute(update, [dict(('_' + name, value)
+                                   for name, value in row.items())
+                              for row in rows])
+
+
+def _metadata_number(value):
+    """ Return a metadata value as a number, or None if not numeric
+    """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isinf(number) or math.isnan(number):
+        return None
+    return number
+
+
+def _definition_key(attrs):
+    """ Return a hashable key of the attributes of a band definition
+    """
+    return tuple(attrs[name] for name in DEFINITION_FIELDS)
+
+
+def _definition_attrs(band):
+    """ Return the attributes of a band stored by its definition
+    """
+    def _number(value):
+        if value is None:
+            return None
+        value = float(value)
+        return None if math.isnan(value) else value
+
+    return {
+        'standard_name': band.standard_name,
+        'long_name': band.long_name,
+        'friendly_name': band.friendly_name,
+        'units': band.units,
+        'fill': _number(band.fill),
+        'valid_min': _number(band.valid_min),
+        'valid_max': _number(band.valid_max),
+        'scale_factor': _number(band.scale_factor)
+    }
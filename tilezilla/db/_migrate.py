@@ -0,0 +1,350 @@
+""" Versions of the database layout, and upgrades of earlier versions
+
+The version of the layout of a database is recorded in its
+``schema_version`` table when it is created or upgraded. Databases are
+upgraded in place, by ``tilez db upgrade``, within a single transaction,
+running each step after the database's version:
+
+1. ``tile_columns``: add the key and numeric bounds of each tile (see
+   :attr:`tilezilla.tilespec.Tile.key` and :mod:`tilezilla.db._spatial`)
+2. ``scenes``: move attributes shared by the tiles of a product to one row
+   per scene (:class:`TableScene`), and attributes shared by the files of a
+   band to one row per band definition (:class:`TableBandDefinition`),
+   instead of repeating them for every tile and band
+3. ``band_count``: add the number of bands of each product, counted once
+   instead of by every search
+4. ``indexes``: replace single column indexes with composite indexes
+   matching the lookups of tiles, products, and bands
+
+The versions of databases created before versions were recorded are
+inferred from their tables.
+"""
+from collections import OrderedDict
+import logging
+
+import numpy as np
+import sqlalchemy as sa
+import sqlalchemy_utils as sau
+
+from ._db import _metadata_number, band_count_update
+from ._spatial import create_rtree
+from ._tables import (Base, TableSchemaVersion, TableTile, TableScene,
+                      TableProduct, TableBandDefinition, TableBand,
+                      TableMetadata)
+
+logger = logging.getLogger('tilezilla')
+
+#: tuple: Columns of tiles added after tiles were first indexed
+TILE_COLUMNS = (('key', sa.BigInteger), ('xmin', sa.Float),
+                ('ymin', sa.Float), ('xmax', sa.Float), ('ymax', sa.Float))
+#: tuple: Indexes replaced by composite indexes
+OBSOLETE_INDEXES = (('tile', 'ix_tile_key'), ('band', 'ix_band_product_id'))
+# Tables of the layout before scenes, renamed while upgrading
+_OLD_TABLES = ('product', 'band', 'product_metadata')
+_OLD_SUFFIX = '_old'
+
+
+def schema_version(engine):
+    """ Return the version of the layout of a database
+
+    Args:
+        engine (sqlalchemy.engine.Engine or Connection): Database engine
+
+    Returns:
+        int: The version recorded, or inferred for databases created before
+            versions were recorded. None if the database has no tables
+    """
+    inspector = sa.inspect(engine)
+    tables = inspector.get_table_names()
+    if TableSchemaVersion.__tablename__ in tables:
+        version = engine.execute(
+            sa.select([sa.func.max(TableSchemaVersion.version)])).scalar()
+        if version is not None:
+            return version
+    if 'tile' not in tables:
+        return None
+
+    columns = [c['name'] for c in inspector.get_columns('tile')]
+    if any(name not in columns for name, _ in TILE_COLUMNS):
+        return 0
+    columns = [c['name'] for c in inspector.get_columns('product')]
+    if 'scene_id' not in columns:
+        return 1
+    if 'n_bands' not in columns:
+        return 2
+    return 3
+
+
+def create_schema(engine):
+    """ Create the tables of a database, and record the version of new ones
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        list[str]: Names of steps needed to upgrade an existing database,
+            which are empty if it is up to date
+    """
+    version = schema_version(engine)
+    Base.metadata.create_all(engine)
+    if version is None:
+        try:
+            _record_version(engine)
+        except sa.exc.IntegrityError:
+            # Recorded by another process creating the database
+            pass
+        return []
+    return _steps_after(version)
+
+
+def needs_upgrade(engine):
+    """ Return the steps needed to upgrade a database
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        list[str]: Names of steps needed, which are empty if the database
+            is up to date
+    """
+    version = schema_version(engine)
+    return [] if version is None else _steps_after(version)
+
+
+def upgrade(engine):
+    """ Upgrade a database to the current layout, in place
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        list[str]: Names of the steps performed
+    """
+    with engine.begin() as conn:
+        version = schema_version(conn)
+        if version is None:
+            return []
+        steps = _steps_after(version)
+        for step in steps:
+            logger.info('Upgrading database: {}'.format(step))
+            _STEPS[step](conn)
+        if steps:
+            Base.metadata.create_all(conn)
+            _record_version(conn)
+    if steps:
+        create_rtree(engine)
+    return steps
+
+
+def _steps_after(version):
+    return list(_STEP_ORDER[version:])
+
+
+def _record_version(engine):
+    engine.execute(TableSchemaVersion.__table__.insert().values(
+        version=SCHEMA_VERSION))
+
+
+def _create_missing_indexes(conn, table):
+    existing = [index['name'] for index in
+                sa.inspect(conn).get_indexes(table.name)]
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+# Steps
+def _upgrade_tile_columns(conn):
+    """ Add the key and numeric bounds of each tile
+    """
+    from ..tilespec import TILE_KEY_ORDER, TILE_KEY_ORDERS
+
+    columns = [c['name'] for c in sa.inspect(conn).get_columns('tile')]
+    for name, type_ in TILE_COLUMNS:
+        if name not in columns:
+            conn.execute('ALTER TABLE tile ADD COLUMN {name} {type}'.format(
+                name=conn.dialect.identifier_preparer.quote(name),
+                type=type_().compile(dialect=conn.dialect)))
+
+    tile = sa.table('tile', sa.column('id'),
+                    sa.column('horizontal'), sa.column('vertical'),
+                    sa.column('bounds', sau.ScalarListType(float)),
+                    *[sa.column(name) for name, _ in TILE_COLUMNS])
+    rows = conn.execute(sa.select([tile.c.id, tile.c.horizontal,
+                                   tile.c.vertical, tile.c.bounds])).fetchall()
+    if rows:
+        keys = TILE_KEY_ORDERS[TILE_KEY_ORDER](
+            np.array([row.horizontal for row in rows]),
+            np.array([row.vertical for row in rows]))
+        update = (tile.update()
+                  .where(tile.c.id == sa.bindparam('_id'))
+                  .values(**dict((name, sa.bindparam('_' + name))
+                                 for name, _ in TILE_COLUMNS)))
+        conn.execute(update, [
+            dict(_id=row.id, _key=int(key),
+                 _xmin=row.bounds[0], _ymin=row.bounds[1],
+                 _xmax=row.bounds[2], _ymax=row.bounds[3])
+            for row, key in zip(rows, keys)
+        ])
+    _create_missing_indexes(conn, TableTile.__table__)
+
+
+def _upgrade_scenes(conn):
+    """ Split products and bands into scenes and band definitions
+    """
+    if 'scene_id' in [c['name'] for c in
+                      sa.inspect(conn).get_columns('product')]:
+        return
+    # Set aside the tables of the old layout, and their indexes and
+    # constraints, whose names are used by the new tables
+    inspector = sa.inspect(conn)
+    tables = inspector.get_table_names()
+    old = {}
+    for name in _OLD_TABLES:
+        if name not in tables:
+            continue
+        for index in inspector.get_indexes(name):
+            if index.get('duplicates_constraint'):
+                continue
+            conn.execute('DROP INDEX {}'.format(index['name']))
+        if conn.dialect.name != 'sqlite':
+            for uc in inspector.get_unique_constraints(name):
+                conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'
+                             .format(name, uc['name']))
+        conn.execute('ALTER TABLE {0} RENAME TO {0}{1}'
+                     .format(name, _OLD_SUFFIX))
+        old[name] = sa.Table(name + _OLD_SUFFIX, sa.MetaData(),
+                             autoload=True, autoload_with=conn)
+    Base.metadata.create_all(conn)
+
+    tile = TableTile.__table__
+    scene = TableScene.__table__
+    product = TableProduct.__table__
+    definition = TableBandDefinition.__table__
+    band = TableBand.__table__
+    metadata = TableMetadata.__table__
+
+    # One scene per product (timeseries_id) and product type (collection),
+    # using the attributes of its first tile
+    old_product = old['product']
+    first = (sa.select([sa.func.min(old_product.c.id)])
+             .select_from(old_product.join(
+                 tile, old_product.c.tile_id == tile.c.id))
+             .group_by(old_product.c.timeseries_id, tile.c.collection))
+    columns = OrderedDict([
+        ('timeseries_id', old_product.c.timeseries_id),
+        ('description', tile.c.collection),
+        ('platform', old_product.c.platform),
+        ('instrument', old_product.c.instrument),
+        ('processed', old_product.c.processed),
+        ('metadata_', old_product.c.metadata_),
+        ('created', old_product.c.created),
+        ('updated', old_product.c.updated)
+    ])
+    conn.execute(scene.insert().from_select(
+        list(columns),
+        sa.select(list(columns.values()))
+        .select_from(old_product.join(
+            tile, old_product.c.tile_id == tile.c.id))
+        .where(old_product.c.id.in_(first))))
+
+    # Products keep their IDs, so bands keep referring to them
+    columns = OrderedDict(
+        (c.name, old_product.c[c.name]) for c in product.columns
+        if c.name in old_product.c)
+    columns['scene_id'] = scene.c.id
+    conn.execute(product.insert().from_select(
+        list(columns),
+        sa.select(list(columns.values()))
+        .select_from(old_product
+                     .join(tile, old_product.c.tile_id == tile.c.id)
+                     .join(scene, sa.and_(
+                         scene.c.timeseries_id == old_product.c.timeseries_id,
+                         scene.c.description == tile.c.collection)))))
+
+    # One definition per distinct set of band attributes
+    old_band = old['band']
+    attrs = [c.name for c in definition.columns if c.name != 'id']
+    conn.execute(definition.insert().from_select(
+        attrs, sa.select([old_band.c[name] for name in attrs]).distinct()))
+    columns = OrderedDict(
+        (c.name, old_band.c[c.name]) for c in band.columns
+        if c.name in old_band.c)
+    columns['definition_id'] = definition.c.id
+    conn.execute(band.insert().from_select(
+        list(columns),
+        sa.select(list(columns.values()))
+        .select_from(old_band.join(definition, sa.and_(*[
+            definition.c[name].isnot_distinct_from(old_band.c[name])
+            for name in attrs])))))
+    conn.execute(band_count_update())
+
+    # Metadata of scenes, from that indexed for products if available
+    if 'product_metadata' in old:
+        old_metadata = old['product_metadata']
+        conn.execute(metadata.insert().from_select(
+            ['scene_id', 'key', 'value', 'number'],
+            sa.select([product.c.scene_id, old_metadata.c.key,
+                       old_metadata.c.value, old_metadata.c.number])
+            .select_from(old_metadata.join(
+                product, old_metadata.c.product_id == product.c.id))
+            .distinct()))
+    else:
+        _index_scene_metadata(conn)
+
+    for name in reversed(_OLD_TABLES):
+        if name in old:
+            old[name].drop(conn)
+
+
+def _index_scene_metadata(conn):
+    """ Index the metadata of scenes that their product types index
+    """
+    from ..products import registry
+
+    scene = TableScene.__table__
+    rows = []
+    for row in conn.execute(sa.select([scene.c.id, scene.c.description,
+                                       scene.c.metadata_])):
+        product_class = registry.products.get(row.description)
+        metadata = row.metadata_ or {}
+        for key in getattr(product_class, 'indexed_metadata', ()):
+            if metadata.get(key) is not None:
+                value = metadata[key]
+                rows.append(dict(scene_id=row.id, key=key, value=str(value),
+                                 number=_metadata_number(value)))
+    if rows:
+        conn.execute(TableMetadata.__table__.insert(), rows)
+
+
+def _upgrade_band_count(conn):
+    """ Add and count the number of bands of each product
+    """
+    if 'n_bands' not in [c['name'] for c in
+                         sa.inspect(conn).get_columns('product')]:
+        conn.execute('ALTER TABLE product ADD COLUMN n_bands INTEGER '
+                     'NOT NULL DEFAULT 0')
+    conn.execute(band_count_update())
+    _create_missing_indexes(conn, TableProduct.__table__)
+
+
+def _upgrade_indexes(conn):
+    """ Replace single column indexes with composite indexes
+    """
+    inspector = sa.inspect(conn)
+    for table, name in OBSOLETE_INDEXES:
+        if name in [index['name'] for index in inspector.get_indexes(table)]:
+            conn.execute('DROP INDEX {}'.format(name))
+    for table in Base.metadata.sorted_tables:
+        _create_missing_indexes(conn, table)
+
+
+_STEPS = OrderedDict([
+    ('tile_columns', _upgrade_tile_columns),
+    ('scenes', _upgrade_scenes),
+    ('band_count', _upgrade_band_count),
+    ('indexes', _upgrade_indexes)
+])
+_STEP_ORDER = list(_STEPS)
+#: int: Version of the layout of databases created by this version
+SCHEMA_VERSION = len(_STEPS)
@@ -8,6 +8,7 @@ import arrow
 import six
 import sqlalchemy as sa
 import sqlalchemy_utils as sau
+from sqlalchemy.ext.associationproxy import AssociationProxyInstance
 
 from ._tables import TABLES
 
@@ -18,6 +19,8 @@ DATETIME_TYPES = (sa.sql.sqltypes.DateTime,
                   sau.ArrowType)
 
 COMPARATORS = ['eq', 'ne', 'le', 'lt', 'ge', 'gt', 'in', 'like']
+#: str: Prefix of filter keys of indexed scene metadata
+METADATA_PREFIX = 'metadata.'
 
 
 # Database linkages as graph ---------------------------------------------------
@@ -83,7 +86,7 @@ def _parse_expression_filter(expr):
     """
     # Parse operator
     for comp in COMPARATORS:
-        split = re.split('\s(?i)%s\s' % comp, expr)
+        split = re.split(r'\s%s\s' % comp, expr, flags=re.IGNORECASE)
         if len(split) == 2:
             return split[0].strip(), comp, split[1].lstrip()
     raise KeyError('Could not find a supported comparator in expression')
@@ -124,16 +127,50 @@ def convert_query_type(column, value):
     return sau.cast_if(value, type(column.type))
 
 
+def _is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _column_filter(column, key, operator, value):
+    """ Return a filter of a column for an operator and value(s)
+    """
+    if operator.lower() == 'in':
+        value = [convert_query_type(column, v) for v in
+                 value.replace(' ', ',').split(',') if v]
+        return column.in_(value)
+
+    attr = [pattern % operator for pattern in
+            ('%s', '%s_', '__%s__')
+            if hasattr(column, pattern % operator)]
+    if not attr:
+        raise KeyError('Cannot construct filter: column {} is not '
+                       'usable with "{}"'.format(key, operator))
+    if value.lower() in ('null', 'none', 'na', 'nan'):
+        value = None
+    else:
+        value = convert_query_type(column, value)
+    return getattr(column, attr[0])(value)
+
+
 # [FUNCTION]
 # The thing to write that uses above
-def construct_filter(query, items, conjunction='and'):
+def construct_filter(query, items, conjunction='and', tiles=None):
     """ Construct a filter from a combination of filter items
 
     Args:
         query (sqlalchemy.orm.query.Query): The SQLAlchemy SQL ORM object
         items (list[str]): List of query expressions in form of
-            "[KEY][OPERATOR][VALUE...]"
+            "[KEY][OPERATOR][VALUE...]". Keys of scene metadata indexed
+            in the database are used as "metadata.[KEY]", and are compared
+            numerically if the value is numeric
         conjunction (str): Combine the filter items using 'and' or 'or'
+        tiles (sqlalchemy.sql.ClauseElement): If given, also require that
+            rows belong to the tiles selected by this clause on the tile
+            table (e.g., from :meth:`Database.tiles_intersecting`)
 
     Returns:
         sqlalchemy.orm.query.Query: A query with filter items applied
@@ -142,7 +179,7 @@ def construct_filter(query, items, conjunction='and'):
         KeyError: Raise if column given in filter expression does not exist
     """
     # Find table model
-    entities = sau.get_query_entities(query)
+    entities = [desc['entity'] for desc in query.column_descriptions]
     if len(entities) > 1:
         logger.warning('Using first entity from search query ({})'
                        .format(entities[0]))
@@ -154,14 +191,37 @@ def construct_filter(query, items, conjunction='and'):
     exprs = [_parse_expression_filter(item) for item in items]
 
     filters = []
-    joins = set([])
+    joins = []  # in order of the path to each linked table
     for key, operator, value in exprs:
+        # Preprocess case of indexed scene metadata
+        if key.startswith(METADATA_PREFIX):
+            _scene = _tablename_to_class(base, 'scene')
+            _metadata = _tablename_to_class(base, 'scene_metadata')
+            if table is _scene:
+                scene_id = _scene.id
+            else:
+                _product = _tablename_to_class(base, 'product')
+                joins.extend([t for t in
+                              _link_path(TABLES_GRAPH, table, _product)
+                              if t is not table and t not in joins])
+                scene_id = _product.scene_id
+            values = (value.replace(' ', ',').split(',')
+                      if operator.lower() == 'in' else [value])
+            numeric = (operator.lower() != 'like' and
+                       all(_is_number(v) for v in values if v))
+            column = _metadata.number if numeric else _metadata.value
+            scenes = sa.select([_metadata.scene_id]).where(sa.and_(
+                _metadata.key == key[len(METADATA_PREFIX):],
+                _column_filter(column, key, operator, value)))
+            filters.append(scene_id.in_(scenes))
+            continue
+
         # Preprocess case of linked table
         if '.' in key:
             _tablename, key = key.split('.', maxsplit=1)
             _table = _tablename_to_class(base, _tablename)
-            joins.update([t for t in _link_path(TABLES_GRAPH, table, _table)
-                          if t is not table])
+            joins.extend([t for t in _link_path(TABLES_GRAPH, table, _table)
+                          if t is not table and t not in joins])
         else:
             _table = table
 
@@ -169,28 +229,25 @@ def construct_filter(query, items, conjunction='and'):
         if column is None:
             raise KeyError('Cannot construct filter: column "{}" does not '
                            'exist'.format(key))
-
-        if operator.lower() == 'in':
-            value = [convert_query_type(column, v) for v in
-                     value.replace(' ', ',').split(',') if v]
-            filter_item = column.in_(value)
-        else:
-            attr = [pattern % operator for pattern in
-                    ('%s', '%s_', '__%s__')
-                    if hasattr(column, pattern % operator)]
-            if not attr:
-                raise KeyError('Cannot construct filter: column {} is not '
-                               'usable with "{}"'.format(key, operator))
-            if value.lower() in ('null', 'none', 'na', 'nan'):
-                value = None
-            else:
-                value = convert_query_type(column, value)
-            filter_item = getattr(column, attr[0])(value)
-        filters.append(filter_item)
+        if isinstance(column, AssociationProxyInstance):
+            # Attribute of a related table (e.g., the scene of a product)
+            joins.extend([t for t in
+                          _link_path(TABLES_GRAPH, table, column.target_class)
+                          if t is not table and t not in joins])
+            column = getattr(column.target_class, column.value_attr)
+        filters.append(_column_filter(column, key, operator, value))
+
+    tile_table = _tablename_to_class(base, 'tile')
+    if tiles is not None:
+        joins.extend([t for t in _link_path(TABLES_GRAPH, table, tile_table)
+                      if t is not table and t not in joins])
 
     for join_table in joins:
         query = query.join(join_table)
     if conjunction == 'or':
-        return query.filter(sa.or_(*filters))
+        query = query.filter(sa.or_(*filters))
     else:
-        return query.filter(sa.and_(*filters))
+        query = query.filter(sa.and_(*filters))
+    if tiles is not None:
+        query = query.filter(tiles)
+    return query
@@ -0,0 +1,103 @@
+""" Records of scenes, products, and bands to index
+
+Records are plain tuples of column values, which are cheap to create, to
+send between processes, and to add to the database in bulk (see
+:meth:`tilezilla.db.Database.index_records`), unlike ORM objects.
+"""
+from collections import namedtuple
+
+from ..stats import BAND_STATISTICS, PRODUCT_STATISTICS
+
+#: tuple: Columns of :class:`TableScene` recorded, and its metadata indexed
+#: for searches (``metadata_values``, as ``(key, value, number)`` tuples)
+SCENE_FIELDS = ('timeseries_id', 'description', 'platform', 'instrument',
+                'processed', 'metadata_', 'metadata_values')
+#: tuple: Columns of :class:`TableBandDefinition` recorded
+DEFINITION_FIELDS = ('standard_name', 'long_name', 'friendly_name', 'units',
+                     'fill', 'valid_min', 'valid_max', 'scale_factor')
+#: tuple: Columns of :class:`TableProduct` recorded
+PRODUCT_FIELDS = (('id', 'timeseries_id', 'acquired', 'metadata_files_') +
+                  PRODUCT_STATISTICS)
+#: tuple: Columns of :class:`TableBand` recorded
+BAND_FIELDS = ('id', 'standard_name', 'path', 'bidx') + BAND_STATISTICS
+
+#: namedtuple: The scene of products
+SceneRecord = namedtuple('SceneRecord', SCENE_FIELDS)
+#: namedtuple: The definition of bands
+DefinitionRecord = namedtuple('DefinitionRecord', DEFINITION_FIELDS)
+#: namedtuple: A product within a tile, without a `tile_id` or `scene_id`.
+#: Products with an `id` are already indexed
+ProductRecord = namedtuple('ProductRecord', PRODUCT_FIELDS)
+#: namedtuple: A band of a product, without a `product_id` or
+#: `definition_id`. Bands with an `id` are already indexed
+BandRecord = namedtuple('BandRecord', BAND_FIELDS)
+
+
+def scene_record(product, metadata_keys=None):
+    """ Return the record of the scene of a product
+
+    Args:
+        product (BaseProduct): A product
+        metadata_keys (iterable[str]): Keys of the product's metadata to
+            index for searches (default: ``product.indexed_metadata``)
+
+    Returns:
+        SceneRecord: The record
+    """
+    from ._db import _metadata_number
+
+    metadata = dict(getattr(product, 'metadata', {}))
+    if metadata_keys is None:
+        metadata_keys = getattr(product, 'indexed_metadata', ())
+    return SceneRecord(
+        timeseries_id=product.timeseries_id,
+        description=product.description,
+        platform=product.platform,
+        instrument=product.instrument,
+        processed=product.processed,
+        metadata_=metadata,
+        metadata_values=tuple(
+            (key, str(metadata[key]), _metadata_number(metadata[key]))
+            for key in metadata_keys if metadata.get(key) is not None)
+    )
+
+
+def definition_record(band):
+    """ Return the record of the definition of a band
+
+    Args:
+        band (Band): A band
+
+    Returns:
+        DefinitionRecord: The record
+    """
+    from ._db import _definition_attrs
+    return DefinitionRecord(**_definition_attrs(band))
+
+
+def product_record(product=None, **fields):
+    """ Return the record of a product
+
+    Args:
+        product (TableProduct): A product already indexed, whose columns are
+            recorded (default: record a new product)
+        fields: Values of columns, overriding those of ``product``
+
+    Returns:
+        ProductRecord: The record
+    """
+    values = dict((name, getattr(product, name, None))
+                  for name in PRODUCT_FIELDS)
+    values.update(fields)
+    return ProductRecord(**values)
+
+
+def band_record(**fields):
+    """ Return the record of a band, with columns not given set to None
+
+    Returns:
+        BandRecord: The record
+    """
+    values = dict.fromkeys(BAND_FIELDS)
+    values.update(fields)
+    return BandRecord(**values)
@@ -1,7 +1,22 @@
 """ Logic for adding/editing/getting entries in tables
 """
 from ..core import Band, BoundingBox
-from ..products import registry as product_registry
+from ..products import DERIVED_PRODUCTS, registry as product_registry
+
+
+def _product_class(description):
+    """ Return the product type of scenes with a given description
+
+    Raises:
+        KeyError: Raise if the product type is not ingested by this package
+            or written by :func:`tilezilla.mapper.map_cube`
+    """
+    if description in DERIVED_PRODUCTS:
+        return DERIVED_PRODUCTS[description]
+    try:
+        return product_registry.products[description]
+    except KeyError:
+        raise KeyError('Unknown product type "{}"'.format(description))
 
 
 class DatacubeResource(object):
@@ -36,19 +51,74 @@ class DatacubeResource(object):
 
     def get_tile_by_tile_index(self, collection, horizontal, vertical):
         _tile = self.db.get_tile_by_tile_index(
-            self.tilespec_id, collection, self.storage,
+            self.tilespec_id, self.storage, collection,
             horizontal, vertical)
         if not _tile:
             return None
         return self._make_tile(_tile)
 
+    def get_tile_id(self, collection, horizontal, vertical):
+        """ Return the database ID of a tile, or None if not indexed
+        """
+        _tile = self.db.get_tile_by_tile_index(
+            self.tilespec_id, self.storage, collection,
+            horizontal, vertical)
+        return _tile.id if _tile else None
+
+    def get_tiles(self, collection=None, key_range=None):
+        """ Return the tiles indexed, optionally only for one collection
+
+        Tiles are returned in the order of their keys along a space-filling
+        curve, so tiles near each other are returned near each other.
+
+        Args:
+            collection (str): Return only tiles of this product collection
+            key_range (tuple[int]): Return only tiles with a key
+                (see :attr:`tilezilla.tilespec.Tile.key`) within this
+                ``(start, stop)`` range
+
+        Returns:
+            list[Tile]: Tiles indexed
+        """
+        return [self._make_tile(_tile) for _tile in
+                self.db.get_tiles(self.tilespec_id, self.storage, collection,
+                                  key_range=key_range)]
+
+    def count_products_by_tile(self, collection=None):
+        """ Return the number of products indexed in each tile
+
+        Args:
+            collection (str): Count only products of this collection
+
+        Returns:
+            dict[tuple, int]: Number of products in each tile, keyed by tile
+                ``(vertical, horizontal)`` index. Tiles not indexed are
+                not included
+        """
+        return self.db.count_products_by_tile(self.tilespec_id, self.storage,
+                                              collection)
+
     def ensure_tile(self, collection, horizontal, vertical):
-        bounds = self.tilespec[(vertical, horizontal)].bounds
+        tile = self.tilespec[(vertical, horizontal)]
 
         tile = self.db.ensure_tile(self.tilespec_id, self.storage,
-                                   collection, horizontal, vertical, bounds)
+                                   collection, horizontal, vertical,
+                                   tile.bounds, key=tile.key)
         return tile.id
 
+    def ensure_tiles(self, collection, tiles):
+        """ Get or add many tiles, adding all those missing at once
+
+        Args:
+            collection (str): Product collection name
+            tiles (list[Tile]): Tiles of the tile specification
+
+        Returns:
+            list[int]: Database ID of each tile
+        """
+        return self.db.ensure_tiles(self.tilespec_id, self.storage,
+                                    collection, tiles)
+
     def _make_tile(self, tile_query):
         return self.tilespec._index_to_tile((tile_query.vertical,
                                              tile_query.horizontal))
@@ -83,11 +153,21 @@ class DatasetResource(object):
         return [self._make_product(prod) for prod in
                 self.db.get_products_by_name(name)]
 
-    def get_products_by_tile(self, tile_id):
-        """ Get all products within a tile
+    def get_products_by_tile(self, tile_id, start=None, end=None):
+        """ Get all products within a tile, optionally within a time range
+
+        Args:
+            tile_id (int): ID of tile containing products
+            start (datetime or Arrow): Return products acquired on or after
+                this date (default: None)
+            end (datetime or Arrow): Return products acquired on or before
+                this date (default: None)
+
+        Returns:
+            list[BaseProduct]: Products, ordered by acquisition date
         """
         return [self._make_product(_prod) for _prod in
-                self.datacube.get_tile(tile_id).products]
+                self.db.get_products_by_tile(tile_id, start=start, end=end)]
 
     def ensure_product(self, tile_id, product):
         """ Add a product to index, creating if needed
@@ -98,7 +178,7 @@ class DatasetResource(object):
         return self.db.ensure_product(tile_id, product).id
 
     def _make_product(self, query):
-        product_class = product_registry.products[query.tile.collection]
+        product_class = _product_class(query.scene.description)
         bands = [self._make_band(b) for b in query.bands]
 
         return product_class(
@@ -0,0 +1,101 @@
+""" Spatial index of tiles, and searches by location
+"""
+import logging
+
+import sqlalchemy as sa
+
+from ._tables import TableTile
+
+logger = logging.getLogger('tilezilla')
+
+#: str: Name of the SQLite R*Tree virtual table indexing tile bounds
+RTREE_TABLE = 'tile_rtree'
+
+_RTREE_DDL = [
+    'CREATE VIRTUAL TABLE {rtree} USING rtree(id, xmin, xmax, ymin, ymax)',
+    # Keep index in sync with tiles
+    'CREATE TRIGGER {rtree}_insert AFTER INSERT ON tile '
+    'WHEN NEW.xmin IS NOT NULL BEGIN '
+    'INSERT OR REPLACE INTO {rtree} '
+    'VALUES (NEW.id, NEW.xmin, NEW.xmax, NEW.ymin, NEW.ymax); END',
+    'CREATE TRIGGER {rtree}_update AFTER UPDATE OF xmin, xmax, ymin, ymax '
+    'ON tile WHEN NEW.xmin IS NOT NULL BEGIN '
+    'INSERT OR REPLACE INTO {rtree} '
+    'VALUES (NEW.id, NEW.xmin, NEW.xmax, NEW.ymin, NEW.ymax); END',
+    'CREATE TRIGGER {rtree}_delete AFTER DELETE ON tile BEGIN '
+    'DELETE FROM {rtree} WHERE id = OLD.id; END',
+    # Index tiles that already exist
+    'INSERT INTO {rtree} SELECT id, xmin, xmax, ymin, ymax FROM tile '
+    'WHERE xmin IS NOT NULL'
+]
+_rtree = sa.table(RTREE_TABLE, *[sa.column(name) for name in
+                                 ('id', 'xmin', 'xmax', 'ymin', 'ymax')])
+
+
+def create_rtree(engine):
+    """ Create (if needed) the SQLite R*Tree index of tile bounds
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        bool: True if the database has an R*Tree index of tile bounds, which
+            is only possible for SQLite databases with the R*Tree module
+    """
+    if engine.dialect.name != 'sqlite':
+        return False
+    inspector = sa.inspect(engine)
+    if RTREE_TABLE in inspector.get_table_names():
+        return True
+    if 'xmin' not in [c['name'] for c in inspector.get_columns('tile')]:
+        # Database needs to be upgraded first
+        return False
+    try:
+        with engine.begin() as conn:
+            for ddl in _RTREE_DDL:
+                conn.execute(ddl.format(rtree=RTREE_TABLE))
+    except sa.exc.OperationalError as exc:
+        logger.debug('Not indexing tile bounds using R*Tree: {}'.format(exc))
+        return False
+    return True
+
+
+def has_rtree(engine):
+    """ Return True if the database has an R*Tree index of tile bounds
+
+    Unlike :func:`create_rtree`, the database is only read from.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): Database engine
+
+    Returns:
+        bool: True if the database has an R*Tree index of tile bounds
+    """
+    return (engine.dialect.name == 'sqlite' and
+            RTREE_TABLE in sa.inspect(engine).get_table_names())
+
+
+def bounds_clause(bounds, rtree=False):
+    """ Return a clause selecting tiles intersecting bounds
+
+    Tiles that only touch the edge of the bounds intersect them (see
+    :func:`tilezilla.geoutils.intersects_bounds`).
+
+    Args:
+        bounds (BoundingBox): Bounds (left, bottom, right, top) in the
+            CRS of the tiles
+        rtree (bool): Find candidate tiles using the R*Tree index
+
+    Returns:
+        sqlalchemy.sql.ClauseElement: A clause on :class:`TableTile`
+    """
+    left, bottom, right, top = [float(b) for b in bounds]
+    clause = sa.and_(TableTile.xmin <= right, TableTile.xmax >= left,
+                     TableTile.ymin <= top, TableTile.ymax >= bottom)
+    if rtree:
+        # R*Tree bounds are rounded outwards, so check the columns as well
+        candidates = sa.select([_rtree.c.id]).where(sa.and_(
+            _rtree.c.xmin <= right, _rtree.c.xmax >= left,
+            _rtree.c.ymin <= top, _rtree.c.ymax >= bottom))
+        clause = sa.and_(TableTile.id.in_(candidates), clause)
+    return clause
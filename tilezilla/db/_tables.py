@@ -1,7 +1,10 @@
 """ Table definitions
 """
+from datetime import datetime
+
 import sqlalchemy as sa
 import sqlalchemy_utils as sau
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -36,6 +39,13 @@ class TableTile(Base):
         sa.UniqueConstraint('horizontal', 'vertical', 'tilespec_id',
                             'storage', 'collection',
                             name='_tilespec_tile_uc'),
+        # Search by bounds (see also the SQLite R*Tree index, "tile_rtree")
+        sa.Index('ix_tile_bounds', 'tilespec_id', 'xmin', 'xmax',
+                 'ymin', 'ymax'),
+        # Find tiles by index, or by key along a space-filling curve
+        sa.Index('ix_tile_tilespec_index', 'tilespec_id', 'horizontal',
+                 'vertical'),
+        sa.Index('ix_tile_tilespec_key', 'tilespec_id', 'key'),
     )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
@@ -49,20 +59,69 @@ class TableTile(Base):
     horizontal = sa.Column(sa.Integer, index=True)
     #: int: Vertical index of tile in tile specification
     vertical = sa.Column(sa.Integer, index=True)
-    #: BoundingBox: Bounds of tile in EPSG:4326
+    #: int: Key of tile along a space-filling curve
+    #: (see :meth:`tilezilla.tilespec.TileSpec.tile_keys`)
+    key = sa.Column(sa.BigInteger)
+    #: BoundingBox: Bounds of tile in the CRS of its tile specification
     bounds = sa.Column(sau.ScalarListType(float), nullable=False)
+    #: float: Bounds of tile, as numeric columns that can be indexed
+    xmin = sa.Column(sa.Float)
+    ymin = sa.Column(sa.Float)
+    xmax = sa.Column(sa.Float)
+    ymax = sa.Column(sa.Float)
     # Reference to product collections stored within this tile
     products = sa.orm.relationship('TableProduct', backref='tile')
 
 
+class TableScene(Base, sau.Timestamp):
+    """ SQL representation of a product acquisition, shared by its tiles
+
+    Attributes of a product that do not depend on the tile (e.g., its
+    metadata) are stored once per scene, instead of once per tile.
+    """
+    __tablename__ = 'scene'
+    __table_args__ = (
+        # Allow only one scene (timeseries_id) per type of product
+        sa.UniqueConstraint('timeseries_id', 'description',
+                            name='_scene_id_description_uc'),
+    )
+
+    def __repr__(self):
+        return ("<Scene(timeseries_id={0.timeseries_id}, "
+                "description={0.description})>".format(self))
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    timeseries_id = sa.Column(sa.String, nullable=False)
+    #: str: Description of the product type (e.g., ESPALandsat)
+    description = sa.Column(sa.String, nullable=False)
+    platform = sa.Column(sa.String, nullable=False)
+    instrument = sa.Column(sa.String, nullable=False)
+    processed = sa.Column(sau.ArrowType, nullable=False)
+
+    metadata_ = sa.Column(sau.JSONType, default={})
+
+    # Reference to metadata indexed for searches
+    metadata_values = sa.orm.relationship('TableMetadata',
+                                          backref='scene',
+                                          cascade='all, delete-orphan')
+    # Reference to the products of each tile
+    products = sa.orm.relationship('TableProduct', backref=sa.orm.backref(
+        'scene', lazy='joined'))
+
+
 class TableProduct(Base, sau.Timestamp):
-    """ SQL representation of dataset products
+    """ SQL representation of dataset products within a tile
+
+    Attributes of the product's scene (``platform``, ``instrument``,
+    ``processed``, and ``metadata_``) are available from the product.
     """
     __tablename__ = 'product'
     __table_args__ = (
         # Allow only one observation (timeseries_id) per tile
         sa.UniqueConstraint('tile_id', 'timeseries_id',
                             name='_tile_store_collection_id_uc'),
+        # Find products in a tile within a time range
+        sa.Index('ix_product_tile_acquired', 'tile_id', 'acquired'),
     )
 
     def __repr__(self):
@@ -77,36 +136,82 @@ class TableProduct(Base, sau.Timestamp):
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     #: int: Reference to tile containing product
     tile_id = sa.Column(sa.ForeignKey(TableTile.id), nullable=False)
+    #: int: Reference to scene of product
+    scene_id = sa.Column(sa.ForeignKey(TableScene.id), index=True,
+                         nullable=False)
 
     timeseries_id = sa.Column(sa.String, index=True, nullable=False)
-    platform = sa.Column(sa.String, nullable=False)
-    instrument = sa.Column(sa.String, nullable=False)
+    # Kept with each tile's product for searches by tile and time
     acquired = sa.Column(sau.ArrowType, nullable=False, index=True)
-    processed = sa.Column(sau.ArrowType, nullable=False)
 
-    metadata_ = sa.Column(sau.JSONType, default={})
+    #: dict: Paths of metadata files copied into the tile
     metadata_files_ = sa.Column(sau.JSONType, default={})
 
+    #: int: Number of bands, kept up to date as bands are indexed
+    #: (see :meth:`tilezilla.db.Database.update_band_count`)
+    n_bands = sa.Column(sa.Integer, index=True, nullable=False, default=0,
+                        server_default='0')
+
+    # Fractions of the tile's pixels of each ``cfmask`` class
+    # (see :mod:`tilezilla.stats`)
+    clear_fraction = sa.Column(sa.Float, index=True)
+    water_fraction = sa.Column(sa.Float, index=True)
+    shadow_fraction = sa.Column(sa.Float, index=True)
+    snow_fraction = sa.Column(sa.Float, index=True)
+    cloud_fraction = sa.Column(sa.Float, index=True)
+
     # Reference to individual band observations
     bands = sa.orm.relationship('TableBand', backref='product')
 
-    @sa.ext.hybrid.hybrid_property
-    def n_bands(self):
-        return len(self.bands)
-
-    @n_bands.expression
-    def n_bands(cls):
-        return (sa.select([sa.func.count(TableBand.id)]).
-                where(TableBand.product_id == cls.id).
-                label('n_bands'))
+    # Attributes of scene
+    platform = association_proxy('scene', 'platform')
+    instrument = association_proxy('scene', 'instrument')
+    processed = association_proxy('scene', 'processed')
+    metadata_ = association_proxy('scene', 'metadata_')
 
     __mapper_args__ = {
         'order_by': acquired
     }
 
 
+class TableBandDefinition(Base):
+    """ SQL representation of the attributes of a band, shared by its files
+    """
+    __tablename__ = 'band_definition'
+
+    def __repr__(self):
+        return ("<BandDefinition(standard_name={0.standard_name}, "
+                "units={0.units}, fill={0.fill}, "
+                "range=({0.valid_min}, {0.valid_max}))>".format(self))
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    standard_name = sa.Column(sa.String, index=True, nullable=False)
+    long_name = sa.Column(sa.String, nullable=False)
+    friendly_name = sa.Column(sa.String, nullable=False)
+    units = sa.Column(sa.String, nullable=False)
+    fill = sa.Column(sa.Float)  # fill can be None
+    valid_min = sa.Column(sa.Float, nullable=False)
+    valid_max = sa.Column(sa.Float, nullable=False)
+    scale_factor = sa.Column(sa.Float)
+
+    # Reference to the files of this band
+    bands = sa.orm.relationship('TableBand', backref=sa.orm.backref(
+        'definition', lazy='joined'))
+
+
 class TableBand(Base, sau.Timestamp):
+    """ SQL representation of the file of a band of a product in a tile
+
+    Attributes of the band's definition (``long_name``, ``friendly_name``,
+    ``units``, ``fill``, ``valid_min``, ``valid_max``, and ``scale_factor``)
+    are available from the band.
+    """
     __tablename__ = 'band'
+    __table_args__ = (
+        # Find bands of a product by name
+        sa.Index('ix_band_product_standard_name', 'product_id',
+                 'standard_name'),
+    )
 
     def __repr__(self):
         product = ('Product' if not getattr(self, 'product', None)
@@ -121,24 +226,76 @@ class TableBand(Base, sau.Timestamp):
         )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
-    product_id = sa.Column(sa.ForeignKey(TableProduct.id),
-                           index=True, nullable=False)
+    product_id = sa.Column(sa.ForeignKey(TableProduct.id), nullable=False)
+    definition_id = sa.Column(sa.ForeignKey(TableBandDefinition.id),
+                              nullable=False)
 
     path = sa.Column(sa.String, nullable=False)
     bidx = sa.Column(sa.Integer, nullable=False)
+    # Kept with each band for searches by name
     standard_name = sa.Column(sa.String, index=True, nullable=False)
-    long_name = sa.Column(sa.String, nullable=False)
-    friendly_name = sa.Column(sa.String, nullable=False)
-    units = sa.Column(sa.String, nullable=False)
-    fill = sa.Column(sa.Float)  # fill can be None
-    valid_min = sa.Column(sa.Float, nullable=False)
-    valid_max = sa.Column(sa.Float, nullable=False)
-    scale_factor = sa.Column(sa.Float)
+
+    # Statistics of the band's data within the tile
+    # (see :mod:`tilezilla.stats`)
+    valid_fraction = sa.Column(sa.Float, index=True)
+    data_min = sa.Column(sa.Float, index=True)
+    data_max = sa.Column(sa.Float, index=True)
+    data_mean = sa.Column(sa.Float, index=True)
+
+    # Attributes of definition
+    long_name = association_proxy('definition', 'long_name')
+    friendly_name = association_proxy('definition', 'friendly_name')
+    units = association_proxy('definition', 'units')
+    fill = association_proxy('definition', 'fill')
+    valid_min = association_proxy('definition', 'valid_min')
+    valid_max = association_proxy('definition', 'valid_max')
+    scale_factor = association_proxy('definition', 'scale_factor')
+
+
+class TableMetadata(Base):
+    """ Scene metadata indexed for searches, one row per key
+
+    Values are stored as text and, if numeric, as numbers so that they
+    may be compared numerically (see :func:`tilezilla.db.construct_filter`).
+    """
+    __tablename__ = 'scene_metadata'
+    __table_args__ = (
+        sa.Index('ix_scene_metadata_number', 'key', 'number'),
+        sa.Index('ix_scene_metadata_value', 'key', 'value'),
+    )
+
+    def __repr__(self):
+        return ("<Metadata(scene_id={0.scene_id}, "
+                "{0.key}={0.value})>".format(self))
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    scene_id = sa.Column(sa.ForeignKey(TableScene.id),
+                         index=True, nullable=False)
+    key = sa.Column(sa.String, nullable=False)
+    #: str: Value, as text
+    value = sa.Column(sa.String)
+    #: float: Value, if numeric
+    number = sa.Column(sa.Float)
+
+
+class TableSchemaVersion(Base):
+    """ Versions of the layout of the database, one row per upgrade
+
+    See :mod:`tilezilla.db._migrate`.
+    """
+    __tablename__ = 'schema_version'
+
+    version = sa.Column(sa.Integer, primary_key=True, autoincrement=False)
+    upgraded = sa.Column(sa.DateTime, default=datetime.utcnow,
+                         nullable=False)
 
 
 TABLES = {
     'tilespec': TableTileSpec,
     'tile': TableTile,
+    'scene': TableScene,
     'product': TableProduct,
-    'band': TableBand
+    'band_definition': TableBandDefinition,
+    'band': TableBand,
+    'scene_metadata': TableMetadata
 }
@@ -0,0 +1,217 @@
+""" Bands derived from other bands of a product while it is ingested
+
+Derived bands (e.g., NDVI or a cloud mask) are declared for a product
+collection within the ``derived`` section of the product's configuration,
+by the name of the derived band:
+
+.. code-block:: yaml
+
+    products:
+        ESPALandsat:
+            derived:
+                ndvi:
+                    function: normalized_difference
+                    bands: [sr_band4, sr_band3]
+                cloud:
+                    function: cloud_mask
+                    bands: [cfmask]
+
+Derived bands are computed from the arrays of their input bands that are
+already read while ingesting a product, so their input bands are not read
+again. They are tiled and indexed like any other band of the product.
+
+Functions are called as ``function(*data, **kwargs)``, where ``data`` are
+masked arrays of each input band, in order, with fill values and values
+outside of the band's valid range masked. Functions return a masked array of
+the derived band in physical units. Derived bands are scaled by the inverse
+of their ``scale_factor`` (e.g., a ``scale_factor`` of 0.0001 stores NDVI of
+0.5 as 5000), and masked pixels are stored as the fill value.
+"""
+import numpy as np
+import six
+
+from .core import Band
+
+#: tuple: ``cfmask`` values of cloud shadow and cloud pixels
+CFMASK_CLOUD = (2, 4)
+
+
+# Functions
+def normalized_difference(a, b):
+    """ Normalized difference of two bands, ``(a - b) / (a + b)``
+
+    For example, NDVI is the normalized difference of the near infrared
+    and red bands, and NBR is the normalized difference of the near infrared
+    and the second shortwave infrared bands.
+
+    Args:
+        a (np.ma.MaskedArray): First band
+        b (np.ma.MaskedArray): Second band
+
+    Returns:
+        np.ma.MaskedArray: Normalized difference, masked where either band
+            is masked or where the bands sum to zero
+    """
+    a = a.astype(np.float32)
+    b = b.astype(np.float32)
+    total = a + b
+    total = np.ma.masked_equal(total, 0)
+    return (a - b) / total
+
+
+def cloud_mask(cfmask, values=CFMASK_CLOUD):
+    """ Mask of clouds (1) and other observations (0) from ``cfmask``
+
+    Args:
+        cfmask (np.ma.MaskedArray): ``cfmask`` band
+        values (iterable[int]): ``cfmask`` values masked as cloud (default:
+            cloud shadow and cloud)
+
+    Returns:
+        np.ma.MaskedArray: Cloud mask, masked where ``cfmask`` is masked
+    """
+    mask = np.isin(cfmask.data, list(values))
+    return np.ma.array(mask.astype(np.uint8), mask=np.ma.getmask(cfmask))
+
+
+#: dict: Functions usable by derived bands, and the default attributes
+#: of the bands they derive
+DERIVED_FUNCTIONS = {
+    'normalized_difference': (normalized_difference, {
+        'dtype': 'int16',
+        'fill': -9999,
+        'scale_factor': 0.0001,
+        'valid_min': -10000,
+        'valid_max': 10000,
+        'units': 'normalized difference'
+    }),
+    'cloud_mask': (cloud_mask, {
+        'dtype': 'uint8',
+        'fill': 255,
+        'scale_factor': 1,
+        'valid_min': 0,
+        'valid_max': 1,
+        'units': 'mask'
+    })
+}
+
+
+class DerivedBand(Band):
+    """ A band computed from other bands of a product
+
+    Derived bands have no path until tiled. Their source is set by
+    :meth:`compute` to describe the array they are computed as.
+
+    Args:
+        standard_name (str): Standard name of the derived band
+        function (str): Name of function in :attr:`DERIVED_FUNCTIONS`
+        bands (list[str]): ``standard_name`` of bands passed to
+            ``function``, in order
+        kwargs (dict): Additional keyword arguments passed to ``function``
+        dtype (str or np.dtype): Datatype of the derived band (default:
+            depends on ``function``)
+        band_kwargs: Other attributes of the band (e.g., ``long_name``,
+            ``fill``, or ``scale_factor``), overriding the defaults of
+            ``function``
+
+    Raises:
+        KeyError: if ``function`` is not known
+        ValueError: if not given any ``bands``
+    """
+    def __init__(self, standard_name, function, bands, kwargs=None,
+                 dtype=None, **band_kwargs):
+        if function not in DERIVED_FUNCTIONS:
+            raise KeyError('Unknown function "{f}" for derived band "{n}" '
+                           '(functions available are: {a})'
+                           .format(f=function, n=standard_name,
+                                   a=', '.join(sorted(DERIVED_FUNCTIONS))))
+        if not bands:
+            raise ValueError('Derived band "{}" requires input bands'
+                             .format(standard_name))
+        func, defaults = DERIVED_FUNCTIONS[function]
+        attrs = dict(defaults, long_name=standard_name,
+                     friendly_name=standard_name)
+        attrs.update(band_kwargs)
+        dtype = np.dtype(dtype or attrs.pop('dtype'))
+        attrs.pop('dtype', None)
+
+        super(DerivedBand, self).__init__(None, 1,
+                                          standard_name=standard_name,
+                                          **attrs)
+        self.function = function
+        self.func = func
+        self.bands = list(bands)
+        self.kwargs = kwargs or {}
+        self.dtype = dtype
+
+    @classmethod
+    def from_config(cls, standard_name, config):
+        """ Return a derived band from its entry in a configuration file
+
+        Args:
+            standard_name (str): Name of the derived band
+            config (dict): Options of the band from the ``derived`` section
+                of a product collection's configuration
+
+        Returns:
+            DerivedBand: The derived band
+        """
+        config = config.copy()
+        return cls(standard_name, config.pop('function'),
+                   config.pop('bands', None), **config)
+
+    def compute(self, data, bands, transform, crs):
+        """ Compute the derived band from the data of its input bands
+
+        Args:
+            data (dict[str, np.ndarray]): Data of each input band, by
+                ``standard_name``, aligned to the same grid
+            bands (dict[str, Band]): Each input band, by ``standard_name``
+            transform (affine.Affine): Affine transform of the data
+            crs (CRS): Coordinate reference system of the data
+
+        Returns:
+            np.ndarray: The derived band, as stored
+        """
+        inputs = [bands[name].masked(data[name]) for name in self.bands]
+        result = np.ma.asarray(self.func(*inputs, **self.kwargs))
+        if self.scale_factor not in (None, 1):
+            result = result / self.scale_factor
+        if self.dtype.kind in 'iu' and result.dtype.kind == 'f':
+            result = np.ma.round(result)
+        result = result.filled(self.fill).astype(self.dtype)
+
+        self.src = _ArraySource(result, transform, crs, self.fill)
+        return result
+
+
+def derived_bands(product_config):
+    """ Return the derived bands declared for a product collection
+
+    Args:
+        product_config (dict): Configuration of a product collection (i.e.,
+            one entry of the ``products`` section of a configuration file)
+
+    Returns:
+        list[DerivedBand]: Derived bands, sorted by name
+    """
+    return [DerivedBand.from_config(name, cfg) for name, cfg in
+            sorted(six.iteritems(product_config.get('derived', None) or {}))]
+
+
+class _ArraySource(object):
+    """ Describes an in-memory array like a single band ``rasterio`` dataset
+    """
+    def __init__(self, data, transform, crs, nodata):
+        self.transform = transform
+        self.crs = crs
+        self.meta = {
+            'driver': 'GTiff',
+            'dtype': data.dtype.name,
+            'nodata': nodata,
+            'count': 1,
+            'height': data.shape[0],
+            'width': data.shape[1],
+            'crs': crs,
+            'transform': transform
+        }
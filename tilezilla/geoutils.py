@@ -2,10 +2,12 @@
 """ Utilities
 """
 import logging
+import math
 import os
 from contextlib import contextmanager
 
 import affine
+import numpy as np
 from osgeo import osr
 import rasterio
 import shapely
@@ -17,6 +19,13 @@ from .core import BoundingBox
 logger = logging.getLogger('tilezilla')
 osr.UseExceptions()
 
+#: dict: Resampling methods computed by :func:`aggregate`, keyed by the name
+#: of the equivalent ``rasterio`` (GDAL) resampling method
+AGGREGATIONS = {
+    'average': 'mean',
+    'mode': 'mode'
+}
+
 
 def match_to_grid(match, grid, pix_size):
     """ Return new postings for input that coalign with grid
@@ -51,8 +60,8 @@ def snap_transform(transform, posting):
     """
     ulx, uly = transform.c, transform.f
     gridx, gridy = posting
-    snapx = gridx + round((ulx - gridx) / transform.a) * transform.a
-    snapy = gridy + round((uly - gridy) / transform.e) * transform.e
+    snapx = gridx + _round_half_up((ulx - gridx) / transform.a) * transform.a
+    snapy = gridy + _round_half_up((uly - gridy) / transform.e) * transform.e
 
     return affine.Affine(transform.a, transform.b, snapx,
                          transform.d, transform.e, snapy)
@@ -61,18 +70,75 @@ def snap_transform(transform, posting):
 def intersects_bounds(a_bounds, b_bounds):
     """ Return True/False if a intersects b
 
+    Bounds that only touch along an edge or at a corner intersect. Either
+    input may be an array of bounds, in which case the result is computed
+    element-wise (with broadcasting).
+
     Args:
-        a_bounds (iterable): bounds of a (left bottom right top)
-        b_bounds (iterable): bounds of b (left bottom right top)
+        a_bounds (iterable): bounds of a (left bottom right top), or an array
+            of bounds with shape ``(..., 4)``
+        b_bounds (iterable): bounds of b (left bottom right top), or an array
+            of bounds with shape ``(..., 4)``
 
     Returns:
-        bool: True/False if a intersects b
+        bool or np.ndarray: True/False if a intersects b
 
     """
-    a = bounds_to_polygon(a_bounds)
-    b = bounds_to_polygon(b_bounds)
+    a = np.asarray(a_bounds, dtype=float)
+    b = np.asarray(b_bounds, dtype=float)
+    hit = ((a[..., 0] <= b[..., 2]) & (a[..., 2] >= b[..., 0]) &
+           (a[..., 1] <= b[..., 3]) & (a[..., 3] >= b[..., 1]))
+    return hit.item() if hit.ndim == 0 else hit
+
+
+def intersecting_geometries(geoms, others, areal_touches=True):
+    """ Return the pairs of geometries that intersect
+
+    Pairs are found using a spatial index (``shapely.strtree.STRtree``) of
+    ``others``, so each geometry is only tested against those near it.
 
-    return a.intersects(b)
+    Args:
+        geoms (list[shapely.geometry.base.BaseGeometry]): Geometries
+        others (list[shapely.geometry.base.BaseGeometry]): Geometries to
+            test against each of ``geoms``
+        areal_touches (bool): Include pairs in which a geometry of ``geoms``
+            with an area only touches the other geometry along their
+            boundaries. Pairs of points or lines touching the other
+            geometry are always included
+
+    Returns:
+        tuple[np.ndarray]: Index within ``geoms`` and within ``others`` of
+            each pair of geometries that intersect, ordered by the index
+            within ``geoms`` and then within ``others``
+    """
+    from shapely.strtree import STRtree
+
+    if not len(geoms) or not len(others):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    tree = STRtree(others)
+    if int(shapely.__version__.split('.')[0]) >= 2:
+        geoms_ = np.asarray(geoms, dtype=object)
+        others_ = np.asarray(others, dtype=object)
+        i, j = tree.query(geoms_, predicate='intersects')
+        if not areal_touches:
+            drop = ((shapely.get_dimensions(geoms_[i]) == 2) &
+                    shapely.touches(geoms_[i], others_[j]))
+            i, j = i[~drop], j[~drop]
+    else:
+        from shapely.prepared import prep
+        index = dict((id(other), n) for n, other in enumerate(others))
+        pairs = []
+        for n, geom in enumerate(geoms):
+            prepared = prep(geom)
+            for other in tree.query(geom):
+                if prepared.intersects(other) and (
+                        areal_touches or geom.area == 0 or
+                        not prepared.touches(other)):
+                    pairs.append((n, index[id(other)]))
+        i, j = np.array(pairs, dtype=int).reshape(-1, 2).T
+    order = np.lexsort((j, i))
+    return np.asarray(i, dtype=int)[order], np.asarray(j, dtype=int)[order]
 
 
 def bounds_to_polygon(bounds):
@@ -108,6 +174,207 @@ def meta_to_bounds(transform, width, height, **kwargs):
     return BoundingBox(c, f + e * height, c + a * width, f)
 
 
+def bounds_to_window(bounds, transform, eps=1e-6):
+    """ Return the pixel window of a raster covering some bounds
+
+    Window edges are snapped outward to whole pixels so that the window
+    always covers ``bounds``. Coordinates within ``eps`` of a pixel edge are
+    considered to lie on that edge.
+
+    Args:
+        bounds (iterable): bounds (left bottom right top)
+        transform (affine.Affine): Affine transformation of the raster
+        eps (float): Tolerance, in pixels, used when snapping to pixel edges
+
+    Returns:
+        tuple: ((row_start, row_stop), (col_start, col_stop)) window
+    """
+    inv = ~transform
+    col_start, row_start = inv * (bounds[0], bounds[3])
+    col_stop, row_stop = inv * (bounds[2], bounds[1])
+
+    def _floor(v):
+        return int(math.floor(v + eps))
+
+    def _ceil(v):
+        return int(math.ceil(v - eps))
+
+    return ((_floor(row_start), _ceil(row_stop)),
+            (_floor(col_start), _ceil(col_stop)))
+
+
+def grid_offset(transform, tilespec):
+    """ Return the offset of a raster's pixel grid from a tile specification
+
+    Args:
+        transform (affine.Affine): Affine transformation of the raster
+        tilespec (TileSpec): Tile specification
+
+    Returns:
+        tuple or None: X/Y offset of the raster's pixel edges from the tile
+            specification's pixel edges, as fractions of a pixel within
+            [-0.5, 0.5), or None if the raster's pixel size differs from the
+            tile specification's or the raster is rotated
+    """
+    res_x, res_y = tilespec.res
+    if (transform.b != 0 or transform.d != 0 or
+            not np.isclose(transform.a, res_x) or
+            not np.isclose(-transform.e, res_y)):
+        return None
+    dx = (transform.c - tilespec.ul[0]) / res_x
+    dy = (tilespec.ul[1] - transform.f) / res_y
+    return (dx - _round_half_up(dx), dy - _round_half_up(dy))
+
+
+def _round_half_up(value):
+    """ Round to the nearest integer, rounding halves up
+
+    Used by both :func:`grid_offset` and :func:`snap_transform`, so that a
+    raster is snapped by the offset checked. Python 3's ``round`` rounds
+    halves to even, instead.
+    """
+    return int(math.floor(value + 0.5))
+
+
+def is_aligned(transform, tilespec, eps=1e-6):
+    """ Return True if a raster's pixels are the pixels of a tile
+    specification
+
+    Args:
+        transform (affine.Affine): Affine transformation of the raster
+        tilespec (TileSpec): Tile specification (assumed to share the
+            raster's coordinate reference system)
+        eps (float): Tolerance, in pixels, for pixel edges to coincide
+
+    Returns:
+        bool: True if the raster has the tile specification's pixel size and
+            its pixel edges coincide with the tile specification's
+    """
+    offset = grid_offset(transform, tilespec)
+    return offset is not None and max(abs(o) for o in offset) <= eps
+
+
+def aggregation_factor(transform, tilespec, eps=1e-6):
+    """ Return the integer factor between a raster's and a tile
+    specification's pixel sizes
+
+    Args:
+        transform (affine.Affine): Affine transformation of the raster
+        tilespec (TileSpec): Tile specification (assumed to share the
+            raster's coordinate reference system)
+        eps (float): Tolerance for the ratio of pixel sizes to be an integer
+
+    Returns:
+        tuple or None: The number of raster rows and columns within each row
+            and column of the tile specification's pixels, or None if the
+            raster is rotated or its pixels do not evenly divide the tile
+            specification's pixels
+    """
+    if transform.b != 0 or transform.d != 0:
+        return None
+    fx = tilespec.res[0] / transform.a
+    fy = tilespec.res[1] / -transform.e
+    if (fx < 1 or fy < 1 or
+            abs(fx - round(fx)) > eps or abs(fy - round(fy)) > eps):
+        return None
+    return int(round(fy)), int(round(fx))
+
+
+def aggregate(data, factor, method='mean', fill=None, offset=(0, 0)):
+    """ Aggregate an array into blocks of pixels, ignoring fill values
+
+    Args:
+        data (np.ndarray): Array, with rows and columns as the last two
+            dimensions
+        factor (tuple): Number of rows and columns in each block
+        method (str): Either "mean" or "mode". Means are rounded for integer
+            datatypes. Modes prefer the least value among ties
+        fill (int or float): Fill value, ignored when aggregating and used
+            for blocks without any other values (default: None)
+        offset (tuple): Number of rows and columns of the first block that
+            precede ``data``, which are treated as fill
+
+    Returns:
+        np.ndarray: The aggregated array, with the datatype of ``data``
+    """
+    if method not in ('mean', 'mode'):
+        raise ValueError('Unknown aggregation method "{}"'.format(method))
+    fy, fx = factor
+    oy, ox = offset
+    ny, nx = data.shape[-2:]
+    out_ny = -(-(ny + oy) // fy)
+    out_nx = -(-(nx + ox) // fx)
+    pad_fill = 0 if fill is None else fill
+
+    # Pad to whole blocks and view as (..., block row, row, block col, col)
+    if (oy, ox) != (0, 0) or out_ny * fy != ny or out_nx * fx != nx:
+        padded = np.full(data.shape[:-2] + (out_ny * fy, out_nx * fx),
+                         pad_fill, dtype=data.dtype)
+        padded[..., oy:oy + ny, ox:ox + nx] = data
+        valid = np.zeros(padded.shape, dtype=bool)
+        valid[..., oy:oy + ny, ox:ox + nx] = True
+    else:
+        padded, valid = data, np.ones(data.shape, dtype=bool)
+    if fill is not None:
+        valid &= ~(np.isnan(padded) if np.isnan(fill) else padded == fill)
+
+    shape = data.shape[:-2] + (out_ny, fy, out_nx, fx)
+    blocks = padded.reshape(shape)
+    valid = valid.reshape(shape)
+    n_valid = valid.sum(axis=(-3, -1))
+
+    if method == 'mean':
+        total = np.where(valid, blocks, 0).sum(axis=(-3, -1), dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = total / n_valid
+        if data.dtype.kind in 'iub':
+            out = np.round(out)
+    else:
+        # Count each value within each block, keeping the most common
+        best, best_count = None, np.zeros(n_valid.shape, dtype=int)
+        for value in np.unique(blocks[valid]):
+            count = ((blocks == value) & valid).sum(axis=(-3, -1))
+            if best is None:
+                best = np.full(n_valid.shape, value, dtype=data.dtype)
+            better = count > best_count
+            best[better] = value
+            best_count[better] = count[better]
+        out = (best if best is not None else
+               np.zeros(n_valid.shape, dtype=data.dtype))
+
+    out = np.where(n_valid > 0, out, pad_fill)
+    return out.astype(data.dtype)
+
+
+def read_window(data, window, fill=None):
+    """ Return a window of an array, padding with ``fill`` outside of it
+
+    Args:
+        data (np.ndarray): Array, with rows and columns as the last two
+            dimensions
+        window (tuple): ((row_start, row_stop), (col_start, col_stop)) window
+        fill (int or float): Value of pixels outside of ``data``
+            (default: 0)
+
+    Returns:
+        np.ndarray: The window of ``data``, as a view of ``data`` if the
+            window is entirely within it or as a copy otherwise
+    """
+    (r0, r1), (c0, c1) = window
+    ny, nx = data.shape[-2:]
+    if r0 >= 0 and c0 >= 0 and r1 <= ny and c1 <= nx:
+        return data[..., r0:r1, c0:c1]
+
+    out = np.full(data.shape[:-2] + (r1 - r0, c1 - c0),
+                  0 if fill is None else fill, dtype=data.dtype)
+    _r0, _r1 = max(r0, 0), min(r1, ny)
+    _c0, _c1 = max(c0, 0), min(c1, nx)
+    if _r1 > _r0 and _c1 > _c0:
+        out[..., _r0 - r0:_r1 - r0, _c0 - c0:_c1 - c0] = \
+            data[..., _r0:_r1, _c0:_c1]
+    return out
+
+
 def reproject_bounds(bounds, src_crs, dst_crs):
     """ Return bounds reprojected to `dst_crs`
 
@@ -132,9 +399,22 @@ def reproject_bounds(bounds, src_crs, dst_crs):
 def reproject_as_needed(src, tilespec, resampling='nearest'):
     """ Return a ``rasterio`` dataset, reprojected if needed
 
-    Returns src dataset if reprojection unncessary. Otherwise returns an in
-    memory ``rasterio`` dataset. Reprojection will snap the bounding
-    coordinates of the source dataset to align with the tile specification.
+    Returns src dataset if its pixels are already aligned to the pixels of
+    the tile specification, so tiles may be cut from it using whole pixel
+    windows. Otherwise returns an in memory ``rasterio`` dataset aligned to
+    the tile specification:
+
+        1. Sources in the tile specification's CRS and with its pixel size,
+           but offset from its grid, are shifted onto the grid by less
+           than half a pixel when using "nearest" resampling. Pixel values
+           are copied, not resampled.
+        2. Sources in the tile specification's CRS with pixels that evenly
+           divide its pixels (e.g., 30m to 240m) are aggregated using
+           :func:`aggregate` when using "average" or "mode" resampling
+           (see :attr:`AGGREGATIONS`), after shifting the source onto the
+           nearest edges of its pixels within the tile specification.
+        3. Other sources are reprojected, snapping the bounding coordinates
+           of the source dataset to align with the tile specification.
 
     Args:
         src (rasterio._io.RasterReader): rasterio raster dataset
@@ -144,8 +424,45 @@ def reproject_as_needed(src, tilespec, resampling='nearest'):
     Returns:
         rasterio._io.RasterReader: original or reprojected dataset
     """
-    if src.crs == tilespec.crs:
+    same_crs = src.crs == tilespec.crs
+    if same_crs and is_aligned(src.transform, tilespec):
+        logger.debug('Source is aligned to tile specification')
         yield src
+    elif (same_crs and resampling == 'nearest' and
+            grid_offset(src.transform, tilespec) is not None):
+        logger.debug('Snapping source to tile specification grid')
+        dst_meta = src.meta.copy()
+        dst_meta['driver'] = 'MEM'
+        dst_meta['transform'] = snap_transform(src.transform, tilespec.ul)
+
+        with rasterio.open(os.path.basename(src.name), 'w+',
+                           **dst_meta) as dst:
+            dst.write(src.read())
+            yield dst
+    elif (same_crs and resampling in AGGREGATIONS and
+            aggregation_factor(src.transform, tilespec) is not None):
+        fy, fx = aggregation_factor(src.transform, tilespec)
+        logger.debug('Aggregating source by {}x{} pixels'.format(fy, fx))
+        # Position of source within tile specification, in source pixels
+        col = int(round((src.transform.c - tilespec.ul[0]) / src.transform.a))
+        row = int(round((tilespec.ul[1] - src.transform.f) /
+                        -src.transform.e))
+        data = aggregate(src.read(), (fy, fx),
+                         method=AGGREGATIONS[resampling], fill=src.nodata,
+                         offset=(row % fy, col % fx))
+
+        res_x, res_y = tilespec.res
+        dst_meta = src.meta.copy()
+        dst_meta['driver'] = 'MEM'
+        dst_meta['height'], dst_meta['width'] = data.shape[-2:]
+        dst_meta['transform'] = affine.Affine(
+            res_x, 0, tilespec.ul[0] + (col // fx) * res_x,
+            0, -res_y, tilespec.ul[1] - (row // fy) * res_y)
+
+        with rasterio.open(os.path.basename(src.name), 'w+',
+                           **dst_meta) as dst:
+            dst.write(data)
+            yield dst
     else:
         # Calculate new transform & size
         transform, width, height = warp.calculate_default_transform(
@@ -162,7 +479,8 @@ def reproject_as_needed(src, tilespec, resampling='nearest'):
         dst_meta['height'] = height
         dst_meta['transform'] = transform
 
-        with rasterio.open(os.path.basename(src.name), 'w', **dst_meta) as dst:
+        with rasterio.open(os.path.basename(src.name), 'w+',
+                           **dst_meta) as dst:
             warp.reproject(
                 rasterio.band(src, 1),
                 rasterio.band(dst, 1),
@@ -0,0 +1,297 @@
+""" Run functions over blocks of an indexed datacube
+
+:func:`map_cube` runs a function over aligned (time, band, y, x) chunks of
+the time series of one or more tiles. Chunks follow the internal block grid
+of the tiles' band files, so each chunk reads whole blocks. Chunks are read
+and computed on the :mod:`tilezilla.multiprocess` executors. The results are
+written by the calling process, one GeoTIFF per tile, and indexed as a new
+product, so they can be read like any other product (e.g., using
+:class:`tilezilla.api.TimeSeriesReader` with ``collection=name``).
+
+Functions are called as ``func(data, times, **kwargs)``, where ``data`` is
+a (time, band, y, x) array of a block of each observation and ``times`` are
+the acquisition dates of each observation. Pixels not observed contain the
+fill value of their band. Functions return a (band, y, x) or (y, x) array
+of results for the block. Functions must be importable (i.e., not a
+``lambda``) to be used with the ``process`` executor.
+
+Example:
+
+    .. code-block:: python
+
+        def mean_ndvi(data, times):
+            red, nir = data[:, 0].astype(float), data[:, 1].astype(float)
+            ndvi = (nir - red) / (nir + red)
+            ndvi[(red == -9999) | (nir == -9999)] = np.nan
+            return np.nanmean(ndvi, axis=0)
+
+        map_cube(mean_ndvi, dataset, ['sr_band3', 'sr_band4'], 'mean_ndvi',
+                 '/data/derived', executor='process', njob=8)
+
+"""
+from collections import OrderedDict
+import concurrent.futures
+import itertools
+import logging
+import os
+
+import arrow
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from . import multiprocess
+from ._util import mkdir_p
+from .api import TimeSeriesReader
+from .composite import block_windows
+from .core import Band
+from .products import DerivedProduct
+from .templates import TileTemplate
+
+logger = logging.getLogger('tilezilla')
+
+#: str: Default pattern of the directory of each tile's results
+TILE_DIRPATTERN = 'h{horizontal:04d}v{vertical:04d}'
+
+
+def map_cube(func, dataset, bands, name, root, tiles=None,
+             start=None, end=None, collection=None,
+             executor='serial', njob=1, block_shape=None,
+             out_bands=None, dtype=None, fill=None, units='',
+             tile_dirpattern=TILE_DIRPATTERN, creation_options=None,
+             **kwargs):
+    """ Run a function over blocks of tiles and index the results
+
+    Args:
+        func (callable): Function to run over each block
+        dataset (DatasetResource): Products and bands of a datacube
+        bands (list[str]): ``standard_name`` of bands passed to ``func``,
+            in order
+        name (str): Name of the new product, which is also the name of its
+            collection
+        root (str): Root directory of results. Results of each tile are
+            written to ``[root]/[name]/[tile_dirpattern]/[name].tif``
+        tiles (list[Tile]): Tiles to process (default: all tiles indexed
+            for ``collection``)
+        start (str, datetime, or Arrow): Use products acquired on or after
+            this date (default: None)
+        end (str, datetime, or Arrow): Use products acquired on or before
+            this date (default: None)
+        collection (str): Name of product collection to use
+        executor (str): Method of parallel execution, from
+            :attr:`tilezilla.multiprocess.MULTIPROC_METHODS`
+        njob (int): Number of jobs for parallel execution
+        block_shape (tuple): Number of rows and columns in each block
+            (default: the internal block shape of the band files)
+        out_bands (list[str]): ``standard_name`` of each band of results
+            (default: ``name`` followed by the band number)
+        dtype (np.dtype): Datatype of results (default: datatype returned by
+            ``func`` for the first block of each tile)
+        fill (int or float): Fill value of results (default: None)
+        units (str): Units of results
+        tile_dirpattern (str or TileTemplate): Format of the directory of
+            each tile's results, using attributes of the tile
+        creation_options (dict): Additional creation options for ``rasterio``
+        kwargs: Additional keyword arguments passed to ``func``
+
+    Returns:
+        OrderedDict[tuple, int]: The database ID of the product created for
+            each tile index, in the order tiles were finished. Tiles without
+            observations are skipped
+    """
+    datacube = dataset.datacube
+    reader = TimeSeriesReader(dataset)
+    tile_dirpattern = TileTemplate.compile(tile_dirpattern)
+    if tiles is None:
+        tiles = list(OrderedDict.fromkeys(datacube.get_tiles(collection)))
+
+    # Build chunks lazily so that only tiles in progress are in memory
+    def _chunks():
+        for tile in tiles:
+            arrays = reader.read(tile.bounds, bands, start=start, end=end,
+                                 collection=collection)
+            arrays = list(arrays.values())
+            observed = [arr for arr in arrays if any(arr.sources)]
+            if not observed:
+                logger.debug('No observations in tile {}'.format(tile.index))
+                continue
+            shape = block_shape or observed[0].block_shape
+            windows = list(block_windows(arrays[0].shape[1:], shape))
+            output = _TileOutput(tile, arrays, shape, len(windows))
+            for window in windows:
+                yield output, window
+
+    results = OrderedDict()
+    # Results of tiles opened but not yet finished
+    opened = []
+    ex = multiprocess.get_executor(executor, njob)
+    try:
+        with ex:
+            def _submit(chunk):
+                output, window = chunk
+                return ex.submit(_map_block, output.arrays, window, func,
+                                 kwargs)
+
+            for (output, window), data in _bounded_map(_submit, _chunks(),
+                                                       2 * njob):
+                if output.dst is None:
+                    path = os.path.join(root, name,
+                                        tile_dirpattern.render(output.tile),
+                                        name + os.extsep + 'tif')
+                    opened.append(output)
+                    output.open(path, data, dtype, fill, creation_options)
+                output.write(window, data)
+                if output.remaining == 0:
+                    output.close()
+                    opened.remove(output)
+                    results[output.tile.index] = _index(
+                        dataset, output, name, out_bands, fill, units,
+                        {'function': getattr(func, '__name__', str(func)),
+                         'bands': list(bands),
+                         'collection': collection,
+                         'start': str(start) if start else None,
+                         'end': str(end) if end else None})
+    finally:
+        # Don't leave partially written results behind
+        for output in opened:
+            output.discard()
+
+    return results
+
+
+def _map_block(arrays, window, func, kwargs):
+    """ Read a (time, band, y, x) block and run a function over it
+    """
+    (r0, r1), (c0, c1) = window
+    data = np.stack([arr[:, r0:r1, c0:c1] for arr in arrays], axis=1)
+    result = np.asarray(func(data, arrays[0].times, **kwargs))
+    if result.ndim == 2:
+        result = result[np.newaxis]
+    if result.ndim != 3 or result.shape[1:] != (r1 - r0, c1 - c0):
+        raise ValueError('Function must return a (band, y, x) or (y, x) '
+                         'array with the shape of the block ({} returned)'
+                         .format(result.shape))
+    return result
+
+
+def _bounded_map(submit, items, max_pending):
+    """ Yield items and their results as they finish, with at most
+    ``max_pending`` items submitted at once
+
+    Args:
+        submit (callable): Submit an item, returning a ``Future``
+        items (iterable): Items to submit
+        max_pending (int): Maximum number of items submitted at once
+    """
+    items = iter(items)
+    futures = dict((submit(item), item)
+                   for item in itertools.islice(items, max_pending))
+    while futures:
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            item = futures.pop(future)
+            yield item, future.result()
+            for _item in itertools.islice(items, 1):
+                futures[submit(_item)] = _item
+
+
+def _index(dataset, output, name, out_bands, fill, units, metadata):
+    """ Index the results of a tile as a new product
+    """
+    tile = output.tile
+    tile_id = dataset.datacube.ensure_tile(name, tile.horizontal,
+                                           tile.vertical)
+    product = DerivedProduct(
+        timeseries_id=name,
+        acquired=output.arrays[0].times[-1],
+        processed=arrow.utcnow(),
+        platform='derived',
+        instrument='derived',
+        bounds=tile.bounds,
+        metadata=metadata)
+    product_id = dataset.ensure_product(tile_id, product)
+
+    count = output.count
+    out_bands = out_bands or ['{}_{}'.format(name, i + 1)
+                              for i in range(count)]
+    if len(out_bands) != count:
+        raise ValueError('Function returned {n} bands but {m} band names '
+                         'were given'.format(n=count, m=len(out_bands)))
+    for bidx, band_name in enumerate(out_bands, 1):
+        dataset.update_band(product_id, Band(
+            output.path, bidx=bidx, standard_name=band_name,
+            long_name=band_name, friendly_name=band_name, units=units,
+            fill=fill, valid_min=output.valid_range[0],
+            valid_max=output.valid_range[1]))
+    logger.debug('Indexed {name} for tile {idx} (product ID {id})'
+                 .format(name=name, idx=tile.index, id=product_id))
+    return product_id
+
+
+class _TileOutput(object):
+    """ Results of one tile, written block by block by the calling process
+    """
+    def __init__(self, tile, arrays, block_shape, n_blocks):
+        self.tile = tile
+        self.arrays = arrays
+        self.block_shape = block_shape
+        self.remaining = n_blocks
+        self.path = None
+        self.dst = None
+        self.count = 0
+        self.valid_range = (np.inf, -np.inf)
+
+    def open(self, path, data, dtype, fill, creation_options):
+        bh, bw = self.block_shape
+        meta = {'driver': 'GTiff', 'compress': 'deflate'}
+        if bh % 16 == 0 and bw % 16 == 0:
+            meta.update({'tiled': True, 'blockysize': bh, 'blockxsize': bw})
+        meta.update(creation_options or {})
+        meta.update({
+            'count': data.shape[0],
+            'dtype': np.dtype(dtype or data.dtype).name,
+            'nodata': fill,
+            'height': self.arrays[0].shape[1],
+            'width': self.arrays[0].shape[2],
+            'transform': self.arrays[0].transform,
+            'crs': self.arrays[0].crs
+        })
+        mkdir_p(os.path.dirname(path))
+        self.path = path
+        self.count = data.shape[0]
+        self.dst = rasterio.open(path, 'w', **meta)
+
+    def write(self, window, data):
+        (r0, r1), (c0, c1) = window
+        if data.shape[0] != self.dst.count:
+            raise ValueError('Function returned {n} bands for block {w} but '
+                             '{m} bands for other blocks'
+                             .format(n=data.shape[0], w=window,
+                                     m=self.dst.count))
+        data = data.astype(self.dst.dtypes[0])
+        self.dst.write(data, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+        valid = data[data != self.dst.nodata] if self.dst.nodata is not None \
+            else data
+        valid = valid[np.isfinite(valid)] if valid.dtype.kind == 'f' \
+            else valid
+        if valid.size:
+            self.valid_range = (min(self.valid_range[0], valid.min().item()),
+                                max(self.valid_range[1], valid.max().item()))
+        self.remaining -= 1
+
+    def close(self):
+        self.dst.close()
+        self.dst = None
+        if not np.isfinite(self.valid_range).all():
+            self.valid_range = (0, 0)
+
+    def discard(self):
+        """ Close and delete an unfinished result
+        """
+        if self.dst is not None:
+            self.dst.close()
+            self.dst = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,302 @@
+""" Plan and execute reads of windows from tiled band files
+
+A :class:`ReadPlan` collects requests for windows of band files and turns
+them into a list of reads that:
+
+1. Are grouped by file and aligned to the internal blocks of each file, so
+   that no block is read more than once no matter how many requests touch it
+2. Merge adjacent blocks into larger rectangular windows to reduce the
+   number of reads issued
+3. Are sorted by file and then by block row and column for sequential access
+
+The plan can be inspected (:attr:`ReadPlan.reads`, :meth:`ReadPlan.summary`)
+before it is executed on a thread pool (:meth:`ReadPlan.execute`). Files are
+opened for each execution, unless they are kept open in a
+:class:`DatasetCache` shared by many executions.
+"""
+from collections import namedtuple, OrderedDict
+import concurrent.futures
+import logging
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+logger = logging.getLogger('tilezilla')
+
+#: namedtuple: A request for a window of a band in a file
+ReadRequest = namedtuple('ReadRequest',
+                         ('key', 'path', 'bidx', 'rows', 'cols'))
+#: namedtuple: A block aligned window of a band to read and the requests
+#: that it (perhaps partially) satisfies
+PlannedRead = namedtuple('PlannedRead',
+                         ('path', 'bidx', 'rows', 'cols', 'requests'))
+
+
+class DatasetCache(object):
+    """ Datasets kept open to be read from by more than one read plan
+
+    Opened datasets are not safe to read from more than one thread at once,
+    so each thread should use its own cache. The least recently used
+    datasets are closed once more than ``max_open`` are open.
+
+    Args:
+        max_open (int): Maximum number of datasets kept open
+    """
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        self._datasets = OrderedDict()
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self, path):
+        """ Return an open dataset, opening it if needed
+
+        Args:
+            path (str): Filename
+
+        Returns:
+            rasterio.io.DatasetReader: The opened dataset
+        """
+        src = self._datasets.pop(path, None)
+        if src is None:
+            src = rasterio.open(path)
+        self._datasets[path] = src
+        while len(self._datasets) > self.max_open:
+            self._datasets.popitem(last=False)[1].close()
+        return src
+
+    def close(self):
+        """ Close all open datasets
+        """
+        while self._datasets:
+            self._datasets.popitem()[1].close()
+
+
+class ReadPlan(object):
+    """ An I/O plan for reading windows from a collection of band files
+
+    All files in a plan are expected to share the same size, internal block
+    size, and datatype (e.g., one band of a product collection in one
+    tile specification).
+
+    Args:
+        block_shape (tuple): Number of rows and columns in each internal
+            block of the files
+        raster_shape (tuple): Number of rows and columns in each file
+        dtype (np.dtype): Datatype of the band
+    """
+    def __init__(self, block_shape, raster_shape, dtype):
+        self.block_shape = tuple(block_shape)
+        self.raster_shape = tuple(raster_shape)
+        self.dtype = np.dtype(dtype)
+        self.requests = []
+        self._reads = None
+
+    def __repr__(self):
+        return ('<{0.__class__.__name__}(n_requests={n_requests}, '
+                'n_reads={n_reads}, n_files={n_files}, '
+                'bytes_saved={bytes_saved})>'.format(self, **self.summary()))
+
+    def add(self, path, bidx, rows, cols, key=None):
+        """ Add a request for a window of a band to the plan
+
+        Args:
+            path (str): Filename
+            bidx (int): Band index of the file
+            rows (tuple): Start and stop rows of the window
+            cols (tuple): Start and stop columns of the window
+            key (object): Returned with the data read for this request by
+                :meth:`execute`
+        """
+        self.requests.append(ReadRequest(key, path, bidx,
+                                         tuple(rows), tuple(cols)))
+        self._reads = None
+
+    @property
+    def reads(self):
+        """ list[PlannedRead]: Reads, in the order they will be issued
+        """
+        if self._reads is None:
+            self._reads = self._plan()
+        return self._reads
+
+    @property
+    def naive_bytes(self):
+        """ int: Bytes read when reading entire bands for each request
+        """
+        n_bands = len(set((r.path, r.bidx) for r in self.requests))
+        return (n_bands * self.raster_shape[0] * self.raster_shape[1] *
+                self.dtype.itemsize)
+
+    @property
+    def planned_bytes(self):
+        """ int: Bytes read by this plan
+        """
+        return sum((r.rows[1] - r.rows[0]) * (r.cols[1] - r.cols[0])
+                   for r in self.reads) * self.dtype.itemsize
+
+    @property
+    def bytes_saved(self):
+        """ int: Bytes not read by this plan compared to reading entire bands
+        """
+        return self.naive_bytes - self.planned_bytes
+
+    def summary(self):
+        """ Return a description of this plan
+
+        Returns:
+            dict: Number of requests, reads, and files in the plan, and the
+                bytes read by this plan compared to reading entire bands
+        """
+        return {
+            'n_requests': len(self.requests),
+            'n_reads': len(self.reads),
+            'n_files': len(set(r.path for r in self.reads)),
+            'naive_bytes': self.naive_bytes,
+            'planned_bytes': self.planned_bytes,
+            'bytes_saved': self.bytes_saved
+        }
+
+    def execute(self, njob=1, datasets=None):
+        """ Execute the plan, yielding the data for each request
+
+        Each file is opened once and its reads are issued in order. Up to
+        ``njob`` files are read concurrently.
+
+        Args:
+            njob (int): Maximum number of concurrent reads
+            datasets (DatasetCache): Read from, and keep open, datasets in
+                this cache instead of opening and closing each file. Files
+                are then read one at a time by the calling thread, which
+                owns the cache
+
+        Yields:
+            tuple (object, np.ndarray): The ``key`` of a request and the data
+                requested
+        """
+        by_file = OrderedDict()
+        for read in self.reads:
+            by_file.setdefault(read.path, []).append(read)
+
+        if njob > 1 and len(by_file) > 1 and datasets is None:
+            with concurrent.futures.ThreadPoolExecutor(njob) as ex:
+                futures = [ex.submit(self._read_file, path, reads)
+                           for path, reads in by_file.items()]
+                for future in concurrent.futures.as_completed(futures):
+                    for item in future.result():
+                        yield item
+        else:
+            for path, reads in by_file.items():
+                for item in self._read_file(path, reads, datasets):
+                    yield item
+
+    def _read_file(self, path, reads, datasets=None):
+        """ Read windows of a file and assemble the requests they satisfy
+        """
+        if datasets is None:
+            with rasterio.open(path) as src:
+                return self._read_dataset(src, reads)
+        return self._read_dataset(datasets.open(path), reads)
+
+    def _read_dataset(self, src, reads):
+        out = OrderedDict()
+        for read in reads:
+            (r0, r1), (c0, c1) = read.rows, read.cols
+            data = src.read(read.bidx,
+                            window=Window(c0, r0, c1 - c0, r1 - r0))
+            for req in read.requests:
+                if id(req) not in out:
+                    out[id(req)] = (req, np.empty(
+                        (req.rows[1] - req.rows[0],
+                         req.cols[1] - req.cols[0]), dtype=data.dtype))
+                _, dst = out[id(req)]
+                rr0, rr1 = max(r0, req.rows[0]), min(r1, req.rows[1])
+                cc0, cc1 = max(c0, req.cols[0]), min(c1, req.cols[1])
+                dst[rr0 - req.rows[0]:rr1 - req.rows[0],
+                    cc0 - req.cols[0]:cc1 - req.cols[0]] = \
+                    data[rr0 - r0:rr1 - r0, cc0 - c0:cc1 - c0]
+        return [(req.key, dst) for req, dst in out.values()]
+
+    def _plan(self):
+        bh, bw = self.block_shape
+        height, width = self.raster_shape
+
+        by_band = OrderedDict()
+        for req in self.requests:
+            by_band.setdefault((req.path, req.bidx), []).append(req)
+
+        reads = []
+        for path, bidx in sorted(by_band):
+            requests = by_band[(path, bidx)]
+            # Index of each request touching each block
+            blocks = {}
+            for i, req in enumerate(requests):
+                for br in range(req.rows[0] // bh,
+                                (req.rows[1] - 1) // bh + 1):
+                    for bc in range(req.cols[0] // bw,
+                                    (req.cols[1] - 1) // bw + 1):
+                        blocks.setdefault((br, bc), []).append(i)
+            for (br0, br1), (bc0, bc1) in merge_blocks(blocks):
+                rows = (br0 * bh, min(br1 * bh, height))
+                cols = (bc0 * bw, min(bc1 * bw, width))
+                overlapping = set()
+                for br in range(br0, br1):
+                    for bc in range(bc0, bc1):
+                        overlapping.update(blocks[(br, bc)])
+                reads.append(PlannedRead(
+                    path, bidx, rows, cols,
+                    [requests[i] for i in sorted(overlapping)]))
+        return reads
+
+
+def merge_blocks(blocks):
+    """ Merge a set of blocks into rectangles of adjacent blocks
+
+    Blocks in each block row are merged into runs of adjacent columns, and
+    runs spanning the same columns in adjacent block rows are merged
+    together. Every block is covered by exactly one rectangle and no
+    rectangle covers blocks not in ``blocks``.
+
+    Args:
+        blocks (iterable[tuple]): Block row and column of blocks to merge
+
+    Returns:
+        list[tuple]: ((block_row_start, block_row_stop),
+            (block_col_start, block_col_stop)) rectangles sorted by block row
+            and column
+    """
+    by_row = OrderedDict()
+    for br, bc in sorted(blocks):
+        by_row.setdefault(br, []).append(bc)
+
+    rects, active = [], {}
+    for br, bcs in by_row.items():
+        runs = []
+        for bc in bcs:
+            if runs and runs[-1][1] == bc:
+                runs[-1][1] = bc + 1
+            else:
+                runs.append([bc, bc + 1])
+
+        _active = {}
+        for bc0, bc1 in runs:
+            rect = active.pop((bc0, bc1), None)
+            if rect and rect[1] == br:
+                _active[(bc0, bc1)] = (rect[0], br + 1)
+            else:
+                if rect:
+                    rects.append((rect, (bc0, bc1)))
+                _active[(bc0, bc1)] = (br, br + 1)
+        rects.extend((rect, cols) for cols, rect in active.items())
+        active = _active
+    rects.extend((rect, cols) for cols, rect in active.items())
+
+    return sorted(rects)
@@ -10,6 +10,12 @@
 """
 from .registry import PRODUCTS, ProductRegistry
 from .espa import ESPALandsat
+from .derived import DerivedProduct
 
 #: ProductRegistry: registry of product types usable within this package
 registry = ProductRegistry(PRODUCTS)
+
+#: dict: product types of collections computed from indexed products (e.g.,
+#: by :func:`tilezilla.mapper.map_cube`), which are never ingested from a
+#: path and so are kept out of :data:`registry`
+DERIVED_PRODUCTS = {DerivedProduct.description: DerivedProduct}
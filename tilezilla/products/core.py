@@ -16,6 +16,8 @@ class BaseProduct(object):
     Attributes:
         description (str): Description of the collection this product belongs
             to (e.g., ESPALandsat, MODIS_C6)
+        indexed_metadata (tuple[str]): Keys of ``metadata`` indexed in the
+            database by default, so products may be searched by them
 
     Args:
         timeseries_id (str): Unique acquisition ID
@@ -34,6 +36,8 @@ class BaseProduct(object):
             metadata
     """
 
+    indexed_metadata = ()
+
     def __init__(self, timeseries_id,
                  acquired, processed, platform, instrument, bounds,
                  bands=None, metadata=None, metadata_files=None):
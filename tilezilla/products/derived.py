@@ -0,0 +1,20 @@
+""" Products derived from other products within a datacube
+"""
+from .core import BaseProduct
+
+
+class DerivedProduct(BaseProduct):
+    """ A product computed from other products indexed in a datacube
+
+    Derived products (e.g., created by :func:`tilezilla.mapper.map_cube`)
+    are indexed within their own collection, but are not ingested from a
+    path. They are therefore listed in
+    :data:`tilezilla.products.DERIVED_PRODUCTS` instead of the registry of
+    product types sniffed by ``tilez ingest``.
+    """
+    description = 'Derived'
+
+    @classmethod
+    def from_path(cls, path):
+        raise NotImplementedError('Derived products are computed from '
+                                  'indexed products, not read from a path')
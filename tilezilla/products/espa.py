@@ -12,6 +12,9 @@ class ESPALandsat(BaseProduct):
     mtl_pattern = 'L*_MTL.txt'
 
     description = 'ESPALandsat'
+    indexed_metadata = ('CLOUD_COVER', 'WRS_PATH', 'WRS_ROW',
+                        'SUN_AZIMUTH', 'SUN_ELEVATION',
+                        'PROCESSING_SOFTWARE_VERSION', 'DATA_TYPE')
 
     @classmethod
     def from_path(cls, path):
@@ -0,0 +1,77 @@
+""" Statistics of tiled bands, recorded in the index when ingested
+
+Statistics are computed from the data of each tile while it is stored, and
+are indexed as columns of the band (:attr:`BAND_STATISTICS`) or, for the
+``cfmask`` band, of the product (:attr:`PRODUCT_STATISTICS`). Observations
+can then be selected without reading them, for example:
+
+.. code-block:: bash
+
+    tilez db search --filter "clear_fraction > 0.6" product
+
+All fractions are fractions of the pixels of the tile, so products that
+only cover part of a tile have smaller fractions.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+#: str: Standard name of the band used to compute :attr:`PRODUCT_STATISTICS`
+CFMASK_BAND = 'cfmask'
+#: OrderedDict: ``cfmask`` values counted by each product statistic
+CFMASK_FRACTIONS = OrderedDict([
+    ('clear_fraction', (0, 1)),  # clear land and clear water
+    ('water_fraction', (1, )),
+    ('shadow_fraction', (2, )),
+    ('snow_fraction', (3, )),
+    ('cloud_fraction', (4, ))
+])
+
+#: tuple: Statistics of each band
+BAND_STATISTICS = ('valid_fraction', 'data_min', 'data_max', 'data_mean')
+#: tuple: Statistics of each product, computed from its ``cfmask`` band
+PRODUCT_STATISTICS = tuple(CFMASK_FRACTIONS)
+
+
+def band_statistics(band, data):
+    """ Return the statistics of the data of a band within a tile
+
+    Args:
+        band (Band): The band
+        data (np.ndarray): Data of the band within a tile
+
+    Returns:
+        dict: The fraction of pixels that are valid (``valid_fraction``) and
+            the minimum, maximum, and mean of valid pixels (``data_min``,
+            ``data_max``, and ``data_mean``; None if no pixels are valid).
+            Statistics of the ``cfmask`` band also include
+            :attr:`PRODUCT_STATISTICS`
+    """
+    masked = band.masked(data)
+    n_valid = masked.count()
+    stats = {
+        'valid_fraction': float(n_valid) / data.size if data.size else 0.,
+        'data_min': masked.min().item() if n_valid else None,
+        'data_max': masked.max().item() if n_valid else None,
+        'data_mean': masked.mean(dtype=np.float64).item() if n_valid else None
+    }
+    if band.standard_name == CFMASK_BAND:
+        stats.update(cfmask_fractions(masked))
+    return stats
+
+
+def cfmask_fractions(cfmask):
+    """ Return the fraction of pixels of each ``cfmask`` class
+
+    Args:
+        cfmask (np.ma.MaskedArray): ``cfmask`` band within a tile, with fill
+            values masked
+
+    Returns:
+        dict: The fraction of pixels within each of :attr:`CFMASK_FRACTIONS`
+    """
+    data = cfmask.filled(255) if np.ma.isMaskedArray(cfmask) else cfmask
+    size = float(data.size) or 1.
+    counts = np.bincount(data.ravel().astype(np.intp), minlength=256)
+    return dict((name, counts[list(values)].sum().item() / size)
+                for name, values in CFMASK_FRACTIONS.items())
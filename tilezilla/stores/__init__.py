@@ -1,10 +1,10 @@
 """ Tools for storing data cube tiles
 """
-import inspect
 import os
 
 from .geotiff import GeoTIFFStore
 from .vrt import VRT
+from ..templates import TileTemplate
 
 STORAGE_TYPES = {
     'GeoTIFF': GeoTIFFStore,
@@ -35,6 +35,7 @@ def destination_path(config, tile, product, root_override=None):
         str: Product destination root folder
     """
     root = root_override or config['store']['root']
-    tile_part = tile.str_format(config['store']['tile_dirpattern'])
+    tile_part = TileTemplate.compile(
+        config['store']['tile_dirpattern']).render(tile)
 
     return os.path.join(root, product.description, tile_part)
@@ -5,12 +5,15 @@ import shutil
 
 import numpy as np
 import rasterio
+from rasterio.windows import Window
 
 from .._util import mkdir_p
 from ..errors import FillValueException
-from ..geoutils import meta_to_bounds
+from ..geoutils import bounds_to_window, meta_to_bounds, read_window
+from ..stats import band_statistics
+from ..templates import ProductTemplate
 
-IMG_PATTERN = '{tile.timeseries_id}_{band.standard_name}.tif'
+IMG_PATTERN = '{product.timeseries_id}_{band.standard_name}.tif'
 
 
 class GeoTIFFStore(object):
@@ -53,6 +56,8 @@ class GeoTIFFStore(object):
     def __init__(self, path, tile, meta_options=None):
         self.path = path
         self.tile = tile
+        # Copy so stores of different tiles don't share (class) options
+        self.meta_options = self.meta_options.copy()
         self.meta_options.update(meta_options or {})
 
         self.meta_options.update({
@@ -63,29 +68,47 @@ class GeoTIFFStore(object):
 
     def store_variable(self, product, band,
                        img_pattern=IMG_PATTERN,
-                       overwrite=False):
+                       overwrite=False, data=None, stats=None):
         """ Store product variable contained within this tile
 
+        The source of the band, ``band.src``, must be aligned to the pixels
+        of the tile specification (see
+        :func:`tilezilla.geoutils.reproject_as_needed`) so that the tile
+        is cut from it using a window of whole pixels.
+
         Args:
             product (BaseProduct): A product to store
             band (Band): A :class:`Band` containing an observed variable
-            img_pattern (str): A format string that is used for creating the
-                output filename for this variable using Attributes of the
-                `product` and `band`. GeoTIFF driver's default is:
+            img_pattern (str or ProductTemplate): A format string that is
+                used for creating the output filename for this variable using
+                Attributes of the `product` and `band`. GeoTIFF driver's
+                default is:
                 ``{product.timeseries_id}_{band.standard_name}.tif``
             overwrite (bool): Allow overwriting
+            data (np.ndarray): Data of ``band.src``, if already read. When
+                given, the tile is sliced from ``data`` instead of being read
+            stats (dict): If given, updated with statistics of the data stored
+                (see :func:`tilezilla.stats.band_statistics`)
 
         Returns:
             str: The path to the stored variable
 
         """
-        # Ensure source data has observations (i.e., not an edge)
         dst_bounds = meta_to_bounds(**self.meta_options)
-        src_window = band.src.window(*dst_bounds, boundless=True)
+        window = bounds_to_window(dst_bounds, band.src.transform)
+        if data is not None:
+            src_data = read_window(data, window, fill=band.fill)
+        else:
+            (r0, r1), (c0, c1) = window
+            src_data = band.src.read(
+                1, window=Window(c0, r0, c1 - c0, r1 - r0),
+                boundless=True, fill_value=band.fill)
 
-        src_data = band.src.read(1, window=src_window, boundless=True)
+        # Ensure source data has observations (i.e., not an edge)
         if np.all(src_data == band.fill):
             raise FillValueException('Variable is 100% fill value')
+        if stats is not None:
+            stats.update(band_statistics(band, src_data))
 
         dst_path = self._band_filename(product, band, img_pattern)
         mkdir_p(os.path.dirname(dst_path))
@@ -137,5 +160,5 @@ class GeoTIFFStore(object):
     def _band_filename(self, product, band, img_pattern=IMG_PATTERN):
         """ Return path to a band in a product
         """
-        name = img_pattern.format(product=product, band=band)
+        name = ProductTemplate.compile(img_pattern).render(product, band)
         return os.path.join(self._product_filename(product), name)
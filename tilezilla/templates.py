@@ -0,0 +1,198 @@
+""" Compiled templates for the paths of tiles and tiled products
+
+Templates are ``str.format`` patterns (e.g., the ``tile_dirpattern`` and
+``tile_imgpattern`` of the "store" section of a configuration file). They
+are parsed and validated once, when compiled, and rendered from only the
+attributes they reference.
+
+Example:
+
+    .. code-block:: python
+
+        >>> template = TileTemplate('h{horizontal:04d}v{vertical:04d}')
+        >>> template.render(tilespec[(2, 10)])
+        'h0010v0002'
+        >>> template.render_index([10, 11], [2, 2])
+        ['h0010v0002', 'h0011v0002']
+
+"""
+import re
+import string
+
+import six
+
+#: tuple: Attributes of :class:`tilezilla.tilespec.Tile` usable in
+#: :class:`TileTemplate`
+TILE_FIELDS = ('horizontal', 'vertical', 'index', 'key', 'bounds', 'crs',
+               'transform', 'polygon', 'geojson', 'tilespec')
+#: tuple: Names usable in :class:`ProductTemplate`
+PRODUCT_FIELDS = ('product', 'band')
+
+_FIELD_NAME = re.compile(r'[.\[]')
+_COMPILED = {}
+
+
+class Template(object):
+    """ A ``str.format`` pattern, parsed and validated once
+
+    Args:
+        pattern (str): A format string
+
+    Raises:
+        ValueError: if ``pattern`` is not a valid format string or uses
+            fields other than :attr:`fields`
+    """
+    #: tuple: Names of fields that may be used in the pattern
+    fields = ()
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        #: tuple: Names of the fields used in the pattern, in order
+        self.names = _parse_names(pattern, self.fields)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__}('{0.pattern}')>".format(self)
+
+    def __str__(self):
+        return self.pattern
+
+    def __eq__(self, other):
+        return (isinstance(other, Template) and
+                type(self) is type(other) and self.pattern == other.pattern)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.pattern))
+
+    @classmethod
+    def compile(cls, pattern):
+        """ Return a template for a pattern, reusing templates compiled before
+
+        Args:
+            pattern (str or Template): A format string, or a template (which
+                is returned unchanged)
+
+        Returns:
+            Template: The compiled template
+        """
+        if isinstance(pattern, cls):
+            return pattern
+        template = _COMPILED.get((cls, pattern))
+        if template is None:
+            template = _COMPILED[(cls, pattern)] = cls(pattern)
+        return template
+
+    def format(self, **kwargs):
+        """ Render the template from keyword arguments
+        """
+        return self.pattern.format(**kwargs)
+
+
+class TileTemplate(Template):
+    """ A template rendered from the attributes of a tile
+
+    Field names are attributes of :class:`tilezilla.tilespec.Tile` (see
+    :attr:`TILE_FIELDS`), such as ``'h{horizontal:04d}v{vertical:04d}'``.
+    """
+    fields = TILE_FIELDS
+
+    def render(self, tile):
+        """ Render the template for a tile
+
+        Args:
+            tile (Tile): A tile
+
+        Returns:
+            str: The rendered template
+        """
+        return self.pattern.format(**dict((name, getattr(tile, name))
+                                          for name in self.names))
+
+    def render_many(self, tiles):
+        """ Render the template for many tiles
+
+        Args:
+            tiles (iterable[Tile]): Tiles
+
+        Returns:
+            list[str]: The rendered template for each tile
+        """
+        return [self.render(tile) for tile in tiles]
+
+    def render_index(self, horizontal, vertical):
+        """ Render the template for many tiles, given only their indexes
+
+        Only templates using just ``horizontal``, ``vertical``, and
+        ``index`` can be rendered from indexes, but no
+        :class:`tilezilla.tilespec.Tile` objects are created.
+
+        Args:
+            horizontal (iterable[int]): Horizontal index of each tile
+            vertical (iterable[int]): Vertical index of each tile
+
+        Returns:
+            list[str]: The rendered template for each tile
+
+        Raises:
+            ValueError: if the template uses other attributes of tiles
+        """
+        other = set(self.names) - set(('horizontal', 'vertical', 'index'))
+        if other:
+            raise ValueError('Cannot render template "{}" from tile indexes '
+                             'because it uses: {}'
+                             .format(self.pattern, ', '.join(sorted(other))))
+        fmt = self.pattern.format
+        return [fmt(horizontal=h, vertical=v, index=(v, h))
+                for h, v in zip(_tolist(horizontal), _tolist(vertical))]
+
+
+class ProductTemplate(Template):
+    """ A template rendered from a product and one of its bands
+
+    Field names are ``product`` and ``band`` (see :attr:`PRODUCT_FIELDS`),
+    such as ``'{product.timeseries_id}_{band.standard_name}.tif'``.
+    """
+    fields = PRODUCT_FIELDS
+
+    def render(self, product, band):
+        """ Render the template for a band of a product
+
+        Args:
+            product (BaseProduct): A product
+            band (Band): A band of the product
+
+        Returns:
+            str: The rendered template
+        """
+        return self.pattern.format(product=product, band=band)
+
+
+def _parse_names(pattern, fields):
+    """ Return the names of fields used in a format string, validating them
+    """
+    if not isinstance(pattern, six.string_types):
+        raise ValueError('Template pattern must be a string ({!r} given)'
+                         .format(pattern))
+    names = []
+    try:
+        parsed = list(string.Formatter().parse(pattern))
+    except ValueError as exc:
+        raise ValueError('Invalid template "{}": {}'.format(pattern, exc))
+    for _, field_name, _, _ in parsed:
+        if field_name is None:
+            continue
+        name = _FIELD_NAME.split(field_name, 1)[0]
+        if name not in fields:
+            raise ValueError('Invalid template "{p}": unknown field "{f}" '
+                             '(fields available are: {a})'
+                             .format(p=pattern, f=field_name or '{}',
+                                     a=', '.join(fields)))
+        if name not in names:
+            names.append(name)
+    return tuple(names)
+
+
+def _tolist(values):
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
@@ -1,18 +1,29 @@
 """ Predefined tile specifications and utilities for working with tile systems
 """
-import inspect
-import itertools
+from collections import OrderedDict
 import json
 import pkgutil
 
 import affine
+import numpy as np
 import rasterio
 from rasterio.crs import CRS
 import shapely.geometry
 import six
 
 from . import geoutils
+from ._util import lazy_property
 from .core import BoundingBox
+from .templates import TileTemplate
+
+#: int: Default number of :class:`Tile` cached by each :class:`TileSpec`
+TILE_CACHE_SIZE = 4096
+#: int: Bits of each tile index used in space-filling curve tile keys. Tile
+#: indexes from ``-2 ** (TILE_KEY_BITS - 1)`` to
+#: ``2 ** (TILE_KEY_BITS - 1) - 1`` can be keyed
+TILE_KEY_BITS = 16
+#: str: Default space-filling curve used to key and order tiles
+TILE_KEY_ORDER = 'hilbert'
 
 
 class TileSpec(object):
@@ -24,9 +35,14 @@ class TileSpec(object):
         res (tuple): pixel X/Y resolution
         size (tuple): number of pixels in X/Y dimension of each tile
         desc (str): description of tile specification (default: None)
+        cache_size (int): Maximum number of :class:`Tile` to keep cached,
+            dropping the least recently used tiles when full. Use ``None``
+            to cache every tile or 0 to disable caching
+            (default: :attr:`TILE_CACHE_SIZE`)
     """
 
-    def __init__(self, ul, crs, res, size, desc=None):
+    def __init__(self, ul, crs, res, size, desc=None,
+                 cache_size=TILE_CACHE_SIZE):
         self.ul = ul
         if isinstance(crs, six.string_types):
             self.crs = CRS.from_string(crs)
@@ -43,7 +59,8 @@ class TileSpec(object):
         self.res = res
         self.size = size
         self.desc = desc or 'unnamed'
-        self._tiles = {}
+        self.cache_size = cache_size
+        self._tiles = OrderedDict()
 
     def __repr__(self):
         return (
@@ -52,6 +69,14 @@ class TileSpec(object):
             .format(self, hex=hex(id(self)))
         )
 
+    @property
+    def transform(self):
+        """ affine.Affine: The ``Affine`` transform of the tile grid, with
+            pixel (0, 0) at the upper left of tile (0, 0)
+        """
+        return affine.Affine(self.res[0], 0, self.ul[0],
+                             0, -self.res[1], self.ul[1])
+
     def __getitem__(self, index):
         """ Return a Tile for the grid row/column specified by index
         """
@@ -74,11 +99,26 @@ class TileSpec(object):
         Returns:
             BoundingBox: the :attr:`BoundingBox` of a tile
         """
-        return BoundingBox(
-            left=self.ul[0] + index[1] * self.size[0] * self.res[0],
-            right=self.ul[0] + (index[1] + 1) * self.size[0] * self.res[0],
-            top=self.ul[1] - index[0] * self.size[1] * self.res[1],
-            bottom=self.ul[1] - (index[0] + 1) * self.size[1] * self.res[1])
+        return BoundingBox(*self.index_to_bounds(*index).tolist())
+
+    def index_to_bounds(self, rows, cols):
+        """ Return the bounds of one or more tiles
+
+        Args:
+            rows (int or np.ndarray): Tile row (vertical) index(es)
+            cols (int or np.ndarray): Tile column (horizontal) index(es)
+
+        Returns:
+            np.ndarray: Bounds (left, bottom, right, top) of each tile, with
+                shape ``(4, )`` for scalar indexes or ``(n, 4)`` for arrays
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        return np.stack((
+            self.ul[0] + cols * self.size[0] * self.res[0],
+            self.ul[1] - (rows + 1) * self.size[1] * self.res[1],
+            self.ul[0] + (cols + 1) * self.size[0] * self.res[0],
+            self.ul[1] - rows * self.size[1] * self.res[1]
+        ), axis=-1)
 
     def _index_to_tile(self, index):
         """ Return the Tile for given index
@@ -89,12 +129,17 @@ class TileSpec(object):
         Returns:
             Tile: a Tile object
         """
-        if index not in self._tiles:
-            bounds = self._index_to_bounds(index)
-            self._tiles[index] = Tile(bounds, self.crs, index, self)
-        return self._tiles[index]
-
-    def bounds_to_tiles(self, bounds):
+        tile = self._tiles.pop(index, None)
+        if tile is None:
+            tile = Tile(self._index_to_bounds(index), self.crs, index, self)
+        if self.cache_size is None or self.cache_size > 0:
+            # Re-insert to mark as most recently used
+            self._tiles[index] = tile
+            if self.cache_size and len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def bounds_to_tiles(self, bounds, order=None):
         """ Yield Tile objects for this TileSpec that intersect a given bounds
 
         .. note::
@@ -104,12 +149,50 @@ class TileSpec(object):
 
         Args:
             bounds (BoundingBox): input bounds
+            order (str): Yield tiles in the order of this space-filling curve,
+                from :attr:`TILE_KEY_ORDERS`, instead of row-major order
+                (default: None)
 
         Yields:
             Tile: the Tiles that intersect within a bounds
         """
-        grid_ys, grid_xs = self._frame_bounds(bounds)
-        return self._yield_tiles(grid_ys, grid_xs, bounds)
+        rows, cols, _ = self.bounds_to_tile_index(bounds)
+        return self._yield_tiles(rows, cols, order=order)
+
+    def bounds_to_tile_index(self, bounds):
+        """ Return the indexes of tiles intersecting one or more bounds
+
+        Tiles that only touch the edge of a bounds are considered to
+        intersect it.
+
+        Args:
+            bounds (BoundingBox or np.ndarray): Bounds (left, bottom, right,
+                top), or an ``(n, 4)`` array of bounds, in tile
+                specification's CRS
+
+        Returns:
+            tuple[np.ndarray]: Tile row (vertical) and column (horizontal)
+                indexes of each tile intersecting each bounds, and the index
+                of the bounds it intersects. Tiles are ordered by bounds, and
+                then by row and column
+        """
+        bounds = np.atleast_2d(np.asarray(bounds, dtype=float))
+        row_min, row_max, col_min, col_max = self._frame_bounds(bounds)
+
+        # Expand each frame into the (row, col) of each candidate tile
+        nrow = np.maximum(row_max - row_min + 1, 0)
+        ncol = np.maximum(col_max - col_min + 1, 0)
+        count = nrow * ncol
+        which = np.repeat(np.arange(len(bounds)), count)
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                                    count)
+        ncol_ = np.maximum(ncol[which], 1)
+        rows = row_min[which] + offset // ncol_
+        cols = col_min[which] + offset % ncol_
+
+        hit = geoutils.intersects_bounds(self.index_to_bounds(rows, cols),
+                                         bounds[which])
+        return rows[hit], cols[hit], which[hit]
 
     def point_to_tile(self, point):
         """ Return a :class:`Tile` containing a given point (x, y)
@@ -119,44 +202,191 @@ class TileSpec(object):
         Returns:
             Tile: The intersecting :class`Tile`
         """
-        px, py = self.size[0] * self.res[0], self.size[1] * self.res[1]
-        _x = int((point[0] - self.ul[0]) // px)
-        _y = int((self.ul[1] - point[1]) // py)
+        return self._index_to_tile(self.point_to_tile_index(*point))
 
-        return self._index_to_tile((_y, _x))
+    def point_to_tile_index(self, x, y):
+        """ Return the index of tiles containing one or more points
 
-    def roi_to_tiles(self, roi):
+        Args:
+            x (float or np.ndarray): X coordinate(s) in tile specification's
+                CRS
+            y (float or np.ndarray): Y coordinate(s) in tile specification's
+                CRS
+
+        Returns:
+            tuple: Tile row (vertical) and column (horizontal) indices, as
+                ``int`` for scalar coordinates or as ``np.ndarray`` for
+                arrays of coordinates
+        """
+        px, py = self.size[0] * self.res[0], self.size[1] * self.res[1]
+        _y = np.floor_divide(self.ul[1] - np.asarray(y), py).astype(int)
+        _x = np.floor_divide(np.asarray(x) - self.ul[0], px).astype(int)
+        if _y.ndim == 0:
+            return int(_y), int(_x)
+        return _y, _x
+
+    def roi_to_tiles(self, roi, order=None):
         """ Yield tiles overlapping a Region of Interest `shapely` geometry
 
+        Tiles are selected using the exact geometry of the ROI, not its
+        bounds, so tiles within the bounds of a diagonal or multi-part ROI
+        that do not intersect it are skipped.
+
         Args:
             roi (shapely.geometry.Polygon): A geometry in the tile
                 specifications' crs
+            order (str): Yield tiles in the order of this space-filling curve,
+                from :attr:`TILE_KEY_ORDERS`, instead of row-major order
+                (default: None)
         Yields:
             Tile: A :class`Tile` that intersects the ROI
         """
-        bounds = BoundingBox(roi.bounds)
-        grid_ys, grid_xs = self._frame_bounds(bounds)
-        return self._yield_tiles(grid_ys, grid_xs, bounds)
+        rows, cols = self.roi_to_tile_index(roi)
+        return self._yield_tiles(rows, cols, order=order)
+
+    def roi_to_tile_index(self, roi, windows=False):
+        """ Return the indexes of tiles intersecting a Region of Interest
+
+        Args:
+            roi (shapely.geometry.base.BaseGeometry): A geometry (e.g., a
+                Polygon or MultiPolygon) in the tile specification's CRS
+            windows (bool): Also return the window of each tile covering the
+                part of the ROI within it
+
+        Returns:
+            tuple[np.ndarray]: Tile row (vertical) and column (horizontal)
+                indexes, and, if ``windows``, a list of
+                ``((row_start, row_stop), (col_start, col_stop))`` pixel
+                windows within each tile
+        """
+        out = self.rois_to_tile_index([roi], windows=windows)
+        return out[:2] + out[3:]
+
+    def rois_to_tile_index(self, rois, windows=False):
+        """ Return the indexes of tiles intersecting many Regions of Interest
+
+        Candidate tiles are found from the bounds of all ROIs at once
+        (see :meth:`bounds_to_tile_index`), and then tested against the
+        exact geometry of the ROIs using a spatial index of the candidate
+        tiles (see :func:`tilezilla.geoutils.intersecting_geometries`), so
+        many ROIs (e.g., all counties of a country) are selected quickly.
+        Tiles that an ROI with an area only touches along its boundary are
+        not included, but tiles touched by points or lines are.
+
+        Args:
+            rois (iterable[shapely.geometry.base.BaseGeometry]): Geometries in
+                the tile specification's CRS
+            windows (bool): Also return the window of each tile covering the
+                part of the ROI within it
+
+        Returns:
+            tuple[np.ndarray]: Tile row (vertical) and column (horizontal)
+                indexes, the index of the ROI each tile intersects, and, if
+                ``windows``, a list of ``((row_start, row_stop),
+                (col_start, col_stop))`` pixel windows within each tile
+        """
+        rois = [roi for roi in rois]
+        bounds = np.array([roi.bounds if not roi.is_empty else
+                           (np.nan, ) * 4 for roi in rois]).reshape(-1, 4)
+        valid = np.where(np.isfinite(bounds).all(axis=1))[0]
+
+        # Each tile that is a candidate of any ROI is tested once. Bounds
+        # are padded so tiles only touching their left or top edge (e.g.,
+        # of a point on a tile's edge) are candidates too
+        pad = np.array([-self.res[0], -self.res[1],
+                        self.res[0], self.res[1]]) / 2.
+        rows, cols, _ = self.bounds_to_tile_index(bounds[valid] + pad)
+        index = np.unique(np.column_stack((rows, cols)),
+                          axis=0).reshape(-1, 2)
+        tile_bounds = self.index_to_bounds(index[:, 0], index[:, 1])
+        boxes = [geoutils.bounds_to_polygon(b) for b in tile_bounds]
+
+        i, j = geoutils.intersecting_geometries(
+            [rois[v] for v in valid], boxes, areal_touches=False)
+        out = (index[j, 0], index[j, 1], valid[i])
+        if windows:
+            out += ([self._clip_window(
+                rois[valid[_i]].intersection(boxes[_j]).bounds,
+                tile_bounds[_j]) for _i, _j in zip(i, j)], )
+        return out
+
+    def _clip_window(self, bounds, tile_bounds):
+        """ Return the window within a tile covering some bounds
+        """
+        transform = affine.Affine(self.res[0], 0, tile_bounds[0],
+                                  0, -self.res[1], tile_bounds[3])
+        (r0, r1), (c0, c1) = geoutils.bounds_to_window(bounds, transform)
+        ny, nx = self.size[1], self.size[0]
+        return ((min(max(r0, 0), ny), min(max(r1, 0), ny)),
+                (min(max(c0, 0), nx), min(max(c1, 0), nx)))
+
+    def tile_keys(self, rows, cols, order=TILE_KEY_ORDER):
+        """ Return the space-filling curve keys of tiles
+
+        Keys depend only on the tile indexes, so they are stable across
+        runs and databases, and tiles near each other in space tend to
+        have keys near each other.
+
+        Args:
+            rows (int or np.ndarray): Tile row (vertical) index(es)
+            cols (int or np.ndarray): Tile column (horizontal) index(es)
+            order (str): Space-filling curve, from :attr:`TILE_KEY_ORDERS`
+
+        Returns:
+            int or np.ndarray: The key of each tile
+        """
+        if order not in TILE_KEY_ORDERS:
+            raise KeyError('Unknown tile key order "{}" (available: {})'
+                           .format(order, ', '.join(sorted(TILE_KEY_ORDERS))))
+        return TILE_KEY_ORDERS[order](cols, rows)
+
+    def sort_tile_index(self, rows, cols, order=TILE_KEY_ORDER):
+        """ Return the indexes that sort tiles along a space-filling curve
+
+        Args:
+            rows (np.ndarray): Tile row (vertical) indexes
+            cols (np.ndarray): Tile column (horizontal) indexes
+            order (str): Space-filling curve, from :attr:`TILE_KEY_ORDERS`
+
+        Returns:
+            np.ndarray: Indexes that sort ``rows`` and ``cols``
+        """
+        return np.argsort(self.tile_keys(rows, cols, order=order),
+                          kind='mergesort')
 
-    def _yield_tiles(self, grid_ys, grid_xs, bounds):
-        for index in itertools.product(grid_ys, grid_xs):
-            tile = self._index_to_tile(index)
-            if geoutils.intersects_bounds(bounds, tile.bounds):
-                yield tile
+    def _yield_tiles(self, rows, cols, order=None):
+        if order:
+            idx = self.sort_tile_index(rows, cols, order=order)
+            rows, cols = rows[idx], cols[idx]
+        for index in zip(rows.tolist(), cols.tolist()):
+            yield self._index_to_tile(index)
 
     def _frame_bounds(self, bounds):
+        """ Return the range of tile rows and columns framing bounds
+
+        Args:
+            bounds (np.ndarray): ``(n, 4)`` array of bounds
+
+        Returns:
+            tuple[np.ndarray]: Minimum and maximum rows, and minimum and
+                maximum columns, of tiles framing each bounds
+        """
         px, py = self.size[0] * self.res[0], self.size[1] * self.res[1]
-        min_grid_x = int((bounds.left - self.ul[0]) // px)
-        max_grid_x = int((bounds.right - self.ul[0]) // px)
-        min_grid_y = int((self.ul[1] - bounds.top) // py)
-        max_grid_y = int((self.ul[1] - bounds.bottom) // py)
-        return (range(min_grid_y, max_grid_y + 1),
-                range(min_grid_x, max_grid_x + 1))
+        left, bottom, right, top = np.asarray(bounds, dtype=float).T
+        return (np.floor_divide(self.ul[1] - top, py).astype(int),
+                np.floor_divide(self.ul[1] - bottom, py).astype(int),
+                np.floor_divide(left - self.ul[0], px).astype(int),
+                np.floor_divide(right - self.ul[0], px).astype(int))
 
 
 class Tile(object):
     """ A tile
 
+    Tiles are lightweight (using ``__slots__``), and cache their derived
+    attributes (e.g., :attr:`transform` and :attr:`polygon`) when first
+    accessed. Tiles are equal if they have the same index in the same tile
+    specification.
+
     Args:
         bounds (BoundingBox): the bounding box of the tile
         crs (str): the coordinate reference system of the tile
@@ -164,6 +394,8 @@ class Tile(object):
         tilespec (TileSpec): the tile specification
 
     """
+    __slots__ = ('bounds', 'crs', 'index', 'tilespec',
+                 '_transform', '_polygon', '_geojson')
 
     def __init__(self, bounds, crs, index, tilespec):
         self.bounds = bounds
@@ -171,6 +403,20 @@ class Tile(object):
         self.index = index
         self.tilespec = tilespec
 
+    def __repr__(self):
+        return ('<{0.__class__.__name__}(index={0.index}, '
+                'bounds={0.bounds})>'.format(self))
+
+    def __eq__(self, other):
+        return (isinstance(other, Tile) and self.index == other.index and
+                self.tilespec is other.tilespec)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tilespec), self.index))
+
     @property
     def vertical(self):
         """ int: The horizontal index of this tile in its tile specification
@@ -184,19 +430,26 @@ class Tile(object):
         return self.index[1]
 
     @property
+    def key(self):
+        """ int: This tile's key along the default space-filling curve
+        (:attr:`TILE_KEY_ORDER`)
+        """
+        return self.tilespec.tile_keys(self.vertical, self.horizontal)
+
+    @lazy_property
     def transform(self):
         """ affine.Affine: The ``Affine`` transform for the tile
         """
         return affine.Affine(self.tilespec.res[0], 0, self.bounds.left,
                              0, -self.tilespec.res[1], self.bounds.top)
 
-    @property
+    @lazy_property
     def polygon(self):
         """ shapely.geometry.Polygon: This tile's geometry
         """
         return geoutils.bounds_to_polygon(self.bounds)
 
-    @property
+    @lazy_property
     def geojson(self):
         """ str: This tile's geometry and crs represented as GeoJSON
         """
@@ -213,16 +466,93 @@ class Tile(object):
         """ Return a string .format'd with tile attributes
 
         Args:
-            s (s): A string with format-compatible substitution fields
+            s (str or TileTemplate): A string with format-compatible
+                substitution fields naming attributes of this tile (see
+                :attr:`tilezilla.templates.TILE_FIELDS`)
 
         Returns:
             str: A formatted string
         """
-        attrs = {
-            k: v for k, v in inspect.getmembers(self)
-            if not callable(v) and not k.startswith('_')
-        }
-        return s.format(**attrs)
+        return TileTemplate.compile(s).render(self)
+
+
+# Space-filling curve keys
+def _key_coords(x, y, bits):
+    """ Return tile indexes as non-negative coordinates for curve keys
+    """
+    offset = 1 << (bits - 1)
+    x = np.asarray(x, dtype=np.int64) + offset
+    y = np.asarray(y, dtype=np.int64) + offset
+    if (np.any(x < 0) or np.any(y < 0) or
+            np.any(x >= 1 << bits) or np.any(y >= 1 << bits)):
+        raise ValueError('Tile indexes must be within [{}, {}) to be keyed'
+                         .format(-offset, offset))
+    return x, y
+
+
+def _as_key(key):
+    return int(key) if key.ndim == 0 else key
+
+
+def morton_key(x, y, bits=TILE_KEY_BITS):
+    """ Return the Morton (Z-order) key of tile indexes
+
+    Args:
+        x (int or np.ndarray): Horizontal tile index(es)
+        y (int or np.ndarray): Vertical tile index(es)
+        bits (int): Number of bits of each index to use
+
+    Returns:
+        int or np.ndarray: Key(s), interleaving the bits of ``x`` and ``y``
+    """
+    x, y = _key_coords(x, y, bits)
+    key = np.zeros(np.broadcast(x, y).shape, dtype=np.int64)
+    for b in range(bits):
+        key |= ((x >> b) & 1) << (2 * b)
+        key |= ((y >> b) & 1) << (2 * b + 1)
+    return _as_key(key)
+
+
+def hilbert_key(x, y, bits=TILE_KEY_BITS):
+    """ Return the Hilbert curve key of tile indexes
+
+    Unlike Morton keys, consecutive Hilbert keys are always neighboring
+    tiles.
+
+    Args:
+        x (int or np.ndarray): Horizontal tile index(es)
+        y (int or np.ndarray): Vertical tile index(es)
+        bits (int): Number of bits of each index to use
+
+    Returns:
+        int or np.ndarray: Key(s), the distance of each tile along a Hilbert
+            curve covering ``2 ** bits`` by ``2 ** bits`` tiles
+    """
+    x, y = _key_coords(x, y, bits)
+    x, y = np.broadcast_arrays(x, y)
+    x, y = x.copy(), y.copy()
+    n = 1 << bits
+    key = np.zeros(x.shape, dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        key += s * s * ((3 * rx) ^ ry)
+        # Rotate quadrant so the curve within it starts at its origin
+        flip = rx & ~ry
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return _as_key(key)
+
+
+#: dict: Space-filling curves available to key and order tiles
+TILE_KEY_ORDERS = {
+    'morton': morton_key,
+    'hilbert': hilbert_key
+}
 
 
 # Load tile specifications from package data